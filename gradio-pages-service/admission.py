@@ -0,0 +1,329 @@
+"""
+アドミッション制御
+アプリ毎の同時実行数・待ち行列と、クライアント毎の同時実行数・トークンバケットでプロキシへの流入を制限する
+上限を超えたリクエストは待たせ続けずに 429（クライアント側の超過）/ 503（アプリ側の飽和）で即座に返す
+SSE・WebSocket 等の長時間の接続はレート制限だけを適用し、同時実行数の枠は使わない
+カウンタはワーカープロセス毎に持つ
+"""
+
+import os
+import math
+import time
+import asyncio
+import threading
+import logging
+from collections import deque
+
+from metrics import ADMISSION_QUEUE_SECONDS, ADMISSION_REJECTIONS
+
+logger = logging.getLogger(__name__)
+
+# 設定できる制限（0 は無制限）
+LIMIT_FIELDS = {
+    'max_concurrency': int,     # アプリ全体の同時処理数
+    'queue_size': int,          # 同時処理数を超えたときに待たせる数
+    'queue_timeout': float,     # 待ち行列で待つ最大秒数
+    'app_rate': float,          # アプリ全体の秒間リクエスト数
+    'app_burst': int,
+    'client_concurrency': int,  # クライアント毎の同時処理数（待ち行列の分を含む）
+    'client_rate': float,       # クライアント毎の秒間リクエスト数
+    'client_burst': int,
+}
+
+# クライアントの状態を掃除する間隔（秒）
+CLIENT_IDLE_SECONDS = 60
+
+
+def default_limits():
+    """環境変数による既定の制限"""
+    return {
+        'max_concurrency': int(os.getenv('APP_MAX_CONCURRENCY', 64)),
+        'queue_size': int(os.getenv('APP_QUEUE_SIZE', 64)),
+        'queue_timeout': float(os.getenv('APP_QUEUE_TIMEOUT', 10)),
+        'app_rate': float(os.getenv('APP_RATE_LIMIT', 0)),
+        'app_burst': int(os.getenv('APP_RATE_BURST', 0)),
+        'client_concurrency': int(os.getenv('CLIENT_MAX_CONCURRENCY', 16)),
+        'client_rate': float(os.getenv('CLIENT_RATE_LIMIT', 50)),
+        'client_burst': int(os.getenv('CLIENT_RATE_BURST', 100)),
+    }
+
+
+def validate_limits(data):
+    """API・設定ファイルの制限を検証し、(制限, エラー) を返す（None の値は既定に戻す指定）"""
+    if not isinstance(data, dict):
+        return None, 'limits must be an object'
+    limits = {}
+    for key, value in data.items():
+        kind = LIMIT_FIELDS.get(key)
+        if kind is None:
+            return None, f"unknown limit: {key}"
+        if value is None:
+            limits[key] = None
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            return None, f"{key} must be a non-negative number"
+        limits[key] = kind(value)
+    return limits, None
+
+
+class TokenBucket:
+    """rate 個/秒で補充され、最大 burst 個まで貯まるトークンバケット"""
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, rate, burst):
+        """1個取り出す（足りなければ次に取り出せるまでの秒数を返す）"""
+        now = time.monotonic()
+        self.rate, self.burst = rate, burst
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+    @property
+    def full(self):
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.burst
+
+
+class Waiter:
+    """待ち行列の1エントリ（notify は許可時にロック下から呼ばれる）"""
+
+    __slots__ = ('notify', 'granted', 'enqueued')
+
+    def __init__(self, notify):
+        self.notify = notify
+        self.granted = False
+        self.enqueued = time.monotonic()
+
+
+class AppGate:
+    """アプリ毎の処理中数・待ち行列・レート"""
+
+    def __init__(self):
+        self.active = 0
+        self.waiters = deque()
+        self.max_concurrency = 0
+        self.bucket = None
+
+
+class ClientState:
+    __slots__ = ('active', 'bucket', 'last_seen')
+
+    def __init__(self):
+        self.active = 0
+        self.bucket = None
+        self.last_seen = time.monotonic()
+
+
+class Ticket:
+    """許可されたリクエスト（release で返却、counted=False は同時実行数に数えていない長時間の接続）"""
+
+    __slots__ = ('app_id', 'client', 'released', 'counted')
+
+    def __init__(self, app_id, client, counted=True):
+        self.app_id = app_id
+        self.client = client
+        self.released = False
+        self.counted = counted
+
+
+class Rejection:
+    """拒否したリクエストのステータスと Retry-After"""
+
+    __slots__ = ('status', 'reason', 'message', 'retry_after')
+
+    def __init__(self, status, reason, message, retry_after):
+        self.status = status
+        self.reason = reason
+        self.message = message
+        self.retry_after = max(1, math.ceil(retry_after))
+
+    @property
+    def headers(self):
+        return {'Retry-After': str(self.retry_after), 'Cache-Control': 'no-store'}
+
+
+class AdmissionController:
+    """アプリ・クライアント毎の流入制限"""
+
+    def __init__(self):
+        self.defaults = default_limits()
+        self.gates = {}
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.pruned_at = time.monotonic()
+        # 前段にリバースプロキシがある場合のみ X-Forwarded-For をクライアントとみなす
+        self.trust_forwarded_for = os.getenv('TRUST_FORWARDED_FOR', '0') == '1'
+
+        logger.info(
+            f"🚦 Admission: {self.defaults['max_concurrency'] or '∞'} concurrent/app "
+            f"(queue {self.defaults['queue_size']}), {self.defaults['client_concurrency'] or '∞'} concurrent/client, "
+            f"{self.defaults['client_rate'] or '∞'} req/s/client"
+        )
+
+    def client_id(self, remote_addr, forwarded_for=None):
+        """制限の単位となるクライアント"""
+        if self.trust_forwarded_for and forwarded_for:
+            return forwarded_for.split(',')[0].strip()
+        return remote_addr or 'unknown'
+
+    def effective(self, app_info):
+        """既定値 ← リポジトリの設定ファイル ← API の順に上書きした制限"""
+        limits = dict(self.defaults)
+        for source in (app_info.get('repo_limits'), app_info.get('limits')):
+            for key, value in (source or {}).items():
+                if key in LIMIT_FIELDS and value is not None:
+                    limits[key] = value
+        return limits
+
+    def try_admit(self, app_id, client, limits, waiter=None, streaming=False):
+        """即座に判定し、(Ticket, None) / (None, Rejection) / (None, None: 待ち行列に入った) を返す"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.pruned_at > CLIENT_IDLE_SECONDS:
+                self.prune(now)
+
+            state = self.clients.get((app_id, client))
+            if state is None:
+                state = self.clients[(app_id, client)] = ClientState()
+            state.last_seen = now
+
+            if limits['client_rate'] > 0:
+                burst = limits['client_burst'] or max(1, math.ceil(limits['client_rate']))
+                if state.bucket is None:
+                    state.bucket = TokenBucket(limits['client_rate'], burst)
+                wait = state.bucket.take(limits['client_rate'], burst)
+                if wait:
+                    return None, self.reject(app_id, 429, 'client_rate', 'Too many requests from this client', wait)
+
+            if not streaming and limits['client_concurrency'] and state.active >= limits['client_concurrency']:
+                return None, self.reject(app_id, 429, 'client_concurrency', 'Too many concurrent requests from this client', 1)
+
+            gate = self.gates.get(app_id)
+            if gate is None:
+                gate = self.gates[app_id] = AppGate()
+            gate.max_concurrency = limits['max_concurrency']
+
+            if limits['app_rate'] > 0:
+                burst = limits['app_burst'] or max(1, math.ceil(limits['app_rate']))
+                if gate.bucket is None:
+                    gate.bucket = TokenBucket(limits['app_rate'], burst)
+                wait = gate.bucket.take(limits['app_rate'], burst)
+                if wait:
+                    return None, self.reject(app_id, 503, 'app_rate', 'This app is receiving too many requests', wait)
+
+            # 接続している間ずっと枠を占有しないよう、長時間の接続は同時実行数に数えない
+            if streaming:
+                return Ticket(app_id, client, counted=False), None
+
+            if not gate.max_concurrency or (gate.active < gate.max_concurrency and not gate.waiters):
+                gate.active += 1
+                state.active += 1
+                return Ticket(app_id, client), None
+
+            if waiter is None or len(gate.waiters) >= limits['queue_size'] or limits['queue_timeout'] <= 0:
+                return None, self.reject(app_id, 503, 'queue_full', 'This app is at capacity', 1)
+
+            gate.waiters.append(waiter)
+            state.active += 1
+            return None, None
+
+    def admit(self, app_id, client, limits, streaming=False):
+        """同期版：待ち行列に入った場合は許可されるか queue_timeout まで待つ"""
+        event = threading.Event()
+        waiter = Waiter(event.set)
+        ticket, rejection = self.try_admit(app_id, client, limits, waiter, streaming)
+        if ticket or rejection:
+            return ticket, rejection
+        event.wait(limits['queue_timeout'])
+        return self.settle(app_id, client, waiter, limits)
+
+    async def admit_async(self, app_id, client, limits, streaming=False):
+        """非同期版：イベントループを止めずに待つ"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(True))
+
+        waiter = Waiter(notify)
+        ticket, rejection = self.try_admit(app_id, client, limits, waiter, streaming)
+        if ticket or rejection:
+            return ticket, rejection
+        try:
+            await asyncio.wait_for(asyncio.shield(future), limits['queue_timeout'])
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            # クライアントが切断した場合も枠を返してから抜ける
+            ticket, _ = self.settle(app_id, client, waiter, limits)
+            if ticket:
+                self.release(ticket)
+            raise
+        return self.settle(app_id, client, waiter, limits)
+
+    def settle(self, app_id, client, waiter, limits):
+        """待ち終わった waiter を Ticket か 503 に確定する"""
+        with self.lock:
+            ADMISSION_QUEUE_SECONDS.labels(app_id).observe(time.monotonic() - waiter.enqueued)
+            if waiter.granted:
+                return Ticket(app_id, client), None
+            gate = self.gates.get(app_id)
+            if gate and waiter in gate.waiters:
+                gate.waiters.remove(waiter)
+            state = self.clients.get((app_id, client))
+            if state:
+                state.active -= 1
+            return None, self.reject(app_id, 503, 'queue_timeout', 'Timed out waiting for this app', limits['queue_timeout'])
+
+    def release(self, ticket):
+        """処理が終わった枠を返し、待ち行列の先頭を通す"""
+        with self.lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if not ticket.counted:
+                return
+            state = self.clients.get((ticket.app_id, ticket.client))
+            if state:
+                state.active -= 1
+            gate = self.gates.get(ticket.app_id)
+            if not gate:
+                return
+            gate.active -= 1
+            while gate.waiters and (not gate.max_concurrency or gate.active < gate.max_concurrency):
+                waiter = gate.waiters.popleft()
+                waiter.granted = True
+                gate.active += 1
+                waiter.notify()
+
+    def reject(self, app_id, status, reason, message, retry_after):
+        ADMISSION_REJECTIONS.labels(app_id, reason).inc()
+        return Rejection(status, reason, message, retry_after)
+
+    def prune(self, now):
+        """しばらくリクエストのないクライアント・アプリの状態を捨てる（ロック取得済み）"""
+        self.pruned_at = now
+        for key, state in list(self.clients.items()):
+            if state.active <= 0 and now - state.last_seen > CLIENT_IDLE_SECONDS and (state.bucket is None or state.bucket.full):
+                del self.clients[key]
+        for app_id, gate in list(self.gates.items()):
+            if gate.active <= 0 and not gate.waiters and (gate.bucket is None or gate.bucket.full):
+                del self.gates[app_id]
+
+    def status(self, app_id):
+        """アプリの処理中数・待ち数"""
+        with self.lock:
+            gate = self.gates.get(app_id)
+            return {
+                'active': gate.active if gate else 0,
+                'queued': len(gate.waiters) if gate else 0,
+            }
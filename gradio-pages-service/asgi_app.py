@@ -0,0 +1,657 @@
+"""
+Forgejo Gradio Pages サービス（ASGI版）
+asyncio + httpx でプロキシし、接続数がスレッド数に縛られないようにする
+起動: gunicorn -c gunicorn.conf.py asgi_app:app
+"""
+
+import time
+import asyncio
+import logging
+
+import httpx
+import websockets
+from starlette.applications import Starlette
+from starlette.background import BackgroundTask, BackgroundTasks
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocketDisconnect
+
+from forgejo_gradio_manager import (
+    manager,
+    proxy as sync_proxy,
+    balancer,
+    choose_replica,
+    lookup_asset,
+    metrics_collector,
+    feed,
+    start_deploy,
+    deploy_log_stream,
+    handle_webhook_event,
+    render_status_page,
+    render_starting_page,
+    STARTING_HEADERS,
+)
+from proxy_engine import HOP_BY_HOP_HEADERS, is_streaming_request
+from deploy_owner import OwnerUnavailable
+from admission import validate_limits
+from dashboard import DASHBOARD_REFRESH_SECONDS, parse_since, sse_event
+from load_balancer import STICKY_COOKIE, gradio_session_hash, wants_session_body
+from metrics import (
+    PROXY_CONNECT_SECONDS, PROXY_ERRORS, PROXY_REQUEST_SECONDS, PROXY_RESPONSE_BYTES, render_metrics,
+)
+
+logger = logging.getLogger(__name__)
+# プロキシした全リクエストがINFOで出力されるのを抑制
+logging.getLogger('httpx').setLevel(logging.WARNING)
+
+PROXY_METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS']
+
+
+class AsyncGradioProxy:
+    """httpx.AsyncClient によるストリーミングプロキシ（設定は同期版と共通）"""
+
+    def __init__(self, settings):
+        self.chunk_size = settings.chunk_size
+        self.connect_timeout = settings.connect_timeout
+        self.read_timeout = settings.read_timeout
+        self.stream_idle_timeout = settings.stream_idle_timeout
+        self.pool_maxsize = settings.pool_maxsize
+        self.asset_cache = settings.asset_cache
+        self.client = None
+
+    async def start(self):
+        """ワーカー起動時にクライアントを生成（fork後に作る必要がある）"""
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=None,
+                max_keepalive_connections=self.pool_maxsize,
+            ),
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            trust_env=False,
+        )
+        logger.info(f"🔀 Async proxy started (keep-alive pool: {self.pool_maxsize})")
+
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+
+    def build_upstream_headers(self, request):
+        """上流へ転送するリクエストヘッダを組み立て"""
+        # Content-Length は残す（httpx はその場合 chunked にしない）
+        headers = [
+            (key, value) for key, value in request.headers.items()
+            if key.lower() not in HOP_BY_HOP_HEADERS and key.lower() != 'host'
+        ]
+        forwarded_for = request.headers.get('x-forwarded-for')
+        client_ip = request.client.host if request.client else ''
+        headers.append(('X-Forwarded-For', f"{forwarded_for}, {client_ip}" if forwarded_for else client_ip))
+        headers.append(('X-Forwarded-Host', request.headers.get('host', '')))
+        headers.append(('X-Forwarded-Proto', request.url.scheme))
+        return headers
+
+    def build_response_headers(self, upstream, host, port, prefix):
+        """クライアントへ返すレスポンスヘッダを組み立て"""
+        headers = {}
+        for key, value in upstream.headers.multi_items():
+            lower = key.lower()
+            if lower in HOP_BY_HOP_HEADERS:
+                continue
+            if lower == 'location':
+                for origin in (f"http://{host}:{port}", f"http://localhost:{port}"):
+                    if value.startswith(origin):
+                        value = prefix + value[len(origin):]
+                        break
+            headers[key] = value
+        return headers
+
+    def connect_tracer(self, app_label):
+        """httpx の trace 拡張でTCP接続の確立時間を記録"""
+        started = {}
+
+        async def trace(event_name, info):
+            if event_name == 'connection.connect_tcp.started':
+                started['at'] = time.perf_counter()
+            elif event_name == 'connection.connect_tcp.complete' and 'at' in started:
+                PROXY_CONNECT_SECONDS.labels(app_label).observe(time.perf_counter() - started['at'])
+        return trace
+
+    async def stream_body(self, upstream, app_label):
+        """上流レスポンスを届いた分だけ中継し、転送量を記録"""
+        sent = 0
+        try:
+            async for chunk in upstream.aiter_raw():
+                sent += len(chunk)
+                yield chunk
+        finally:
+            PROXY_RESPONSE_BYTES.labels(app_label).inc(sent)
+
+    async def forward(self, request, host, port, path, prefix='', app_label='', on_close=None, cache_key=None):
+        """リクエストを上流へ転送し、StreamingResponseを返す（on_close はストリーム終了後に呼ぶ）"""
+        app_label = app_label or f"{host}:{port}"
+        target_url = f"http://{host}:{port}{path}"
+        if request.url.query:
+            target_url = f"{target_url}?{request.url.query}"
+
+        has_body = request.headers.get('content-length') not in (None, '0') or \
+            request.headers.get('transfer-encoding', '').lower() == 'chunked'
+        read_timeout = self.stream_idle_timeout if is_streaming_request(request, path) else self.read_timeout
+        cache = self.asset_cache if cache_key else None
+        upstream_headers = self.build_upstream_headers(request)
+        if cache:
+            upstream_headers = cache.upstream_headers(upstream_headers)
+
+        upstream_request = self.client.build_request(
+            request.method,
+            target_url,
+            headers=upstream_headers,
+            content=request.stream() if has_body else None,
+            timeout=httpx.Timeout(read_timeout, connect=self.connect_timeout),
+            extensions={'trace': self.connect_tracer(app_label)},
+        )
+        started = time.perf_counter()
+        try:
+            upstream = await self.client.send(upstream_request, stream=True)
+        except Exception:
+            PROXY_ERRORS.labels(app_label).inc()
+            raise
+        PROXY_REQUEST_SECONDS.labels(app_label, str(upstream.status_code)).observe(time.perf_counter() - started)
+
+        headers = self.build_response_headers(upstream, host, port, prefix)
+        background = BackgroundTasks([BackgroundTask(upstream.aclose)])
+        if on_close:
+            background.add_task(on_close)
+
+        if cache:
+            content_length = upstream.headers.get('content-length', '')
+            ttl = cache.ttl_for(upstream.status_code, list(headers.items()), int(content_length) if content_length.isdigit() else None)
+            if ttl:
+                content = b''.join([chunk async for chunk in upstream.aiter_raw()])
+                PROXY_RESPONSE_BYTES.labels(app_label).inc(len(content))
+                entry = cache.store(cache_key, upstream.status_code, list(headers.items()), content, ttl)
+                status, cached_headers, content = cache.respond(entry, request.headers, hit=False)
+                return Response(content, status_code=status, headers=dict(cached_headers), background=background)
+
+        if 'text/event-stream' in upstream.headers.get('content-type', ''):
+            headers['X-Accel-Buffering'] = 'no'
+            logger.info(f"📡 SSE stream opened: {path} ({host}:{port})")
+
+        return StreamingResponse(
+            self.stream_body(upstream, app_label),
+            status_code=upstream.status_code,
+            headers=headers,
+            background=background,
+        )
+
+    async def relay(self, receive, send):
+        """片方向のメッセージ中継（無通信タイムアウト付き）"""
+        while True:
+            message = await asyncio.wait_for(receive(), timeout=self.stream_idle_timeout)
+            if message is None:
+                return
+            await send(message)
+
+    async def tunnel_websocket(self, websocket, host, port, path, app_label=''):
+        """WebSocketをコンテナポートへ中継"""
+        app_label = app_label or f"{host}:{port}"
+        target_url = f"ws://{host}:{port}{path}"
+        if websocket.url.query:
+            target_url = f"{target_url}?{websocket.url.query}"
+
+        subprotocols = [
+            p.strip() for p in websocket.headers.get('sec-websocket-protocol', '').split(',') if p.strip()
+        ]
+        extra_headers = [
+            (key, value) for key, value in websocket.headers.items()
+            if key.lower() in ('cookie', 'authorization', 'origin', 'user-agent')
+        ]
+
+        started = time.perf_counter()
+        try:
+            upstream = await websockets.connect(
+                target_url,
+                subprotocols=subprotocols or None,
+                extra_headers=extra_headers,
+                open_timeout=self.connect_timeout,
+                max_size=None,
+            )
+        except Exception:
+            PROXY_ERRORS.labels(app_label).inc()
+            raise
+        # ハンドシェイク完了までの時間（TCP接続 + アップグレード）
+        PROXY_CONNECT_SECONDS.labels(app_label).observe(time.perf_counter() - started)
+
+        async with upstream:
+            await websocket.accept(subprotocol=upstream.subprotocol)
+            logger.info(f"🔗 WebSocket tunnel opened: {path} ({host}:{port})")
+
+            async def client_receive():
+                message = await websocket.receive()
+                if message['type'] == 'websocket.disconnect':
+                    return None
+                return message.get('bytes') if message.get('bytes') is not None else message.get('text')
+
+            async def upstream_receive():
+                try:
+                    return await upstream.recv()
+                except websockets.ConnectionClosed:
+                    return None
+
+            async def client_send(data):
+                if isinstance(data, bytes):
+                    await websocket.send_bytes(data)
+                else:
+                    await websocket.send_text(data)
+
+            tasks = [
+                asyncio.create_task(self.relay(client_receive, upstream.send)),
+                asyncio.create_task(self.relay(upstream_receive, client_send)),
+            ]
+            try:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+                for task in done:
+                    if isinstance(task.exception(), asyncio.TimeoutError):
+                        logger.info(f"⏰ WebSocket idle timeout ({self.stream_idle_timeout}s)")
+            finally:
+                logger.info(f"🔗 WebSocket tunnel closed: {path} ({host}:{port})")
+                try:
+                    await websocket.close()
+                except RuntimeError:
+                    pass
+
+
+async_proxy = AsyncGradioProxy(sync_proxy)
+state_sync_task = None
+
+
+async def sync_state_loop():
+    """他ワーカーのアプリ状態（SQLite）をスレッドプールで定期的に取り込む"""
+    while True:
+        try:
+            await run_in_threadpool(manager.sync_apps_state)
+        except Exception as e:
+            logger.error(f"State sync error: {e}")
+        await asyncio.sleep(manager.state_sync_interval)
+
+
+async def start_state_sync():
+    """マルチワーカー時はルーティング用の状態をイベントループの外で取り込む"""
+    global state_sync_task
+    if not manager.shared_state or state_sync_task:
+        return
+    await run_in_threadpool(manager.sync_apps_state)
+    manager.background_state_sync = True
+    state_sync_task = asyncio.create_task(sync_state_loop())
+    logger.info(f"🔄 Syncing app state every {manager.state_sync_interval}s in the background")
+
+
+async def stop_state_sync():
+    global state_sync_task
+    if state_sync_task:
+        state_sync_task.cancel()
+        state_sync_task = None
+    manager.background_state_sync = False
+
+
+def split_repo_path(path_params):
+    """パスパラメータからリポジトリ名・ブランチ・アプリ内パスを取得"""
+    repo_full_name = f"{path_params['username']}/{path_params['repository']}"
+    branch, path = manager.split_branch_path(repo_full_name, path_params.get('path', ''))
+    if not path.startswith('/'):
+        path = '/' + path
+    return repo_full_name, branch, path
+
+
+async def wait_for_cold_start(repo_full_name, branch='main'):
+    """idle アプリを起動し、スレッドを占有せずに準備完了を待つ"""
+    await run_in_threadpool(manager.cold_start, repo_full_name, branch, wait=False)
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + manager.cold_start_timeout
+    while loop.time() < deadline and manager.is_app_suspended(repo_full_name, branch):
+        await asyncio.sleep(0.5)
+    return manager.get_app_target(repo_full_name, branch)
+
+
+async def admit(connection, app_label, streaming=False):
+    """アプリ・クライアント毎の上限を判定（待ち行列ではイベントループを止めずに待つ、streaming はレート制限のみ）"""
+    client = manager.admission.client_id(
+        connection.client.host if connection.client else None, connection.headers.get('x-forwarded-for')
+    )
+    limits = manager.admission.effective(manager.apps.get(app_label) or {})
+    return await manager.admission.admit_async(app_label, client, limits, streaming)
+
+
+async def serve_gradio_app(request):
+    """Gradioアプリを提供（パスベース、main 以外のブランチは /@<branch>/ 配下）"""
+    repo_full_name, branch, path = split_repo_path(request.path_params)
+    prefix = manager.app_path(repo_full_name, branch)
+    if request.url.path == prefix:
+        # 相対パスのアセットを解決できるよう末尾の / を付ける
+        query = request.url.query
+        return RedirectResponse(f"{prefix}/" + (f"?{query}" if query else ''), status_code=308)
+    target = manager.get_app_target(repo_full_name, branch)
+    if not target and manager.is_app_suspended(repo_full_name, branch):
+        # ブラウザには即座に起動中ページ、API呼び出しは起動完了まで保留
+        if request.method == 'GET' and 'text/html' in request.headers.get('accept', ''):
+            await run_in_threadpool(manager.cold_start, repo_full_name, branch, wait=False)
+            return HTMLResponse(render_starting_page(repo_full_name), status_code=503, headers=STARTING_HEADERS)
+        target = await wait_for_cold_start(repo_full_name, branch)
+    if not target:
+        return HTMLResponse(f"<h1>404 - Gradio App Not Found</h1><p>App '{repo_full_name}' ({branch}) is not deployed or not running.</p><p><a href='/'>← Back to Apps List</a></p>", status_code=404)
+
+    manager.touch_app(repo_full_name, branch)
+
+    # JS/CSS等はキャッシュから返し、上流へは送らない
+    asset_key, cached = lookup_asset(repo_full_name, branch, request.method, path, request.url.query, request.headers)
+    if cached:
+        status, headers, body = cached
+        return Response(body, status_code=status, headers=dict(headers))
+
+    # Gradioのセッション（キュー/SSE）は同じレプリカへ固定する（読んだボディは stream() で再送される）
+    body = None
+    content_length = request.headers.get('content-length')
+    if wants_session_body(request.method, path, request.headers.get('content-type'),
+                          int(content_length) if content_length and content_length.isdigit() else None):
+        body = await request.body()
+    session_hash = gradio_session_hash(path, request.query_params.get('session_hash'), body)
+
+    # アプリ・クライアント毎の上限を超えたら上流へ送らずに返す
+    app_label = f"{repo_full_name}:{branch}"
+    ticket, rejection = await admit(request, app_label, is_streaming_request(request, path))
+    if rejection:
+        return HTMLResponse(
+            f"<h1>{rejection.status} - {rejection.message}</h1><p>Please retry in {rejection.retry_after}s.</p>",
+            status_code=rejection.status, headers=rejection.headers
+        )
+
+    replica, set_sticky = choose_replica(repo_full_name, branch, request.cookies.get(STICKY_COOKIE), session_hash)
+    if not replica:
+        manager.admission.release(ticket)
+        return HTMLResponse(f"<h1>503 - No Healthy Replica</h1><p>App '{repo_full_name}' has no healthy replica.</p>", status_code=503)
+
+    def finish():
+        balancer.release(replica)
+        manager.admission.release(ticket)
+
+    balancer.acquire(replica)
+    try:
+        response = await async_proxy.forward(
+            request, replica['host'], replica['port'], path, prefix=prefix,
+            app_label=app_label, on_close=finish, cache_key=asset_key,
+        )
+    except Exception as e:
+        finish()
+        if isinstance(e, httpx.ConnectError):
+            balancer.eject(replica)
+        logger.error(f"Proxy error for {repo_full_name}: {e}")
+        return HTMLResponse(f"<h1>502 - Service Unavailable</h1><p>Error connecting to Gradio app: {str(e)}</p>", status_code=502)
+
+    if set_sticky:
+        response.set_cookie(STICKY_COOKIE, replica['container_name'], path=f"{prefix}/", httponly=True, samesite='lax')
+    return response
+
+
+async def serve_gradio_websocket(websocket):
+    """Gradioアプリへのアップグレード接続を中継"""
+    repo_full_name, branch, path = split_repo_path(websocket.path_params)
+    target = manager.get_app_target(repo_full_name, branch)
+    if not target and manager.is_app_suspended(repo_full_name, branch):
+        target = await wait_for_cold_start(repo_full_name, branch)
+    if not target:
+        await websocket.close(code=4404)
+        return
+
+    manager.touch_app(repo_full_name, branch)
+    session_hash = gradio_session_hash(path, websocket.query_params.get('session_hash'))
+    app_label = f"{repo_full_name}:{branch}"
+    ticket, rejection = await admit(websocket, app_label, streaming=True)
+    if rejection:
+        await websocket.close(code=1013)
+        return
+
+    replica, _ = choose_replica(repo_full_name, branch, websocket.cookies.get(STICKY_COOKIE), session_hash)
+    if not replica:
+        manager.admission.release(ticket)
+        await websocket.close(code=1013)
+        return
+
+    balancer.acquire(replica)
+    try:
+        await async_proxy.tunnel_websocket(websocket, replica['host'], replica['port'], path, app_label=app_label)
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        if isinstance(e, OSError):
+            balancer.eject(replica)
+        logger.error(f"WebSocket proxy error for {repo_full_name}: {e}")
+        await websocket.close(code=1011)
+    finally:
+        balancer.release(replica)
+        manager.admission.release(ticket)
+
+
+async def webhook(request):
+    """Forgejo Webhookエンドポイント"""
+    try:
+        logger.info("📧 Received webhook")
+        data = await request.json()
+        body, status = await run_in_threadpool(handle_webhook_event, data, request.headers)
+        return JSONResponse(body, status_code=status)
+    except Exception as e:
+        logger.error(f"Webhook error: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def list_apps(request):
+    """アプリ一覧API（owner / status / branch で絞り込み、limit / offset でページング、ETag 対応）"""
+    status, body, headers = await run_in_threadpool(
+        feed.query, request.query_params, request.headers.get('if-none-match')
+    )
+    if status == 304:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(body, status_code=status, headers=headers)
+
+
+async def dashboard_delta(request):
+    """ダッシュボードの差分（since 以降に変わったアプリ）"""
+    since = parse_since(request.query_params.get('since'))
+    return JSONResponse(await run_in_threadpool(feed.delta, since, request.query_params.get('feed')))
+
+
+async def feed_events(since, feed_id, keepalive=15):
+    """ダッシュボードの SSE（状態の読み直しだけをスレッドプールで行い、待つ間はスレッドを占有しない）"""
+    loop = asyncio.get_running_loop()
+    delta = await run_in_threadpool(feed.delta, since, feed_id)
+    yield sse_event(delta)
+    version = delta['version']
+    sent_at = loop.time()
+    while True:
+        await asyncio.sleep(DASHBOARD_REFRESH_SECONDS)
+        current = await run_in_threadpool(feed.refresh, DASHBOARD_REFRESH_SECONDS)
+        if current == version:
+            if loop.time() - sent_at >= keepalive:
+                sent_at = loop.time()
+                yield ": keepalive\n\n"
+            continue
+        delta = await run_in_threadpool(feed.delta, version)
+        version = delta['version']
+        sent_at = loop.time()
+        yield sse_event(delta)
+
+
+async def dashboard_events(request):
+    """ダッシュボードの差分フィード（SSE）"""
+    since = parse_since(request.headers.get('last-event-id') or request.query_params.get('since'))
+    return StreamingResponse(
+        feed_events(since, request.query_params.get('feed')),
+        media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+async def manage_app(request):
+    """手動デプロイ / 停止API"""
+    repo_full_name = request.path_params['repo_full_name']
+    try:
+        body = await request.body()
+        data = (await request.json() if body else None) or {}
+        # DELETE にボディを付けられないクライアント向けにクエリでも指定可能
+        branch = request.query_params.get('branch') or data.get('branch', 'main')
+
+        if request.method == 'POST':
+            logger.info(f"🚀 Manual deploy request for {repo_full_name}")
+            result, status = await run_in_threadpool(start_deploy, repo_full_name, branch, None, 'api', data.get('replicas'))
+            return JSONResponse(result, status_code=status)
+
+        if await run_in_threadpool(manager.run_on_owner, 'stop_app', f"{repo_full_name}:{branch}"):
+            return JSONResponse({'status': 'success', 'message': 'App stopped'})
+        return JSONResponse({'status': 'error', 'message': 'Failed to stop app'}, status_code=400)
+    except Exception as e:
+        logger.error(f"App API error: {e}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
+
+async def app_limits(request):
+    """アプリの流入制限API（PUT の null は既定値に戻す）"""
+    repo_full_name = request.path_params['repo_full_name']
+    branch = request.query_params.get('branch', 'main')
+    if request.method == 'PUT':
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        limits, error = validate_limits(data)
+        if error:
+            return JSONResponse({'error': error}, status_code=400)
+        result = await run_in_threadpool(manager.run_on_owner, 'set_app_limits', repo_full_name, branch, limits)
+    else:
+        result = await run_in_threadpool(manager.get_app_limits, repo_full_name, branch)
+    if result is None:
+        return JSONResponse({'error': 'App not found'}, status_code=404)
+    return JSONResponse(result)
+
+
+async def app_deploys(request):
+    """アプリのデプロイ履歴API（フェーズ毎の時刻付き）"""
+    repo_full_name = request.path_params['repo_full_name']
+    branch = request.query_params.get('branch', 'main')
+    try:
+        limit = int(request.query_params.get('limit', 20))
+    except ValueError:
+        limit = 20
+    return JSONResponse(await run_in_threadpool(manager.deploy_history, repo_full_name, branch, limit))
+
+
+async def deploy_status(request):
+    """デプロイキューの状態API"""
+    return JSONResponse(await run_in_threadpool(manager.run_on_owner, 'scheduler_status'))
+
+
+async def base_images(request):
+    """ベースイメージプールの状態API"""
+    items = await run_in_threadpool(manager.run_on_owner, 'base_image_status')
+    return JSONResponse({'enabled': manager.base_images.enabled, 'base_images': items})
+
+
+async def deploy_detail(request):
+    """デプロイ詳細API（ビルドログ込み）"""
+    job = await run_in_threadpool(manager.get_deploy, request.path_params['job_id'])
+    if not job:
+        return JSONResponse({'error': 'Deploy not found'}, status_code=404)
+    return JSONResponse(job)
+
+
+async def read_job_log(job_id, index):
+    """実行中のジョブのログ（オーナー以外のワーカーではオーナーから取得）"""
+    if manager.is_owner:
+        return manager.read_job_log(job_id, index)
+    return await run_in_threadpool(manager.run_on_owner, 'read_job_log', job_id, index)
+
+
+async def follow_deploy_log(job_id, first, keepalive=15, interval=0.25):
+    """実行中のデプロイログを追従（待つ間はスレッドを占有しない）"""
+    loop = asyncio.get_running_loop()
+    sent_at = loop.time()
+    chunk = first
+    while True:
+        if chunk is None:
+            # 追従中にオーナーの履歴から外れた
+            return
+        lines, index, done = chunk
+        if lines:
+            sent_at = loop.time()
+            yield ''.join(f"{line}\n" for line in lines)
+        if done:
+            return
+        if loop.time() - sent_at >= keepalive:
+            sent_at = loop.time()
+            yield ''
+        await asyncio.sleep(interval)
+        try:
+            chunk = await read_job_log(job_id, index)
+        except (OwnerUnavailable, RuntimeError) as e:
+            # オーナーの引き継ぎ中などは追従を打ち切り、レスポンスは正常に閉じる
+            logger.warning(f"⚠️  Stopped following deploy log {job_id}: {e}")
+            return
+
+
+async def deploy_log(request):
+    """デプロイログ（実行中はライブで追従）"""
+    job_id = request.path_params['job_id']
+    try:
+        first = await read_job_log(job_id, 0)
+    except (OwnerUnavailable, RuntimeError) as e:
+        return owner_unavailable(request, e)
+    stream = follow_deploy_log(job_id, first) if first else await run_in_threadpool(deploy_log_stream, job_id)
+    if stream is None:
+        return JSONResponse({'error': 'Deploy not found'}, status_code=404)
+    return StreamingResponse(stream, media_type='text/plain; charset=utf-8', headers={'X-Accel-Buffering': 'no'})
+
+
+def owner_unavailable(request, exc):
+    """オーナーのワーカーに転送できなかった API は 503 を返す（Flask 側と同じ形）"""
+    return JSONResponse({'status': 'error', 'message': str(exc)}, status_code=503)
+
+
+async def metrics(request):
+    """Prometheusメトリクス"""
+    body, content_type = await run_in_threadpool(render_metrics, metrics_collector)
+    return Response(body, media_type=content_type)
+
+
+async def health(request):
+    """ヘルスチェックAPI"""
+    return JSONResponse(await run_in_threadpool(manager.health_check))
+
+
+async def index(request):
+    """ステータスページ"""
+    return HTMLResponse(await run_in_threadpool(render_status_page))
+
+
+app = Starlette(
+    routes=[
+        Route('/', index),
+        Route('/health', health),
+        Route('/metrics', metrics),
+        Route('/webhook', webhook, methods=['POST']),
+        Route('/api/apps', list_apps, methods=['GET']),
+        Route('/api/dashboard', dashboard_delta, methods=['GET']),
+        Route('/api/dashboard/events', dashboard_events, methods=['GET']),
+        Route('/api/apps/{repo_full_name:path}/deploys', app_deploys, methods=['GET']),
+        Route('/api/apps/{repo_full_name:path}/limits', app_limits, methods=['GET', 'PUT']),
+        Route('/api/apps/{repo_full_name:path}', manage_app, methods=['POST', 'DELETE']),
+        Route('/api/deploys', deploy_status, methods=['GET']),
+        Route('/api/base-images', base_images, methods=['GET']),
+        Route('/api/deploys/{job_id}', deploy_detail, methods=['GET']),
+        Route('/api/deploys/{job_id}/log', deploy_log, methods=['GET']),
+        Route('/{username}/{repository}/', serve_gradio_app, methods=PROXY_METHODS),
+        Route('/{username}/{repository}/{path:path}', serve_gradio_app, methods=PROXY_METHODS),
+        WebSocketRoute('/{username}/{repository}/', serve_gradio_websocket),
+        WebSocketRoute('/{username}/{repository}/{path:path}', serve_gradio_websocket),
+    ],
+    on_startup=[async_proxy.start, start_state_sync, manager.start_background_tasks],
+    on_shutdown=[stop_state_sync, async_proxy.close],
+    exception_handlers={OwnerUnavailable: owner_unavailable},
+)
@@ -0,0 +1,358 @@
+"""
+静的アセットのキャッシュ
+GradioのJS/CSS・フォント・/file= のレスポンスをアプリ（イメージ）毎にメモリLRUで保持し、
+あふれた分は任意でディスクへ退避する。ETag/304 と gzip/brotli 圧縮もここで付ける
+"""
+
+import os
+import re
+import gzip
+import time
+import shutil
+import hashlib
+import threading
+import logging
+from collections import OrderedDict
+
+from metrics import PROXY_CACHE_BYTES, PROXY_CACHE_REQUESTS
+from load_balancer import STICKY_COOKIE
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+# キャッシュ対象のパス（Gradioのバンドル・静的ファイル・アップロード/出力ファイル）
+ASSET_PATH_MARKERS = ('/assets/', '/static/', '/file=', '/gradio_api/file=', '/custom_component/')
+ASSET_EXTENSIONS = (
+    '.js', '.mjs', '.css', '.map', '.wasm', '.woff', '.woff2', '.ttf', '.otf',
+    '.svg', '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico',
+)
+# 圧縮して返す Content-Type
+COMPRESSIBLE_TYPES = ('text/', 'javascript', 'json', 'xml', 'svg', 'wasm')
+# 保存しないレスポンスヘッダ（ETag・圧縮・長さはキャッシュ側で付け直す）
+UNSTORED_HEADERS = {'content-length', 'content-encoding', 'etag', 'date', 'age', 'vary', 'x-cache', 'set-cookie'}
+
+MAX_AGE_PATTERN = re.compile(r'(?:s-maxage|max-age)\s*=\s*(\d+)')
+
+
+def cache_key(app_label, version, path, query=''):
+    """キャッシュキー（イメージが変われば別キーになるので再デプロイで自動的に無効化）"""
+    return app_label, version or '', f"{path}?{query}" if query else path
+
+
+def accepted_encodings(accept_encoding):
+    """Accept-Encoding のうち q=0 でないもの"""
+    accepted = set()
+    for token in (accept_encoding or '').split(','):
+        name, _, params = token.strip().partition(';')
+        if not name:
+            continue
+        if re.search(r'q\s*=\s*0(?:\.0*)?\s*$', params):
+            continue
+        accepted.add(name.strip().lower())
+    return accepted
+
+
+def has_session_cookie(cookie_header):
+    """振り分け用以外のクッキー（ログイン等、利用者毎に内容が変わりうるもの）を送っているか"""
+    for token in (cookie_header or '').split(';'):
+        name = token.partition('=')[0].strip()
+        if name and name != STICKY_COOKIE:
+            return True
+    return False
+
+
+def etag_matches(if_none_match, etag):
+    """If-None-Match が ETag と一致するか（弱い比較）"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+    return etag in tags
+
+
+class CachedAsset:
+    """1レスポンス分（圧縮済みのバリアントは遅延生成して保持）"""
+
+    __slots__ = ('key', 'status', 'headers', 'content_type', 'body', 'digest', 'expires', 'variants', 'disk_size')
+
+    def __init__(self, key, status, headers, content_type, body, expires):
+        self.key = key
+        self.status = status
+        self.headers = headers
+        self.content_type = content_type
+        self.body = body
+        self.digest = hashlib.sha1(body).hexdigest()[:20]
+        self.expires = expires
+        self.variants = {}
+        # ディスク退避中は body を None にしてサイズだけ持つ
+        self.disk_size = 0
+
+    @property
+    def size(self):
+        return len(self.body or b'') + sum(len(body) for body in self.variants.values())
+
+    def etag(self, encoding=None):
+        return f'"{self.digest}-{encoding}"' if encoding else f'"{self.digest}"'
+
+
+class AssetCache:
+    """サイズ上限付きのLRU（メモリ → ディスク）"""
+
+    def __init__(self):
+        self.max_bytes = int(float(os.getenv('ASSET_CACHE_MB', 64)) * 1024 * 1024)
+        self.max_object = int(float(os.getenv('ASSET_CACHE_MAX_OBJECT_MB', 8)) * 1024 * 1024)
+        # Cache-Control のない静的アセットを保持する秒数
+        self.default_ttl = int(os.getenv('ASSET_CACHE_TTL', 300))
+        self.compress_min = int(os.getenv('ASSET_COMPRESS_MIN', 1024))
+        self.disk_max_bytes = int(float(os.getenv('ASSET_CACHE_DISK_MB', 512)) * 1024 * 1024)
+        self.disk_dir = os.getenv('ASSET_CACHE_DIR', '')
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.disk = OrderedDict()
+        self.disk_bytes = 0
+        self.lock = threading.Lock()
+        self.dir_lock = threading.Lock()
+        self.pid = None
+
+        if self.enabled:
+            logger.info(
+                f"🗃️  Asset cache: {self.max_bytes // (1024 * 1024)}MB in memory"
+                + (f", {self.disk_max_bytes // (1024 * 1024)}MB on disk ({self.disk_dir})" if self.disk_dir else '')
+                + (', brotli' if brotli else '')
+            )
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def is_candidate(self, method, path, headers):
+        """キャッシュから返せる（または保存できる）リクエストか"""
+        if not self.enabled or method not in ('GET', 'HEAD'):
+            return False
+        # 部分取得・認証付き・クッキー付きのリクエストは上流へそのまま流す
+        if headers.get('Range') or headers.get('Authorization') or has_session_cookie(headers.get('Cookie')):
+            return False
+        return any(marker in path for marker in ASSET_PATH_MARKERS) or path.lower().endswith(ASSET_EXTENSIONS)
+
+    def upstream_headers(self, headers):
+        """キャッシュ用に上流へ送るヘッダ（無圧縮の完全なレスポンスを要求）"""
+        stripped = {'accept-encoding', 'if-none-match', 'if-modified-since'}
+        return [(key, value) for key, value in headers if key.lower() not in stripped] + [('Accept-Encoding', 'identity')]
+
+    def ttl_for(self, status, headers, content_length):
+        """上流のレスポンスを保存する秒数（保存しない場合は None）"""
+        if status != 200 or content_length is None or content_length > self.max_object:
+            return None
+        # 同名ヘッダが複数あっても指示を取りこぼさないよう連結して見る
+        lowered = {}
+        for key, value in headers:
+            key = key.lower()
+            lowered[key] = f"{lowered[key]}, {value}" if key in lowered else value
+        if 'set-cookie' in lowered or lowered.get('content-encoding', 'identity') != 'identity':
+            return None
+        if lowered.get('vary', '').strip() not in ('', 'Accept-Encoding', 'accept-encoding'):
+            return None
+        cache_control = lowered.get('cache-control', '').lower()
+        directives = {directive.strip().split('=')[0] for directive in cache_control.split(',')}
+        if directives & {'no-store', 'no-cache', 'private'}:
+            return None
+        match = MAX_AGE_PATTERN.search(cache_control)
+        if match:
+            return int(match.group(1)) or None
+        if 'immutable' in cache_control:
+            return 365 * 24 * 3600
+        return self.default_ttl or None
+
+    def store(self, key, status, headers, body, ttl):
+        """上流のレスポンスを保存"""
+        stored = [(k, v) for k, v in headers if k.lower() not in UNSTORED_HEADERS]
+        content_type = next((v for k, v in stored if k.lower() == 'content-type'), '')
+        entry = CachedAsset(key, status, stored, content_type, body, time.monotonic() + ttl)
+        spilled = []
+        with self.lock:
+            self.discard(key)
+            self.memory[key] = entry
+            self.memory_bytes += entry.size
+            spilled = self.evict_memory()
+        self.spill(spilled)
+        return entry
+
+    def lookup(self, key):
+        """キャッシュ済みのレスポンス（期限切れ・未保存なら None）"""
+        now = time.monotonic()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if entry.expires > now:
+                    self.memory.move_to_end(key)
+                    return entry
+                self.discard(key)
+            entry = self.disk.pop(key, None)
+            if entry is not None:
+                self.disk_bytes -= entry.disk_size
+        if entry is None or entry.expires <= now:
+            if entry is not None:
+                self.remove_file(entry)
+            PROXY_CACHE_REQUESTS.labels('miss').inc()
+            return None
+
+        # ディスクから読み戻してメモリ側へ昇格
+        try:
+            with open(self.file_path(key), 'rb') as f:
+                entry.body = f.read()
+        except OSError:
+            PROXY_CACHE_REQUESTS.labels('miss').inc()
+            return None
+        self.remove_file(entry)
+        with self.lock:
+            self.discard(key)
+            self.memory[key] = entry
+            self.memory_bytes += entry.size
+            spilled = self.evict_memory()
+        self.spill(spilled)
+        return entry
+
+    def respond(self, entry, request_headers, hit=True):
+        """(ステータス, ヘッダ, ボディ) を組み立て（ETag 一致なら 304、HEAD のボディはサーバー側で落とす）"""
+        encoding = self.pick_encoding(entry, request_headers.get('Accept-Encoding'))
+        body = self.variant(entry, encoding)
+        etag = entry.etag(encoding)
+        headers = list(entry.headers) + [
+            ('ETag', etag),
+            ('Vary', 'Accept-Encoding'),
+            ('X-Cache', 'HIT' if hit else 'MISS'),
+        ]
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+
+        if etag_matches(request_headers.get('If-None-Match'), etag):
+            if hit:
+                PROXY_CACHE_REQUESTS.labels('not_modified').inc()
+            return 304, headers, b''
+        if hit:
+            PROXY_CACHE_REQUESTS.labels('hit').inc()
+        headers.append(('Content-Length', str(len(body))))
+        return entry.status, headers, body
+
+    def pick_encoding(self, entry, accept_encoding):
+        """クライアントが受け付ける圧縮方式（圧縮しない場合は None）"""
+        if len(entry.body) < self.compress_min:
+            return None
+        if not any(kind in entry.content_type for kind in COMPRESSIBLE_TYPES):
+            return None
+        accepted = accepted_encodings(accept_encoding)
+        if brotli and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    def variant(self, entry, encoding):
+        """圧縮済みのボディ（初回のみ圧縮して保持）"""
+        if not encoding:
+            return entry.body
+        body = entry.variants.get(encoding)
+        if body is None:
+            if encoding == 'br':
+                body = brotli.compress(entry.body, quality=5)
+            else:
+                body = gzip.compress(entry.body, compresslevel=6, mtime=0)
+            with self.lock:
+                if entry.key in self.memory and encoding not in entry.variants:
+                    entry.variants[encoding] = body
+                    self.memory_bytes += len(body)
+                    spilled = self.evict_memory()
+                else:
+                    spilled = []
+            self.spill(spilled)
+        return body
+
+    def invalidate(self, app_label, keep_version=None):
+        """アプリのキャッシュを削除（keep_version のものは残す）"""
+        removed = []
+        with self.lock:
+            for key in [k for k in (*self.memory, *self.disk) if k[0] == app_label and k[1] != keep_version]:
+                entry = self.disk.get(key)
+                if entry is not None:
+                    removed.append(entry)
+                self.discard(key)
+            self.update_gauges()
+        for entry in removed:
+            self.remove_file(entry)
+
+    def discard(self, key):
+        """メモリ・ディスクからキーを外す（呼び出し側でロック取得済み）"""
+        entry = self.memory.pop(key, None)
+        if entry is not None:
+            self.memory_bytes -= entry.size
+        entry = self.disk.pop(key, None)
+        if entry is not None:
+            self.disk_bytes -= entry.disk_size
+
+    def evict_memory(self):
+        """上限を超えた分を古い順に追い出し、ディスクへ退避する分を返す（ロック取得済み）"""
+        spilled = []
+        now = time.monotonic()
+        while self.memory_bytes > self.max_bytes and self.memory:
+            _, entry = self.memory.popitem(last=False)
+            self.memory_bytes -= entry.size
+            if self.disk_dir and entry.expires > now and len(entry.body) <= self.disk_max_bytes:
+                spilled.append(entry)
+        self.update_gauges()
+        return spilled
+
+    def spill(self, entries):
+        """追い出したエントリをディスクへ書き出す（圧縮済みバリアントは捨てる）"""
+        for entry in entries:
+            path = self.file_path(entry.key)
+            try:
+                with open(path, 'wb') as f:
+                    f.write(entry.body)
+            except OSError as e:
+                logger.warning(f"Failed to spill asset to {path}: {e}")
+                continue
+            evicted = []
+            with self.lock:
+                if entry.key in self.memory:
+                    # 書き出している間に新しいレスポンスが保存された
+                    evicted.append(entry)
+                else:
+                    entry.variants = {}
+                    entry.disk_size = len(entry.body)
+                    entry.body = None
+                    self.discard(entry.key)
+                    self.disk[entry.key] = entry
+                    self.disk_bytes += entry.disk_size
+                while self.disk_bytes > self.disk_max_bytes and self.disk:
+                    _, old = self.disk.popitem(last=False)
+                    self.disk_bytes -= old.disk_size
+                    evicted.append(old)
+                self.update_gauges()
+            for old in evicted:
+                self.remove_file(old)
+
+    def file_path(self, key):
+        """ディスク上のファイル（ワーカー毎のディレクトリ）"""
+        directory = os.path.join(self.disk_dir, str(os.getpid()))
+        with self.dir_lock:
+            if self.pid != os.getpid():
+                # 前回の起動やfork元のファイルは使わない
+                shutil.rmtree(directory, ignore_errors=True)
+                os.makedirs(directory, exist_ok=True)
+                self.pid = os.getpid()
+        return os.path.join(directory, hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def remove_file(self, entry):
+        try:
+            os.remove(self.file_path(entry.key))
+        except OSError:
+            pass
+
+    def update_gauges(self):
+        PROXY_CACHE_BYTES.labels('memory').set(self.memory_bytes)
+        PROXY_CACHE_BYTES.labels('disk').set(self.disk_bytes)
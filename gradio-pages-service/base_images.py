@@ -0,0 +1,320 @@
+"""
+ベースイメージプール
+よく使う依存関係（gradio / torch / transformers など）をインストール済みのベースイメージを事前にビルド・定期更新し、
+requirements.txt に合うベースへ Dockerfile の FROM を差し替えて差分だけをインストールさせる
+"""
+
+import io
+import os
+import re
+import time
+import tarfile
+import hashlib
+import threading
+import logging
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+# ベースイメージの名前（タグは定義のダイジェスト）
+BASE_IMAGE_PREFIX = 'gradio-pages-base'
+# BuildKit のキャッシュマウントで共有する pip のキャッシュ
+PIP_CACHE_MOUNT = '--mount=type=cache,id=gradio-pages-pip,target=/root/.cache/pip,sharing=locked'
+
+# BASE_IMAGES_FILE がない場合の定義
+DEFAULT_BASE_IMAGES = [
+    {'name': 'gradio', 'from': 'python:3.11-slim', 'requirements': ['gradio']},
+    {'name': 'gradio-transformers', 'from': 'python:3.11-slim', 'requirements': ['gradio', 'torch', 'transformers']},
+]
+
+REQUIREMENT_NAME = re.compile(r'^([A-Za-z0-9][A-Za-z0-9._-]*)')
+FROM_LINE = re.compile(r'^(\s*FROM\s+)((?:--\S+\s+)*)(\S+)(.*)$', re.IGNORECASE)
+
+
+def normalize_name(name):
+    """PEP 503 の正規化（大文字小文字・区切り文字の違いを同一視）"""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def parse_requirements(text):
+    """requirements.txt を {正規化したパッケージ名: バージョン指定} にする（オプション行・URL は無視）"""
+    packages = {}
+    for line in text.splitlines():
+        line = line.split(' #', 1)[0].strip()
+        if not line or line.startswith(('#', '-')) or '://' in line:
+            continue
+        match = REQUIREMENT_NAME.match(line)
+        if not match:
+            continue
+        spec = line[match.end():].split(';', 1)[0]
+        spec = re.sub(r'^\[[^\]]*\]', '', spec).strip()
+        packages[normalize_name(match.group(1))] = spec
+    return packages
+
+
+def normalize_image(image):
+    """docker.io/library/ の省略を揃える"""
+    for prefix in ('docker.io/library/', 'library/'):
+        if image.startswith(prefix):
+            return image[len(prefix):]
+    return image
+
+
+def logical_lines(text):
+    """Dockerfile を行継続（末尾の \\）でまとめた命令毎の行リストにする"""
+    group = []
+    for line in text.splitlines():
+        group.append(line)
+        if not line.rstrip().endswith('\\'):
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+class BaseImageSpec:
+    """ベースイメージ1つ分の定義"""
+
+    def __init__(self, name, source, requirements, pip_args=None):
+        self.name = name
+        self.source = normalize_image(source)
+        self.requirements = list(requirements)
+        self.pip_args = list(pip_args or [])
+        self.packages = parse_requirements('\n'.join(self.requirements))
+        digest = hashlib.sha256(
+            '\0'.join([self.source, *self.requirements, '', *self.pip_args]).encode()
+        ).hexdigest()
+        self.tag = f"{BASE_IMAGE_PREFIX}-{name}:{digest[:12]}"
+
+    def dockerfile(self, cache_mount=False):
+        pip_args = ' '.join(self.pip_args)
+        install = (
+            f"RUN {PIP_CACHE_MOUNT} pip install {pip_args} -r /tmp/gradio-pages-base/requirements.txt"
+            if cache_mount else
+            f"RUN pip install --no-cache-dir {pip_args} -r /tmp/gradio-pages-base/requirements.txt"
+        )
+        return (
+            f"FROM {self.source}\n"
+            f"COPY requirements.txt /tmp/gradio-pages-base/requirements.txt\n"
+            f"{install}\n"
+            f"LABEL gradio-pages.base={self.name}\n"
+        )
+
+    def match(self, packages):
+        """リポジトリの依存関係に対する一致数（ベースにしかないパッケージや固定バージョンの食い違いがあれば None）"""
+        score = 0
+        for name, spec in self.packages.items():
+            wanted = packages.get(name)
+            if wanted is None:
+                return None
+            if spec.startswith('==') and wanted.startswith('==') and spec != wanted:
+                return None
+            score += 1
+        return score
+
+
+class GeneratedContext:
+    """メモリ上のファイルだけからなる小さなビルドコンテキスト（BuildContext と同じ stream を持つ）"""
+
+    def __init__(self, files):
+        self.files = files
+
+    def stream(self):
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w') as tar:
+            for name, data in self.files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mtime = 0
+                tar.addfile(info, io.BytesIO(data))
+        yield buffer.getvalue()
+
+
+class BaseImagePool:
+    """ベースイメージの定義・ビルド状態と、リポジトリの Dockerfile の書き換え"""
+
+    def __init__(self, build_func, exists_func, buildkit=False, image_id_func=None, prune_func=None):
+        # build_func(context, image_tag, fresh) -> bool / exists_func(image_tag) -> bool
+        self.build_func = build_func
+        self.exists_func = exists_func
+        # image_id_func(image_tag) -> ID or None / prune_func(残すIDの集合) は更新で置き換わったベースの削除
+        self.image_id_func = image_id_func
+        self.prune_func = prune_func
+        self.buildkit = buildkit
+        self.enabled = os.getenv('BASE_IMAGE_POOL', '0') == '1'
+        self.refresh_hours = float(os.getenv('BASE_IMAGE_REFRESH_HOURS', 24))
+        # BuildKit 時は pip install に共有キャッシュをマウントする
+        self.cache_mount = buildkit and os.getenv('PIP_CACHE_MOUNT', '0') == '1'
+        self.specs = self.load_specs(os.getenv('BASE_IMAGES_FILE', '/data/base-images.yml')) if self.enabled else []
+        self.status = {spec.name: {'built_at': None, 'error': None, 'building': False} for spec in self.specs}
+        self.lock = threading.Lock()
+
+        if self.enabled:
+            logger.info(f"🧱 Base image pool: {', '.join(spec.name for spec in self.specs) or 'none'}")
+
+    def load_specs(self, path):
+        """ベースイメージの定義を読む（ファイルがなければ既定の定義）"""
+        definitions = DEFAULT_BASE_IMAGES
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    definitions = (yaml.safe_load(f) or {}).get('base_images', [])
+            except (OSError, yaml.YAMLError, AttributeError) as e:
+                logger.error(f"❌ Failed to load {path}, using default base images: {e}")
+        specs = []
+        for definition in definitions:
+            try:
+                specs.append(BaseImageSpec(
+                    definition['name'], definition['from'], definition['requirements'], definition.get('pip_args')
+                ))
+            except (KeyError, TypeError) as e:
+                logger.error(f"❌ Invalid base image definition {definition}: {e}")
+        return specs
+
+    def start(self):
+        """未ビルドのベースをビルドし、以後 BASE_IMAGE_REFRESH_HOURS 毎に作り直すスレッドを起動"""
+        if self.enabled and self.specs:
+            threading.Thread(target=self.refresh_loop, name='base-images', daemon=True).start()
+
+    def refresh_loop(self):
+        fresh = False
+        while True:
+            for spec in self.specs:
+                self.build(spec, fresh=fresh)
+            self.prune()
+            if self.refresh_hours <= 0:
+                return
+            time.sleep(self.refresh_hours * 3600)
+            # 固定されていない依存関係の新しいバージョンを取り込む
+            fresh = True
+
+    def build(self, spec, fresh=False):
+        """ベースイメージをビルド（fresh でなければ既にあるものはそのまま）"""
+        with self.lock:
+            state = self.status[spec.name]
+            if state['building'] or (not fresh and self.exists_func(spec.tag)):
+                return
+            state['building'] = True
+        try:
+            logger.info(f"🧱 Building base image {spec.tag}" + (" (refresh)" if fresh else ""))
+            context = GeneratedContext({
+                'Dockerfile': spec.dockerfile(self.cache_mount).encode(),
+                'requirements.txt': ('\n'.join(spec.requirements) + '\n').encode(),
+            })
+            if not self.build_func(context, spec.tag, fresh):
+                raise RuntimeError('build failed')
+            state['built_at'] = time.time()
+            state['error'] = None
+            logger.info(f"✅ Base image ready: {spec.tag}")
+        except Exception as e:
+            state['error'] = str(e)
+            logger.error(f"❌ Base image {spec.name} failed: {e}")
+        finally:
+            state['building'] = False
+
+    def image_id(self, spec):
+        return self.image_id_func(spec.tag) if self.image_id_func else None
+
+    def prune(self):
+        """作り直しで置き換わった（または定義から消えた）ベースイメージを削除"""
+        if not self.prune_func:
+            return
+        try:
+            self.prune_func({image_id for image_id in map(self.image_id, self.specs) if image_id})
+        except Exception as e:
+            logger.warning(f"⚠️  Failed to prune old base images: {e}")
+
+    def select(self, dockerfile, requirements, preference=None):
+        """Dockerfile の FROM と requirements.txt に合うベースを選ぶ（最も多くの依存関係を含むもの）"""
+        if preference is False:
+            return None
+        sources = set()
+        for group in logical_lines(dockerfile):
+            match = FROM_LINE.match(group[0])
+            if match:
+                sources.add(normalize_image(match.group(3)))
+        packages = parse_requirements(requirements)
+        best, best_score = None, 0
+        for spec in self.specs:
+            if preference and spec.name != preference:
+                continue
+            if spec.source not in sources:
+                continue
+            score = spec.match(packages)
+            if score and score > best_score:
+                best, best_score = spec, score
+        return best
+
+    def rewrite_dockerfile(self, dockerfile, base=None):
+        """ベースの元イメージを指す FROM をベースに差し替え、BuildKit 時は pip install にキャッシュをマウント（変更がなければ None）"""
+        lines = []
+        changed = False
+        for group in logical_lines(dockerfile):
+            first = group[0]
+            match = FROM_LINE.match(first)
+            if base and match and normalize_image(match.group(3)) == base.source:
+                group = [f"{match.group(1)}{match.group(2)}{base.tag}{match.group(4)}", *group[1:]]
+                changed = True
+            elif self.cache_mount and re.match(r'\s*RUN\s', first, re.IGNORECASE):
+                command = ' '.join(group)
+                if 'pip install' in command and '--mount=' not in first:
+                    exec_form = first.lstrip()[3:].lstrip().startswith('[')
+                    group = [re.sub(r'^(\s*RUN\s+)', lambda m: f"{m.group(1)}{PIP_CACHE_MOUNT} ", first, flags=re.IGNORECASE), *group[1:]]
+                    # キャッシュはマウント側に残りレイヤーには入らないので無効化オプションは外す
+                    if not exec_form:
+                        group = [line.replace(' --no-cache-dir', '') for line in group]
+                    changed = True
+            lines.extend(group)
+        return '\n'.join(lines) + '\n' if changed else None
+
+    def prepare(self, context_dir, preference=None, job=None):
+        """ビルド前の Dockerfile（書き換え不要なら None）と、使うベースイメージの ID
+
+        ベースは同じタグのまま作り直されるため、ID をアプリのビルドコンテキストのダイジェストに含めて作り直させる
+        """
+        if not self.enabled and not self.cache_mount:
+            return None, None
+        if preference is not False and not isinstance(preference, str):
+            preference = None
+        try:
+            with open(os.path.join(context_dir, 'Dockerfile'), 'r') as f:
+                dockerfile = f.read()
+            requirements = ''
+            requirements_path = os.path.join(context_dir, 'requirements.txt')
+            if os.path.exists(requirements_path):
+                with open(requirements_path, 'r', errors='ignore') as f:
+                    requirements = f.read()
+        except OSError as e:
+            logger.warning(f"⚠️  Could not read Dockerfile for base image selection: {e}")
+            return None, None
+
+        base = self.select(dockerfile, requirements, preference) if self.enabled else None
+        if base and not self.exists_func(base.tag):
+            message = f"Base image {base.tag} is not built yet, building from {base.source}"
+            logger.info(f"🧱 {message}")
+            if job:
+                job.log_line(message)
+            threading.Thread(target=self.build, args=(base,), daemon=True).start()
+            base = None
+        if base:
+            message = f"Using base image {base.tag} ({', '.join(base.requirements)} preinstalled)"
+            logger.info(f"🧱 {message}")
+            if job:
+                job.log_line(message)
+
+        rewritten = self.rewrite_dockerfile(dockerfile, base)
+        return (rewritten.encode() if rewritten else None), (self.image_id(base) if base else None)
+
+    def to_dict(self):
+        return [
+            {
+                'name': spec.name,
+                'image': spec.tag,
+                'from': spec.source,
+                'requirements': spec.requirements,
+                'built': self.exists_func(spec.tag),
+                **self.status[spec.name],
+            }
+            for spec in self.specs
+        ]
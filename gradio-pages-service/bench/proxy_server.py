@@ -0,0 +1,58 @@
+"""
+ベンチマーク対象のサービスを起動（Docker API はスタンドインに差し替え）
+run_bench.py から別プロセスとして起動し、メモリ使用量をこのプロセス単位で測る
+"""
+
+import os
+import sys
+import signal
+import argparse
+import logging
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import docker
+
+from stand_ins import FakeDockerClient
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the Gradio Pages service against stand-in backends')
+    parser.add_argument('--port', type=int, required=True)
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask')
+    parser.add_argument('--build-seconds', type=float, default=0.5)
+    args = parser.parse_args()
+
+    # 接続先（DOCKER_HOSTS の URL）毎に別のデーモンとして振る舞う
+    fakes = {}
+
+    def fake_client(base_url=None, **kwargs):
+        if base_url not in fakes:
+            fakes[base_url] = FakeDockerClient(build_seconds=args.build_seconds)
+        return fakes[base_url]
+
+    docker.from_env = lambda **kwargs: fake_client()
+    docker.DockerClient = fake_client
+    # 終了時にバックエンドのプロセスも片付ける
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    try:
+        if args.server == 'asgi':
+            import uvicorn
+            import asgi_app
+            uvicorn.run(asgi_app.app, host='127.0.0.1', port=args.port, log_level='warning', access_log=False)
+        else:
+            import forgejo_gradio_manager
+            # リクエスト毎のアクセスログはベンチマークの邪魔になるので出さない
+            logging.getLogger('werkzeug').setLevel(logging.WARNING)
+            forgejo_gradio_manager.manager.start_background_tasks()
+            forgejo_gradio_manager.app.run(host='127.0.0.1', port=args.port, debug=False, threaded=True)
+    finally:
+        for fake in fakes.values():
+            fake.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,464 @@
+#!/usr/bin/env python3
+"""
+Gradio Pages ベンチマーク
+スタンドイン（偽Gradioバックエンド・偽Docker API・ローカルbareリポジトリ）に対してサービスを起動し、
+プロキシのスループット / p50・p99 レイテンシ、同時接続あたりのメモリ、Webhookから配信開始までの時間を測る
+
+    python bench/run_bench.py --output result.json
+    python bench/run_bench.py --compare baseline.json   # 悪化していれば終了コード 1
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from stand_ins import LocalForge, free_port, free_port_block, git
+
+SCHEMA_VERSION = 1
+
+# 比較対象の指標（higher: 大きいほど良い / lower: 小さいほど良い）
+TRACKED_METRICS = {
+    'rps': 'higher',
+    'p50_ms': 'lower',
+    'p99_ms': 'lower',
+    'first_event_p99_ms': 'lower',
+    'rss_per_connection_bytes': 'lower',
+    'webhook_to_serving_p50_s': 'lower',
+}
+
+
+def log(message):
+    print(message, file=sys.stderr, flush=True)
+
+
+def percentile(values, pct):
+    """最近傍法のパーセンタイル"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def process_status(pid):
+    """/proc/<pid>/status の RSS（バイト）とスレッド数"""
+    rss, threads = 0, 0
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rss = int(line.split()[1]) * 1024
+            elif line.startswith('Threads:'):
+                threads = int(line.split()[1])
+    return rss, threads
+
+
+def wait_until(predicate, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = predicate()
+        if result:
+            return result
+        time.sleep(interval)
+    return None
+
+
+class ServiceUnderTest:
+    """サービスを別プロセス（新しいセッション）で起動し、バックエンドごと停止する"""
+
+    def __init__(self, workdir, forge, server, build_seconds, keep_limits, extra_env, nodes=1):
+        self.port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        # バックエンドのポート（全ノード分）はエフェメラル範囲の外から空いている範囲を選ぶ
+        port_start = free_port_block(51 * nodes)
+        env = {
+            **os.environ,
+            'FORGEJO_URL': forge.url,
+            'GRADIO_BACKEND_HOST': '127.0.0.1',
+            'GRADIO_PORT_START': str(port_start),
+            'GRADIO_PORT_END': str(port_start + 50),
+            'STATE_DB': os.path.join(workdir, 'apps_state.db'),
+            'ASSET_CACHE_DIR': os.path.join(workdir, 'asset-cache'),
+            'DRAIN_TIMEOUT': '1',
+            'IDLE_TIMEOUT': '0',
+            'PYTHONUNBUFFERED': '1',
+        }
+        if not keep_limits:
+            # 1クライアントから負荷を掛けるため、既定ではプロキシ自体の上限を測る
+            env.update({'CLIENT_RATE_LIMIT': '0', 'CLIENT_MAX_CONCURRENCY': '0', 'APP_MAX_CONCURRENCY': '0'})
+        if nodes > 1:
+            # 2台目以降はスタンドインのリモートデーモン（同じマシンなのでポート範囲をずらす）
+            hosts = [{'name': 'local', 'ports': f"{port_start}-{port_start + 50}"}]
+            for index in range(1, nodes):
+                start = port_start + 51 * index
+                hosts.append({
+                    'name': f"node{index}",
+                    'url': f"tcp://bench-node{index}:2375",
+                    'address': '127.0.0.1',
+                    'ports': f"{start}-{start + 50}",
+                })
+            env['DOCKER_HOSTS_FILE'] = os.path.join(workdir, 'docker-hosts.yml')
+            with open(env['DOCKER_HOSTS_FILE'], 'w') as f:
+                json.dump({'docker_hosts': hosts}, f)
+        env.update(extra_env)
+        self.log_path = os.path.join(workdir, 'service.log')
+        self.log_file = open(self.log_path, 'w')
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(BENCH_DIR, 'proxy_server.py'),
+             '--port', str(self.port), '--server', server, '--build-seconds', str(build_seconds)],
+            env=env, stdout=self.log_file, stderr=subprocess.STDOUT, start_new_session=True
+        )
+
+    def wait_ready(self, timeout=30):
+        def healthy():
+            if self.process.poll() is not None:
+                raise RuntimeError(f"Service exited with code {self.process.returncode}, see {self.log_path}")
+            try:
+                return requests.get(f"{self.base_url}/health", timeout=1).ok
+            except requests.RequestException:
+                return False
+        if not wait_until(healthy, timeout, 0.2):
+            raise RuntimeError(f"Service did not become healthy, see {self.log_path}")
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            try:
+                self.process.wait(15)
+            except subprocess.TimeoutExpired:
+                pass
+        # 取り残されたバックエンドもまとめて止める
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        self.log_file.close()
+
+
+def measure_deploy(service, forge, label, previous_containers=()):
+    """push → Webhook → 新しいコンテナが応答するまでの時間と、デプロイの各フェーズ
+
+    レプリカが複数あると旧デプロイの別レプリカも応答するため、旧デプロイの全レプリカと比べる
+    """
+    sha = forge.push_commit(f"bench: {label}")
+    app_url = f"{service.base_url}/{forge.repo_full_name}/config"
+    started = time.perf_counter()
+    response = requests.post(
+        f"{service.base_url}/webhook",
+        json={'ref': 'refs/heads/main', 'after': sha, 'repository': {'full_name': forge.repo_full_name}},
+        headers={'X-Forgejo-Event': 'push'},
+        timeout=10
+    )
+    response.raise_for_status()
+    job_id = response.json()['job_id']
+
+    def serving_new_version():
+        try:
+            r = requests.get(app_url, timeout=2)
+        except requests.RequestException:
+            return None
+        container = r.headers.get('X-Container')
+        if r.status_code == 200 and container and container not in previous_containers:
+            return container
+        return None
+
+    container = wait_until(serving_new_version, 120)
+    elapsed = time.perf_counter() - started
+    job = requests.get(f"{service.base_url}/api/deploys/{job_id}", timeout=10).json()
+    if not container:
+        raise RuntimeError(f"Deploy {label} did not start serving: {job.get('status')} {job.get('message')}")
+    app_info = requests.get(f"{service.base_url}/api/apps", timeout=10).json().get(f"{forge.repo_full_name}:main") or {}
+    return {
+        'label': label,
+        'commit': sha,
+        'job_id': job_id,
+        'webhook_to_serving_s': round(elapsed, 3),
+        'status': job.get('status'),
+        'phases': {phase['name']: phase['duration'] for phase in job.get('phases', [])},
+        'container': container,
+        'containers': [replica['container_name'] for replica in app_info.get('replicas', [])] or [container],
+    }
+
+
+def run_load(url, concurrency, duration, method='GET', body=None):
+    """concurrency 本の keep-alive 接続で duration 秒リクエストを繰り返す"""
+    latencies = []
+    statuses = {}
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker():
+        session = requests.Session()
+        local_latencies, local_statuses, local_errors = [], {}, 0
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                response = session.request(method, url, data=body, timeout=30)
+                response.content
+                local_latencies.append(time.perf_counter() - started)
+                local_statuses[response.status_code] = local_statuses.get(response.status_code, 0) + 1
+            except requests.RequestException:
+                local_errors += 1
+        session.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    ms = [latency * 1000 for latency in latencies]
+    return {
+        'url': url,
+        'concurrency': concurrency,
+        'duration_s': round(elapsed, 3),
+        'requests': len(latencies),
+        'errors': errors[0],
+        'status': {str(status): count for status, count in sorted(statuses.items())},
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else 0,
+        'p50_ms': round(percentile(ms, 50), 2) if ms else None,
+        'p90_ms': round(percentile(ms, 90), 2) if ms else None,
+        'p99_ms': round(percentile(ms, 99), 2) if ms else None,
+        'max_ms': round(max(ms), 2) if ms else None,
+    }
+
+
+def measure_streams(service, url, count, hold_seconds):
+    """SSEストリームを count 本同時に張り、最初のイベントまでの時間と接続あたりのメモリを測る"""
+    rss_before, threads_before = process_status(service.pid)
+    first_event = []
+    opened = threading.Barrier(count + 1, timeout=60)
+    release = threading.Event()
+    failures = [0]
+    lock = threading.Lock()
+
+    def client():
+        response = None
+        try:
+            started = time.perf_counter()
+            response = requests.get(url, stream=True, timeout=30, headers={'Accept': 'text/event-stream'})
+            for line in response.iter_lines():
+                if line.startswith(b'data:'):
+                    with lock:
+                        first_event.append((time.perf_counter() - started) * 1000)
+                    break
+        except requests.RequestException:
+            with lock:
+                failures[0] += 1
+        try:
+            opened.wait()
+        except threading.BrokenBarrierError:
+            pass
+        release.wait(hold_seconds + 60)
+        if response is not None:
+            response.close()
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    try:
+        opened.wait()
+    except threading.BrokenBarrierError:
+        pass
+    # 接続が落ち着いてから測る
+    time.sleep(hold_seconds)
+    rss_during, threads_during = process_status(service.pid)
+    release.set()
+    for thread in threads:
+        thread.join(10)
+
+    connected = len(first_event)
+    return {
+        'url': url,
+        'connections': count,
+        'connected': connected,
+        'failures': failures[0],
+        'first_event_p50_ms': round(percentile(first_event, 50), 2) if first_event else None,
+        'first_event_p99_ms': round(percentile(first_event, 99), 2) if first_event else None,
+        'rss_before_bytes': rss_before,
+        'rss_during_bytes': rss_during,
+        'rss_per_connection_bytes': int((rss_during - rss_before) / connected) if connected else None,
+        'threads_before': threads_before,
+        'threads_during': threads_during,
+    }
+
+
+def flatten_metrics(result):
+    """比較用に {'proxy.asset.rps': 値, ...} の形へ平らにする"""
+    flat = {}
+
+    def walk(prefix, node):
+        if isinstance(node, dict):
+            for key, value in node.items():
+                walk(f"{prefix}.{key}" if prefix else key, value)
+        elif isinstance(node, (int, float)) and prefix.rsplit('.', 1)[-1] in TRACKED_METRICS:
+            flat[prefix] = node
+
+    walk('', {key: result[key] for key in ('proxy', 'streams', 'deploy') if key in result})
+    return flat
+
+
+def compare(result, baseline, tolerance):
+    """ベースラインより tolerance（割合）以上悪化した指標"""
+    current = flatten_metrics(result)
+    regressions = []
+    for name, before in flatten_metrics(baseline).items():
+        after = current.get(name)
+        if after is None or not before:
+            continue
+        direction = TRACKED_METRICS[name.rsplit('.', 1)[-1]]
+        change = (after - before) / before
+        worse = change < -tolerance if direction == 'higher' else change > tolerance
+        if worse:
+            regressions.append({'metric': name, 'baseline': before, 'current': after, 'change': round(change, 3)})
+    return regressions
+
+
+def git_revision():
+    try:
+        return git('rev-parse', 'HEAD', cwd=BENCH_DIR)
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--server', choices=('flask', 'asgi'), default='flask', help='service mode to benchmark')
+    parser.add_argument('--concurrency', type=int, default=16, help='concurrent keep-alive clients per scenario')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per load scenario')
+    parser.add_argument('--streams', type=int, default=100, help='concurrent SSE streams for the memory test')
+    parser.add_argument('--stream-hold', type=float, default=2, help='seconds to hold the streams before sampling memory')
+    parser.add_argument('--redeploys', type=int, default=2, help='redeploys to time after the first deploy')
+    parser.add_argument('--build-seconds', type=float, default=0.5, help='simulated image build time')
+    parser.add_argument('--keep-limits', action='store_true', help='keep the default admission limits')
+    parser.add_argument('--nodes', type=int, default=1, help='stand-in Docker daemons to schedule across')
+    parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help='extra service environment')
+    parser.add_argument('--output', help='write the JSON result to this file (default: stdout)')
+    parser.add_argument('--compare', help='baseline JSON result; exit 1 if any tracked metric regressed')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression (default 0.2)')
+    parser.add_argument('--keep-workdir', action='store_true', help='keep the temporary directory (service log)')
+    args = parser.parse_args()
+
+    extra_env = dict(item.split('=', 1) for item in args.env)
+    workdir = tempfile.mkdtemp(prefix='gradio-pages-bench-')
+    forge = LocalForge(os.path.join(workdir, 'forge'))
+    service = ServiceUnderTest(workdir, forge, args.server, args.build_seconds, args.keep_limits, extra_env, args.nodes)
+    result = {
+        'schema': SCHEMA_VERSION,
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'git_commit': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'server': args.server,
+        'params': {
+            'concurrency': args.concurrency,
+            'duration_s': args.duration,
+            'streams': args.streams,
+            'build_seconds': args.build_seconds,
+            'keep_limits': args.keep_limits,
+            'nodes': args.nodes,
+            'env': extra_env,
+        },
+    }
+
+    try:
+        service.wait_ready()
+        log(f"🚀 Service ({args.server}) on {service.base_url}, work dir {workdir}")
+
+        # Webhook → 配信開始（初回デプロイ + 再デプロイ）
+        deploys = [measure_deploy(service, forge, 'first deploy')]
+        log(f"📦 first deploy: {deploys[0]['webhook_to_serving_s']}s {deploys[0]['phases']}")
+        for index in range(args.redeploys):
+            deploys.append(measure_deploy(service, forge, f"redeploy {index + 1}", deploys[-1]['containers']))
+            log(f"📦 redeploy {index + 1}: {deploys[-1]['webhook_to_serving_s']}s {deploys[-1]['phases']}")
+        redeploy_times = [d['webhook_to_serving_s'] for d in deploys[1:]]
+        result['deploy'] = {
+            'first': deploys[0],
+            'redeploys': deploys[1:],
+            'webhook_to_serving_p50_s': percentile(redeploy_times, 50) if redeploy_times else deploys[0]['webhook_to_serving_s'],
+        }
+
+        apps = requests.get(f"{service.base_url}/api/apps", timeout=10).json()
+        replica = apps[f"{forge.repo_full_name}:main"]['replicas'][0]
+        direct = f"http://{replica['host']}:{replica['port']}"
+        app_url = f"{service.base_url}/{forge.repo_full_name}"
+
+        # プロキシ経由と直結（比較用）のスループット・レイテンシ
+        scenarios = {
+            'asset': f"{app_url}/assets/index.js",
+            'page': f"{app_url}/",
+            'api': f"{app_url}/config",
+            'slow_50ms': f"{app_url}/slow?ms=50",
+            'direct_api': f"{direct}/config",
+        }
+        result['proxy'] = {}
+        for name, url in scenarios.items():
+            result['proxy'][name] = run_load(url, args.concurrency, args.duration)
+            stats = result['proxy'][name]
+            log(f"⚡ {name}: {stats['rps']} req/s, p50 {stats['p50_ms']}ms, p99 {stats['p99_ms']}ms, errors {stats['errors']}")
+        result['proxy']['post_api'] = run_load(f"{app_url}/run/predict", args.concurrency, args.duration, 'POST', b'{"data": [1]}')
+
+        # SSE（Gradioキュー）の同時接続
+        result['streams'] = measure_streams(
+            service, f"{app_url}/queue/data?events=0&interval_ms=1000", args.streams, args.stream_hold
+        )
+        streams = result['streams']
+        log(f"📡 {streams['connected']}/{streams['connections']} streams, "
+            f"first event p99 {streams['first_event_p99_ms']}ms, {streams['rss_per_connection_bytes']} bytes/connection")
+
+        metrics = requests.get(f"{service.base_url}/metrics", timeout=10).text
+        result['cache_hits'] = sum(
+            float(line.rsplit(' ', 1)[1]) for line in metrics.splitlines()
+            if line.startswith('gradio_proxy_cache_requests_total{result="hit"}')
+        )
+    finally:
+        service.stop()
+        if not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    exit_code = 0
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        result['regressions'] = compare(result, baseline, args.tolerance)
+        for regression in result['regressions']:
+            log(f"❌ {regression['metric']}: {regression['baseline']} → {regression['current']} ({regression['change']:+.0%})")
+        exit_code = 1 if result['regressions'] else 0
+
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+        log(f"📝 Wrote {args.output}")
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
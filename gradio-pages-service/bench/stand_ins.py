@@ -0,0 +1,351 @@
+"""
+ベンチマーク用のスタンドイン
+Gradioアプリの代わりのHTTPバックエンド、Docker API の代わりのクライアント、Forgejo の代わりのローカルbareリポジトリ
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import queue
+import signal
+import socket
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import docker
+
+# 静的アセット（Gradioのバンドル相当の大きさ）
+ASSET_BODY = (b"/* gradio bundle */\n" + b"function f(){return 42}\n" * 8000)
+PAGE_BODY = b"<!DOCTYPE html><html><head><script src=\"./assets/index.js\"></script></head><body>bench</body></html>"
+
+
+class GradioBackendHandler(BaseHTTPRequestHandler):
+    """Gradioアプリの代わり（静的アセット・遅いエンドポイント・SSEのキュー）"""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FakeGradio/1.0'
+
+    def log_message(self, *args):
+        pass
+
+    def send_body(self, status, content_type, body, extra=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Container', self.server.container_name)
+        for key, value in extra:
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if url.path in ('/', ''):
+            self.send_body(200, 'text/html; charset=utf-8', PAGE_BODY)
+        elif url.path.startswith('/assets/'):
+            self.send_body(200, 'application/javascript', ASSET_BODY, [('Cache-Control', 'public, max-age=3600')])
+        elif url.path == '/config':
+            body = json.dumps({'version': 'bench', 'container': self.server.container_name}).encode()
+            self.send_body(200, 'application/json', body)
+        elif url.path == '/slow':
+            time.sleep(int(params.get('ms', ['100'])[0]) / 1000)
+            self.send_body(200, 'application/json', b'{"ok": true}')
+        elif url.path == '/queue/data':
+            self.stream_events(int(params.get('events', ['5'])[0]), int(params.get('interval_ms', ['200'])[0]) / 1000)
+        else:
+            self.send_body(404, 'text/plain', b'not found')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.send_body(200, 'application/json', json.dumps({'received': len(body)}).encode())
+
+    def stream_events(self, events, interval):
+        """Gradioのキューと同じ text/event-stream（events=0 なら切断まで送り続ける）"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('X-Container', self.server.container_name)
+        self.end_headers()
+        sent = 0
+        try:
+            while not events or sent < events:
+                data = f"data: {json.dumps({'msg': 'process_generating', 'n': sent})}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                self.wfile.flush()
+                sent += 1
+                time.sleep(interval)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+def serve_backend(port, container_name):
+    """バックエンドを起動して終了シグナルまで待つ（コンテナ1台＝1プロセス）"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), GradioBackendHandler)
+    server.daemon_threads = True
+    server.container_name = container_name
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    server.serve_forever()
+
+
+class FakeImage:
+    def __init__(self, store, tag, labels=None):
+        self.store = store
+        self.tags = [tag]
+        self.id = f"sha256:{os.urandom(32).hex()}"
+        self.labels = labels or {}
+        self.attrs = {'Created': f"{time.time():.6f}"}
+
+    def tag(self, repository, tag):
+        self.store[f"{repository}:{tag}"] = self
+        self.tags.append(f"{repository}:{tag}")
+
+    def save(self, named=False):
+        # イメージの tar の代わりにタグだけを流す
+        yield json.dumps([named] if isinstance(named, str) else self.tags).encode()
+
+
+class FakeImages:
+    def __init__(self):
+        self.store = {}
+
+    def get(self, tag):
+        if tag not in self.store:
+            raise docker.errors.ImageNotFound(tag)
+        return self.store[tag]
+
+    def list(self, name=None, filters=None):
+        label = (filters or {}).get('label')
+        images = {
+            id(image): image for tag, image in self.store.items()
+            if (not name or tag.startswith(f"{name}:")) and (not label or label in image.labels)
+        }
+        return list(images.values())
+
+    def remove(self, tag, noprune=False):
+        self.store.pop(tag, None)
+
+    def load(self, data):
+        tags = json.loads(b''.join(data))
+        image = FakeImage(self.store, tags[0])
+        for tag in tags:
+            self.store[tag] = image
+        return [image]
+
+
+class FakeAPI:
+    """低レベルAPI（ビルドは build_seconds 掛けてログを流す）"""
+
+    def __init__(self, images, build_seconds):
+        self.images = images
+        self.build_seconds = build_seconds
+
+    def build(self, tag, path=None, fileobj=None, **kwargs):
+        def stream():
+            # デーモンと同じくコンテキストを最後まで受け取ってからビルドする
+            context = b''.join(fileobj) if fileobj is not None else b''
+            received = len(context)
+            # Dockerfile の LABEL だけ拾う（ベースイメージの削除対象の絞り込み用）
+            labels = dict(re.findall(rb'LABEL ([\w.-]+)=(\S+)', context))
+            yield {'stream': f"Sending build context to Docker daemon  {received} bytes\n"}
+            steps = 5
+            for step in range(steps):
+                time.sleep(self.build_seconds / steps)
+                yield {'stream': f"Step {step + 1}/{steps} : bench build\n"}
+            self.images.store[tag] = FakeImage(
+                self.images.store, tag, {key.decode(): value.decode() for key, value in labels.items()}
+            )
+            yield {'stream': f"Successfully tagged {tag}\n"}
+        return stream()
+
+
+class FakeContainer:
+    """バックエンドのサブプロセスをコンテナに見立てる"""
+
+    def __init__(self, client, name, port, labels):
+        self.client = client
+        self.name = name
+        self.port = port
+        self.labels = labels
+        self.attrs = {'State': {}, 'Config': {'Labels': labels}}
+        self.process = None
+        self.status = 'created'
+
+    def start(self):
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), 'backend', str(self.port), self.name],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        self.status = 'running'
+        self.client.emit(self.name, 'start')
+
+    def reload(self):
+        if self.process and self.process.poll() is not None and self.status == 'running':
+            self.status = 'exited'
+
+    def stats(self, stream=False, one_shot=False):
+        rss = 0
+        try:
+            with open(f"/proc/{self.process.pid}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        rss = int(line.split()[1]) * 1024
+        except (OSError, AttributeError):
+            pass
+        return {'cpu_stats': {'cpu_usage': {'total_usage': 0}}, 'memory_stats': {'usage': rss, 'limit': 0}}
+
+    def remove(self, force=False):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.status = 'removed'
+        self.client.containers.by_name.pop(self.name, None)
+        self.client.emit(self.name, 'destroy')
+
+
+class FakeContainers:
+    def __init__(self, client):
+        self.client = client
+        self.by_name = {}
+
+    def get(self, name):
+        if name not in self.by_name:
+            raise docker.errors.NotFound(name)
+        return self.by_name[name]
+
+    def list(self, all=False, filters=None):
+        return [c for c in self.by_name.values() if all or c.status == 'running']
+
+    def run(self, image, name, ports=None, labels=None, **kwargs):
+        if name in self.by_name:
+            raise docker.errors.APIError(f"Conflict: container name {name} is already in use")
+        port = next(iter((ports or {}).values()))
+        container = FakeContainer(self.client, name, port, labels or {})
+        self.by_name[name] = container
+        container.start()
+        return container
+
+
+class FakeDockerClient:
+    """docker.from_env() / docker.DockerClient() の代わり（マネージャーが使う範囲だけ、1インスタンスが1ノード）"""
+
+    def __init__(self, build_seconds=0.5, memory=16 * 1024 ** 3):
+        self.memory = memory
+        self.images = FakeImages()
+        self.api = FakeAPI(self.images, build_seconds)
+        self.containers = FakeContainers(self)
+        self.subscribers = []
+
+    def info(self):
+        return {'MemTotal': self.memory}
+
+    def emit(self, name, action):
+        event = {'Type': 'container', 'Action': action, 'Actor': {'Attributes': {'name': name}}}
+        for subscriber in list(self.subscribers):
+            subscriber.put(event)
+
+    def events(self, decode=True, filters=None):
+        subscriber = queue.Queue()
+        self.subscribers.append(subscriber)
+
+        def stream():
+            while True:
+                yield subscriber.get()
+        return stream()
+
+    def shutdown(self):
+        for container in list(self.containers.by_name.values()):
+            container.remove(force=True)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def ephemeral_port_range():
+    """カーネルが接続元ポートに使う範囲（読めなければ Linux の既定値）"""
+    try:
+        with open('/proc/sys/net/ipv4/ip_local_port_range') as f:
+            low, high = map(int, f.read().split())
+        return low, high
+    except (OSError, ValueError):
+        return 32768, 60999
+
+
+def free_port_block(size, base=20000):
+    """エフェメラル範囲の外で size 個すべて bind できる連続ポートの先頭
+
+    バックエンド用のポートが接続元ポートと衝突しないよう、リモートノード分も含めて事前に確かめる
+    """
+    low, high = ephemeral_port_range()
+    starts = [*range(base, low - size + 1, size), *range(high + 1, 65536 - size, size)]
+    for start in starts:
+        if all(port_bindable(port) for port in range(start, start + size)):
+            return start
+    raise RuntimeError(f"No block of {size} free ports outside the ephemeral range {low}-{high}")
+
+
+def port_bindable(port):
+    with socket.socket() as sock:
+        try:
+            sock.bind(('127.0.0.1', port))
+            return True
+        except OSError:
+            return False
+
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout.strip()
+
+
+class LocalForge:
+    """Forgejo の代わりのbareリポジトリ（FORGEJO_URL=file://<root> で参照させる）"""
+
+    def __init__(self, root, repo_full_name='bench/demo'):
+        self.root = root
+        self.repo_full_name = repo_full_name
+        self.bare = os.path.join(root, f"{repo_full_name}.git")
+        self.work = os.path.join(root, '.work', repo_full_name)
+        os.makedirs(self.bare, exist_ok=True)
+        git('init', '--bare', '--quiet', '--initial-branch=main', cwd=self.bare)
+        git('clone', '--quiet', self.bare, self.work)
+        git('config', 'user.email', 'bench@localhost', cwd=self.work)
+        git('config', 'user.name', 'bench', cwd=self.work)
+        git('checkout', '--quiet', '-b', 'main', cwd=self.work)
+
+    @property
+    def url(self):
+        return f"file://{self.root}"
+
+    def push_commit(self, message):
+        """アプリのファイルを書き換えてpushし、コミットSHAを返す"""
+        files = {
+            'Dockerfile': 'FROM python:3.11-slim\nCOPY . /app\nCMD ["python", "/app/app.py"]\n',
+            'requirements.txt': 'gradio\n',
+            'app.py': f'import gradio as gr\n# {message}\ngr.Interface(lambda x: x, "text", "text").launch()\n',
+        }
+        for name, content in files.items():
+            with open(os.path.join(self.work, name), 'w') as f:
+                f.write(content)
+        git('add', '-A', cwd=self.work)
+        git('commit', '--quiet', '-m', message, cwd=self.work)
+        git('push', '--quiet', 'origin', 'main', cwd=self.work)
+        return git('rev-parse', 'HEAD', cwd=self.work)
+
+
+if __name__ == '__main__' and len(sys.argv) == 4 and sys.argv[1] == 'backend':
+    serve_backend(int(sys.argv[2]), sys.argv[3])
@@ -0,0 +1,171 @@
+"""
+ビルドコンテキストのダイジェスト計算とストリーミング
+.dockerignore を考慮したコンテキストの内容からイメージタグを決め、同じ内容なら再ビルドしない
+デーモンへはフィルタ済みの tar をチャンク毎に生成して送り、チェックアウト全体をメモリに載せない
+"""
+
+import io
+import os
+import stat
+import tarfile
+import hashlib
+import logging
+
+from docker.utils.build import exclude_paths
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# .dockerignore に関係なく除外するパターン（カンマ区切り、! で始まる行で .dockerignore から戻せる）
+DEFAULT_EXCLUDES = [p.strip() for p in os.getenv('BUILD_CONTEXT_EXCLUDE', '.git').split(',') if p.strip()]
+# コンテキストの大きさの警告・拒否の閾値（MB、0 で無効）
+BUILD_CONTEXT_WARN_MB = float(os.getenv('BUILD_CONTEXT_WARN_MB', 200))
+BUILD_CONTEXT_MAX_MB = float(os.getenv('BUILD_CONTEXT_MAX_MB', 2048))
+
+
+class BuildContextTooLarge(Exception):
+    """ビルドコンテキストが BUILD_CONTEXT_MAX_MB を超えた"""
+
+
+def read_dockerignore(context_dir):
+    """.dockerignore のパターンを読む（docker-py と同じ解釈）"""
+    dockerignore = os.path.join(context_dir, '.dockerignore')
+    if not os.path.exists(dockerignore):
+        return []
+    with open(dockerignore) as f:
+        return [
+            line.strip() for line in f.read().splitlines()
+            if line.strip() and not line.strip().startswith('#')
+        ]
+
+
+def context_files(context_dir, patterns=None):
+    """デーモンへ送られるパスの一覧（ソート済み・相対パス）"""
+    if patterns is None:
+        patterns = DEFAULT_EXCLUDES + read_dockerignore(context_dir)
+    return sorted(exclude_paths(context_dir, list(patterns)))
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
+
+
+class BuildContext:
+    """フィルタ済みのビルドコンテキスト（送るファイルの一覧・合計サイズ・tar ストリーム）"""
+
+    def __init__(self, context_dir, patterns=None):
+        self.context_dir = context_dir
+        self.entries = []
+        self.size = 0
+        # ディスクの内容の代わりに送るファイル（ベースイメージへ差し替えた Dockerfile など）
+        self.overrides = {}
+        for rel_path in context_files(context_dir, patterns):
+            st = os.lstat(os.path.join(context_dir, rel_path))
+            self.entries.append((rel_path, st))
+            if stat.S_ISREG(st.st_mode):
+                self.size += st.st_size
+
+    def override(self, rel_path, data):
+        """ファイルの内容を差し替える（サイズとダイジェストにも反映）"""
+        self.overrides[rel_path] = data
+        self.size = sum(self.file_size(rel, st) for rel, st in self.entries if stat.S_ISREG(st.st_mode))
+
+    def open(self, rel_path):
+        if rel_path in self.overrides:
+            return io.BytesIO(self.overrides[rel_path])
+        return open(os.path.join(self.context_dir, rel_path), 'rb')
+
+    def file_size(self, rel_path, st):
+        return len(self.overrides[rel_path]) if rel_path in self.overrides else st.st_size
+
+    def check_size(self, job=None):
+        """サイズを報告し、閾値を超えていれば警告・拒否する"""
+        message = f"Build context: {len(self.entries)} files, {format_size(self.size)}"
+        logger.info(f"📦 {message}")
+        if job:
+            job.log_line(message)
+        if BUILD_CONTEXT_MAX_MB and self.size > BUILD_CONTEXT_MAX_MB * 1024 * 1024:
+            raise BuildContextTooLarge(
+                f"Build context is {format_size(self.size)}, over the {BUILD_CONTEXT_MAX_MB:g}MB limit "
+                f"(add large files to .dockerignore)"
+            )
+        if BUILD_CONTEXT_WARN_MB and self.size > BUILD_CONTEXT_WARN_MB * 1024 * 1024:
+            largest = sorted(
+                (st.st_size, rel_path) for rel_path, st in self.entries if stat.S_ISREG(st.st_mode)
+            )[-3:]
+            warning = f"Build context is large ({format_size(self.size)}); largest files: " + ', '.join(
+                f"{rel_path} ({format_size(size)})" for size, rel_path in reversed(largest)
+            )
+            logger.warning(f"⚠️  {warning}")
+            if job:
+                job.log_line(warning)
+
+    def tarinfo(self, rel_path, st):
+        """tar のヘッダー（所有者は docker build と同じく root に揃える）"""
+        info = tarfile.TarInfo(rel_path)
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.mtime = int(st.st_mtime)
+        if stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            info.linkname = os.readlink(os.path.join(self.context_dir, rel_path))
+        elif stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        else:
+            info.type = tarfile.REGTYPE
+            info.size = self.file_size(rel_path, st)
+        return info
+
+    def stream(self, chunk_size=HASH_CHUNK_SIZE):
+        """tar をチャンク毎に生成する（ファイルは chunk_size ずつ読むのでメモリは一定）"""
+        for rel_path, st in self.entries:
+            if not (stat.S_ISREG(st.st_mode) or stat.S_ISDIR(st.st_mode) or stat.S_ISLNK(st.st_mode)):
+                continue
+            info = self.tarinfo(rel_path, st)
+            yield info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape')
+            if info.type != tarfile.REGTYPE:
+                continue
+            remaining = info.size
+            with self.open(rel_path) as f:
+                while remaining > 0:
+                    chunk = f.read(min(chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            if remaining:
+                # 走査後にファイルが縮んだ場合もヘッダーのサイズに合わせる
+                yield b'\0' * remaining
+            if info.size % tarfile.BLOCKSIZE:
+                yield b'\0' * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+        yield b'\0' * (tarfile.BLOCKSIZE * 2)
+
+    def digest(self, base_id=None):
+        """コンテキストの内容ダイジェスト（パス・実行ビット・内容・リンク先、あればベースイメージの ID）"""
+        digest = hashlib.sha256()
+        if base_id:
+            digest.update(b'B' + base_id.encode() + b'\0')
+        for rel_path, st in self.entries:
+            full_path = os.path.join(self.context_dir, rel_path)
+            digest.update(rel_path.encode('utf-8', 'surrogateescape') + b'\0')
+
+            if stat.S_ISLNK(st.st_mode):
+                digest.update(b'L' + os.readlink(full_path).encode('utf-8', 'surrogateescape'))
+            elif stat.S_ISDIR(st.st_mode):
+                digest.update(b'D')
+            else:
+                digest.update((b'X' if st.st_mode & stat.S_IXUSR else b'F') + str(self.file_size(rel_path, st)).encode() + b'\0')
+                with self.open(rel_path) as f:
+                    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                        digest.update(chunk)
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+
+def context_digest(context_dir, patterns=None):
+    """ビルドコンテキストの内容ダイジェスト"""
+    return BuildContext(context_dir, patterns).digest()
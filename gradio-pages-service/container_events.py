@@ -0,0 +1,71 @@
+"""
+コンテナイベントの購読
+Docker の events ストリームからGradioコンテナの状態変化を受け取り、マネージャーへ通知する
+"""
+
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# マネージャーが起動したコンテナに付けるラベル
+MANAGED_LABEL = 'gradio-pages.managed'
+
+# 状態に関係するアクション（health_status は "health_status: healthy" の形で届く）
+TRACKED_ACTIONS = ('start', 'die', 'oom', 'destroy', 'health_status')
+
+
+class ContainerEventWatcher:
+    """events ストリームを購読し、切断時は再接続する"""
+
+    def __init__(self, docker_client, on_event, reconnect_delay=5, name=None):
+        self.docker_client = docker_client
+        # 購読するノード名（複数の Docker ホストを使う場合のログ・スレッド名用）
+        self.name = name
+        self.on_event = on_event
+        self.reconnect_delay = reconnect_delay
+        self.connected = False
+        self.last_event_at = None
+        self.thread = None
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        suffix = f"-{self.name}" if self.name else ''
+        self.thread = threading.Thread(target=self.run, name=f'container-events{suffix}', daemon=True)
+        self.thread.start()
+        logger.info(f"👂 Watching Docker container events{f' on {self.name}' if self.name else ''}")
+
+    def snapshot(self):
+        """購読開始時点の状態を一覧APIで1回だけ取得"""
+        containers = self.docker_client.containers.list(all=True, filters={'label': MANAGED_LABEL})
+        for container in containers:
+            health = container.attrs.get('State', {}).get('Health', {}).get('Status')
+            action = 'start' if container.status == 'running' else 'die'
+            self.on_event(container.name, action)
+            if health:
+                self.on_event(container.name, f"health_status: {health}")
+
+    def run(self):
+        while True:
+            try:
+                # 購読を先に張ってからスナップショットを取り、取りこぼしを防ぐ
+                events = self.docker_client.events(
+                    decode=True,
+                    filters={'type': 'container', 'label': MANAGED_LABEL}
+                )
+                self.connected = True
+                self.snapshot()
+                for event in events:
+                    action = event.get('Action') or event.get('status') or ''
+                    if not action.startswith(TRACKED_ACTIONS):
+                        continue
+                    name = event.get('Actor', {}).get('Attributes', {}).get('name')
+                    if name:
+                        self.last_event_at = time.time()
+                        self.on_event(name, action)
+            except Exception as e:
+                logger.warning(f"Docker events stream error{f' on {self.name}' if self.name else ''}: {e}")
+            self.connected = False
+            time.sleep(self.reconnect_delay)
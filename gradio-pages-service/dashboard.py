@@ -0,0 +1,337 @@
+"""
+ステータスダッシュボードとアプリ一覧API
+アプリの概要をメモリ上で差分管理し（Docker への問い合わせなし）、バージョン付きの変更履歴から
+JSON / SSE の差分フィードと ETag 付きのページングされた /api/apps を返す。HTML もバージョン毎にキャッシュする
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+import logging
+from collections import deque
+from html import escape
+from urllib.parse import urlencode
+
+logger = logging.getLogger(__name__)
+
+# 差分を保持する件数（これより古い version からの要求には全件を返す）
+FEED_HISTORY = int(os.getenv('DASHBOARD_HISTORY', 1000))
+# ダッシュボード・SSE がアプリ状態を見直す最短間隔（秒）
+DASHBOARD_REFRESH_SECONDS = float(os.getenv('DASHBOARD_REFRESH_SECONDS', 1))
+# /api/apps の既定・最大の件数
+APPS_PAGE_SIZE = int(os.getenv('APPS_PAGE_SIZE', 100))
+APPS_PAGE_MAX = int(os.getenv('APPS_PAGE_MAX', 1000))
+
+
+def sse_event(delta):
+    """差分1件分の SSE イベント"""
+    return f"id: {delta['version']}\nevent: delta\ndata: {json.dumps(delta)}\n\n"
+
+
+class AppFeed:
+    """アプリ概要のスナップショットと version 毎の変更履歴"""
+
+    def __init__(self, summaries_func, card_func):
+        # summaries_func() -> {repo_id: 概要} / card_func(概要) -> カードのHTML
+        self.summaries_func = summaries_func
+        self.card_func = card_func
+        # プロセス毎に変わる ID（再起動・別ワーカーの version と混同しない）
+        self.feed_id = uuid.uuid4().hex[:8]
+        self.version = 0
+        self.apps = {}
+        self.cards = {}
+        self.changes = deque(maxlen=FEED_HISTORY)
+        self.refreshed_at = 0
+        self.page_cache = None
+        self.cond = threading.Condition()
+
+    def refresh(self, max_age=0):
+        """アプリ状態を読み直し、変わったアプリだけ version を進めて記録する"""
+        with self.cond:
+            if max_age and time.monotonic() - self.refreshed_at < max_age:
+                return self.version
+            self.refreshed_at = time.monotonic()
+            try:
+                current = self.summaries_func()
+            except Exception as e:
+                logger.error(f"Dashboard refresh failed: {e}")
+                return self.version
+
+            changed = False
+            for repo_id, summary in current.items():
+                if self.apps.get(repo_id) != summary:
+                    self.version += 1
+                    self.apps[repo_id] = summary
+                    self.cards[repo_id] = self.card_func(summary)
+                    self.changes.append((self.version, repo_id))
+                    changed = True
+            for repo_id in [r for r in self.apps if r not in current]:
+                self.version += 1
+                del self.apps[repo_id]
+                del self.cards[repo_id]
+                self.changes.append((self.version, repo_id))
+                changed = True
+            if changed:
+                self.cond.notify_all()
+            return self.version
+
+    def summary(self):
+        """ヘッダーの集計（ロック取得済み）"""
+        statuses = [app['status'] for app in self.apps.values()]
+        return {
+            'total_apps': len(statuses),
+            'healthy_apps': statuses.count('running'),
+            'idle_apps': statuses.count('idle') + statuses.count('starting'),
+        }
+
+    def delta(self, since=None, feed_id=None):
+        """since 以降の変更（古すぎる・未指定・別プロセスの version なら全件で reset=True）"""
+        self.refresh(DASHBOARD_REFRESH_SECONDS)
+        with self.cond:
+            oldest = self.changes[0][0] if self.changes else self.version + 1
+            reset = (
+                since is None or (feed_id and feed_id != self.feed_id) or since > self.version
+                or (since < self.version and since + 1 < oldest)
+            )
+            if reset:
+                changed_ids = list(self.apps)
+            else:
+                changed_ids = list(dict.fromkeys(repo_id for version, repo_id in self.changes if version > since))
+            return {
+                'feed': self.feed_id,
+                'version': self.version,
+                'reset': reset,
+                'summary': self.summary(),
+                'apps': [
+                    {'id': repo_id, **self.apps[repo_id], 'html': self.cards[repo_id]}
+                    for repo_id in sorted(changed_ids) if repo_id in self.apps
+                ],
+                'removed': [] if reset else [repo_id for repo_id in changed_ids if repo_id not in self.apps],
+            }
+
+    def wait(self, since, timeout):
+        """version が since を超えるまで最大 timeout 秒待つ（待つ間も定期的に状態を見直す）"""
+        deadline = time.monotonic() + timeout
+        while True:
+            version = self.refresh(DASHBOARD_REFRESH_SECONDS)
+            remaining = deadline - time.monotonic()
+            if version != since or remaining <= 0:
+                return version
+            with self.cond:
+                if self.version == since:
+                    self.cond.wait(min(remaining, DASHBOARD_REFRESH_SECONDS))
+
+    def events(self, since=None, feed_id=None, keepalive=15):
+        """SSE の差分フィード（最初に since からの差分、以後は変更毎に1イベント）"""
+        delta = self.delta(since, feed_id)
+        yield sse_event(delta)
+        version = delta['version']
+        while True:
+            current = self.wait(version, keepalive)
+            if current == version:
+                yield ": keepalive\n\n"
+                continue
+            delta = self.delta(version)
+            version = delta['version']
+            yield sse_event(delta)
+
+    def page(self, render_func):
+        """ダッシュボードのHTML（version が変わった時だけ描き直す）"""
+        self.refresh(DASHBOARD_REFRESH_SECONDS)
+        with self.cond:
+            if self.page_cache and self.page_cache[0] == self.version:
+                return self.page_cache[1]
+            cards = [(repo_id, self.cards[repo_id]) for repo_id in sorted(self.apps)]
+            html = render_func(self.feed_id, self.version, self.summary(), cards)
+            self.page_cache = (self.version, html)
+            return html
+
+    def query(self, params, if_none_match=None):
+        """ページング・絞り込み付きのアプリ一覧（status, 本文, ヘッダー）を返す"""
+        try:
+            limit = min(max(int(params.get('limit', APPS_PAGE_SIZE)), 1), APPS_PAGE_MAX)
+            offset = max(int(params.get('offset', 0)), 0)
+        except ValueError:
+            return 400, {'error': 'limit and offset must be integers'}, {}
+        owner = (params.get('owner') or '').lower()
+        status = params.get('status') or ''
+        branch = params.get('branch') or ''
+
+        version = self.refresh()
+        key = urlencode(sorted((k, str(v)) for k, v in (
+            ('limit', limit), ('offset', offset), ('owner', owner), ('status', status), ('branch', branch)
+        )))
+        etag = f'"apps-{self.feed_id}-{version}-{hashlib.sha1(key.encode()).hexdigest()[:12]}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if if_none_match and etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return 304, None, headers
+
+        with self.cond:
+            matched = [
+                (repo_id, app) for repo_id, app in sorted(self.apps.items())
+                if (not owner or (app.get('repo_full_name') or '').split('/')[0].lower() == owner)
+                and (not status or app.get('status') == status)
+                and (not branch or app.get('branch') == branch)
+            ]
+        page = dict(matched[offset:offset + limit])
+        headers['X-Total-Count'] = str(len(matched))
+        if offset + limit < len(matched):
+            next_params = {k: v for k, v in (('owner', owner), ('status', status), ('branch', branch)) if v}
+            headers['Link'] = f'</api/apps?{urlencode({**next_params, "limit": limit, "offset": offset + limit})}>; rel="next"'
+        return 200, page, headers
+
+
+def parse_since(value):
+    """since / Last-Event-ID の version（不正なら None）"""
+    try:
+        return int(value) if value not in (None, '') else None
+    except ValueError:
+        return None
+
+
+def render_app_card(app, backend_host):
+    """アプリ1件分のカード"""
+    replicas = app.get('replicas') or []
+    running = sum(1 for r in replicas if r.get('status') == 'running')
+    nodes = ', '.join(sorted({r['node'] for r in replicas if r.get('node')})) or '-'
+    url = escape(app.get('url') or '')
+    direct = f"{app.get('host') or backend_host}:{app.get('port')}"
+    return f'''<div class="app status-{escape(str(app.get('status')))}">
+                <h3>{escape(str(app.get('repo_full_name')))}</h3>
+                <p><strong>Status:</strong> {escape(str(app.get('status')))}</p>
+                <p><strong>Port:</strong> {escape(str(app.get('port')))}</p>
+                <p><strong>Replicas:</strong> {running} / {len(replicas)} running</p>
+                <p><strong>Node:</strong> {escape(nodes)}</p>
+                <p><strong>URL:</strong> <a href="{url}" target="_blank" class="url">{url}</a></p>
+                <p><strong>Direct:</strong> <a href="http://{escape(direct)}" target="_blank" class="url">{escape(direct)}</a></p>
+                <p><strong>Branch:</strong> {escape(str(app.get('branch')))}</p>
+                <p><strong>Created:</strong> {escape(str(app.get('created')))}</p>
+            </div>'''
+
+
+def render_dashboard(manager, feed_id, version, summary, cards):
+    """ダッシュボードのHTML（以後の更新は /api/dashboard/events の差分で反映）"""
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>🚀 Forgejo Gradio Pages (Debug)</title>
+        <style>
+            body {{ font-family: Arial, sans-serif; margin: 40px; }}
+            .app {{ border: 1px solid #ddd; margin: 10px 0; padding: 15px; border-radius: 5px; }}
+            .status-running {{ background-color: #d4edda; }}
+            .status-stopped {{ background-color: #f8d7da; }}
+            .status-error, .status-unhealthy {{ background-color: #fff3cd; }}
+            .status-idle, .status-starting {{ background-color: #e2e3e5; }}
+            .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 20px; border-radius: 10px; margin-bottom: 20px; }}
+            .url {{ font-family: monospace; background: #f8f9fa; padding: 5px; border-radius: 3px; }}
+            .debug {{ background: #fff3cd; padding: 15px; border-radius: 8px; margin: 20px 0; }}
+        </style>
+    </head>
+    <body>
+        <div class="header">
+            <h1>🚀 Forgejo Gradio Pages (Debug)</h1>
+            <p>GitHub Pagesライクな Gradio アプリ デプロイサービス</p>
+            <p><strong>Active Apps:</strong> <span id="healthy-apps">{summary['healthy_apps']}</span> / <span id="total-apps">{summary['total_apps']}</span></p>
+            <p><strong>Port Range:</strong> {manager.port_start}-{manager.port_end}</p>
+        </div>
+
+        <div class="debug">
+            <h3>🔧 Debug Info</h3>
+            <p><strong>Docker:</strong> {'✅ Connected' if manager.docker_client else '❌ Not connected'}</p>
+            <p><strong>Docker Hosts:</strong> {escape(', '.join(manager.hosts.hosts))} (placement: {escape(manager.hosts.policy)}, build: {escape(manager.hosts.build_host.name)})</p>
+            <p><strong>Forgejo URL:</strong> {escape(manager.forgejo_url)}</p>
+            <p><strong>Token:</strong> {'✅ Set' if manager.forgejo_token else '❌ Not set'}</p>
+            <p><strong>Port Range:</strong> {manager.port_start}-{manager.port_end}</p>
+            <p><strong>Live updates:</strong> <span id="feed-state">connecting…</span></p>
+        </div>
+
+        <h2>📱 Deployed Gradio Apps</h2>
+        <div id="apps">
+            {''.join(f'<div data-app-id="{escape(repo_id)}">{card}</div>' for repo_id, card in cards)}
+        </div>
+        <p id="no-apps" {'hidden' if cards else ''}>No apps deployed yet.</p>
+
+        <h2>🧪 Test Deploy</h2>
+        <button onclick="testDeploy()">Test Deploy Sunwood-ai-labs/gradio-pages</button>
+        <div id="testResult"></div>
+
+        <script>
+        let feedVersion = {version};
+        let feedId = {json.dumps(feed_id)};
+
+        function applyDelta(delta) {{
+            const container = document.getElementById('apps');
+            if (delta.feed !== feedId || delta.reset) {{
+                container.innerHTML = '';
+            }}
+            for (const id of delta.removed) {{
+                const node = container.querySelector(`[data-app-id="${{CSS.escape(id)}}"]`);
+                if (node) node.remove();
+            }}
+            for (const app of delta.apps) {{
+                let node = container.querySelector(`[data-app-id="${{CSS.escape(app.id)}}"]`);
+                if (!node) {{
+                    node = document.createElement('div');
+                    node.dataset.appId = app.id;
+                    const next = [...container.children].find(child => child.dataset.appId > app.id);
+                    container.insertBefore(node, next || null);
+                }}
+                node.innerHTML = app.html;
+            }}
+            document.getElementById('healthy-apps').textContent = delta.summary.healthy_apps;
+            document.getElementById('total-apps').textContent = delta.summary.total_apps;
+            document.getElementById('no-apps').hidden = container.children.length > 0;
+            feedId = delta.feed;
+            feedVersion = delta.version;
+        }}
+
+        function pollFeed() {{
+            // SSE が使えない環境では JSON の差分をポーリング
+            fetch(`/api/dashboard?since=${{feedVersion}}&feed=${{feedId}}`)
+                .then(response => response.json())
+                .then(delta => {{ applyDelta(delta); document.getElementById('feed-state').textContent = 'polling'; }})
+                .catch(() => {{ document.getElementById('feed-state').textContent = 'disconnected'; }})
+                .finally(() => setTimeout(pollFeed, 5000));
+        }}
+
+        if (window.EventSource) {{
+            // 再接続時はブラウザが Last-Event-ID で最後の version を送る
+            const source = new EventSource(`/api/dashboard/events?since=${{feedVersion}}&feed=${{feedId}}`);
+            source.addEventListener('delta', event => applyDelta(JSON.parse(event.data)));
+            source.onopen = () => {{ document.getElementById('feed-state').textContent = 'live'; }};
+            source.onerror = () => {{ document.getElementById('feed-state').textContent = 'reconnecting…'; }};
+        }} else {{
+            pollFeed();
+        }}
+
+        function testDeploy() {{
+            fetch('/api/apps/Sunwood-ai-labs/gradio-pages', {{
+                method: 'POST',
+                headers: {{'Content-Type': 'application/json'}},
+                body: JSON.stringify({{'branch': 'main'}})
+            }})
+            .then(response => response.json())
+            .then(data => {{
+                document.getElementById('testResult').innerHTML =
+                    '<p><strong>Result:</strong> ' + JSON.stringify(data) + '</p>';
+            }})
+            .catch(error => {{
+                document.getElementById('testResult').innerHTML =
+                    '<p><strong>Error:</strong> ' + error + '</p>';
+            }});
+        }}
+        </script>
+
+        <h2>📝 API Test</h2>
+        <ul>
+            <li><a href="/api/apps">GET /api/apps</a></li>
+            <li><a href="/api/dashboard">GET /api/dashboard</a></li>
+            <li><a href="/health">GET /health</a></li>
+        </ul>
+    </body>
+    </html>
+    """
@@ -0,0 +1,117 @@
+"""
+デプロイのオーナー（マルチワーカー時）
+ファイルロックを取った1ワーカーだけがデプロイ・コンテナの起動停止を行い、他のワーカーは Unix ソケット経由でオーナーへ転送する
+オーナーのワーカーが落ちるとロックが外れ、待機中の別のワーカーが引き継ぐ
+"""
+
+import os
+import time
+import fcntl
+import threading
+import logging
+from multiprocessing.connection import Client, Listener
+
+logger = logging.getLogger(__name__)
+
+# オーナーでないワーカーがロックを取り直す間隔（秒）
+ELECTION_INTERVAL = float(os.getenv('OWNER_ELECTION_INTERVAL', 1))
+# 引き継ぎ中などでオーナーに繋がらない時に待つ最大秒数
+OWNER_CALL_TIMEOUT = float(os.getenv('OWNER_CALL_TIMEOUT', 10))
+
+
+class OwnerUnavailable(Exception):
+    """オーナーのワーカーに接続できない"""
+
+
+class DeployOwner:
+    """flock によるオーナー選出と、オーナーへの呼び出しの転送"""
+
+    def __init__(self, lock_path, socket_path, authkey, dispatch, on_elected):
+        self.lock_path = lock_path
+        self.socket_path = socket_path
+        # fork 前に作った鍵をワーカー間で共有する（preload_app 前提）
+        self.authkey = authkey
+        # dispatch(名前, args, kwargs) -> 結果 / on_elected() はオーナーになった時に1度だけ
+        self.dispatch = dispatch
+        self.on_elected = on_elected
+        self.is_owner = False
+        self.lock_file = None
+        self.started_pid = None
+
+    def start(self):
+        """ロックの取得を試み続けるスレッドを起動（fork後のワーカー毎に呼ぶ）"""
+        if self.started_pid == os.getpid():
+            return
+        self.started_pid = os.getpid()
+        self.is_owner = False
+        threading.Thread(target=self.election_loop, name='deploy-owner', daemon=True).start()
+
+    def election_loop(self):
+        """ロックを取れたらオーナーとしてソケットで待ち受ける（ロックはプロセス終了まで保持）"""
+        # fork 前に開いたファイルだとロックがワーカー間で共有されるため、ここで開く
+        lock_file = open(self.lock_path, 'a')
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(ELECTION_INTERVAL)
+        self.lock_file = lock_file
+
+        # ロックを持っているので残っているソケットは前のオーナーのもの
+        try:
+            os.unlink(self.socket_path)
+        except FileNotFoundError:
+            pass
+        listener = Listener(self.socket_path, family='AF_UNIX', authkey=self.authkey)
+        self.is_owner = True
+        logger.info(f"👑 Worker {os.getpid()} is the deploy owner")
+        try:
+            self.on_elected()
+        except Exception as e:
+            logger.error(f"Deploy owner startup error: {e}")
+
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logger.warning(f"⚠️  Rejected owner connection: {e}")
+                continue
+            threading.Thread(target=self.serve, args=(conn,), daemon=True).start()
+
+    def serve(self, conn):
+        """転送されてきた呼び出しを実行して結果を返す"""
+        with conn:
+            while True:
+                try:
+                    name, args, kwargs = conn.recv()
+                except EOFError:
+                    return
+                try:
+                    reply = ('ok', self.dispatch(name, args, kwargs))
+                except Exception as e:
+                    logger.error(f"Owner call {name} failed: {e}")
+                    reply = ('error', str(e))
+                conn.send(reply)
+
+    def call(self, name, *args, **kwargs):
+        """オーナーのワーカーで実行して結果を返す（繋がらなければ OWNER_CALL_TIMEOUT まで待ち直す）"""
+        deadline = time.monotonic() + OWNER_CALL_TIMEOUT
+        while True:
+            try:
+                conn = Client(self.socket_path, family='AF_UNIX', authkey=self.authkey)
+                break
+            except (OSError, EOFError) as e:
+                if time.monotonic() >= deadline:
+                    raise OwnerUnavailable(f"Deploy owner is not reachable: {e}")
+                time.sleep(0.2)
+        # 送信後は実行済みかもしれないので再送しない（デプロイの投入などが二重にならないように）
+        with conn:
+            try:
+                conn.send((name, args, kwargs))
+                status, value = conn.recv()
+            except (OSError, EOFError) as e:
+                raise OwnerUnavailable(f"Deploy owner went away during {name}: {e}")
+        if status == 'error':
+            raise RuntimeError(value)
+        return value
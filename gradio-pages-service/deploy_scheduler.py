@@ -0,0 +1,289 @@
+"""
+デプロイスケジューラー
+有界ワーカープールで repo:branch 単位にデプロイを直列化し、連続pushは最新コミットに合流させる
+"""
+
+import os
+import time
+import uuid
+import threading
+import logging
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime
+
+from metrics import DEPLOY_PHASE_SECONDS, DEPLOY_QUEUE_DEPTH, DEPLOYS, DEPLOYS_RUNNING
+
+# ジョブ毎に保持するログの行数（ビルドログ込み）
+DEPLOY_LOG_LINES = int(os.getenv('DEPLOY_LOG_LINES', 2000))
+
+logger = logging.getLogger(__name__)
+
+
+class DeployCancelled(Exception):
+    """新しいpushによって古くなったデプロイの中断"""
+
+
+class DeployJob:
+    """1回分のデプロイ要求（フェーズ毎の時刻とビルドログを記録）"""
+
+    def __init__(self, repo_full_name, branch, commit=None, source='api', replicas=None):
+        # 再起動やワーカーをまたいでも重複しないID
+        self.id = uuid.uuid4().hex[:12]
+        self.repo_full_name = repo_full_name
+        self.branch = branch
+        self.commit = commit
+        self.source = source
+        # None の場合は現在のレプリカ数を維持
+        self.replicas = replicas
+        self.status = 'queued'
+        self.message = ''
+        self.submitted_at = datetime.now().isoformat()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.phases = []
+        self.log = deque(maxlen=DEPLOY_LOG_LINES)
+        self.log_total = 0
+        self.log_cond = threading.Condition()
+
+    @property
+    def key(self):
+        return f"{self.repo_full_name}:{self.branch}"
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        """中断要求があれば DeployCancelled を送出"""
+        if self.cancelled:
+            raise DeployCancelled(f"Deployment of {self.key} superseded by a newer push")
+
+    @contextmanager
+    def phase(self, name):
+        """デプロイの1フェーズの開始・終了時刻と所要時間を記録"""
+        entry = {'name': name, 'started_at': datetime.now().isoformat(), 'finished_at': None, 'duration': None}
+        self.phases.append(entry)
+        self.log_line(f"▶ {name}")
+        started = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            duration = time.perf_counter() - started
+            entry['finished_at'] = datetime.now().isoformat()
+            entry['duration'] = round(duration, 3)
+            DEPLOY_PHASE_SECONDS.labels(self.key, name).observe(duration)
+
+    def log_line(self, line):
+        """ログを1行追加し、追従中のクライアントを起こす"""
+        with self.log_cond:
+            self.log.append(line)
+            self.log_total += 1
+            self.log_cond.notify_all()
+
+    def finish(self, status, message):
+        """結果を確定してログの追従を終わらせる"""
+        with self.log_cond:
+            self.status = status
+            self.message = message
+            self.finished_at = datetime.now().isoformat()
+            self.log.append(f"■ {status}: {message}")
+            self.log_total += 1
+            self.log_cond.notify_all()
+
+    def read_log(self, index):
+        """index 行目以降のログを待たずに返す（行, 次の index, 終了済みか）"""
+        with self.log_cond:
+            # 保持数を超えて捨てられた行は飛ばす
+            first = self.log_total - len(self.log)
+            lines = list(self.log)[max(index, first) - first:]
+            return lines, self.log_total, self.finished_at is not None
+
+    def follow_log(self, keepalive=15):
+        """ジョブ終了までログを追従する（keepalive 秒毎に空文字を返す）"""
+        index = 0
+        while True:
+            with self.log_cond:
+                if index >= self.log_total and self.finished_at is None:
+                    self.log_cond.wait(keepalive)
+                lines, index, done = self.read_log(index)
+            if not lines and not done:
+                yield ''
+            for line in lines:
+                yield line
+            if done:
+                return
+
+    def to_dict(self, include_log=False):
+        data = {
+            'id': self.id,
+            'repo_full_name': self.repo_full_name,
+            'branch': self.branch,
+            'commit': self.commit,
+            'source': self.source,
+            'replicas': self.replicas,
+            'status': self.status,
+            'message': self.message,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'phases': list(self.phases),
+        }
+        if include_log:
+            data['log'] = list(self.log)
+        return data
+
+
+class DeployScheduler:
+    """repo:branch 単位で合流・直列化する有界デプロイワーカープール"""
+
+    def __init__(self, deploy_func, on_finish=None):
+        self.deploy_func = deploy_func
+        # 終了したジョブの記録先（状態ストアへの保存など）
+        self.on_finish = on_finish
+        default_workers = max(1, (os.cpu_count() or 2) // 2)
+        self.max_workers = int(os.getenv('DEPLOY_MAX_WORKERS', default_workers))
+        self.pending = OrderedDict()
+        self.running = {}
+        self.history = deque(maxlen=int(os.getenv('DEPLOY_HISTORY_SIZE', 100)))
+        self.cond = threading.Condition()
+        self.workers = []
+
+        logger.info(f"🏗️  Deploy scheduler: {self.max_workers} worker(s)")
+
+    def ensure_workers(self):
+        """ワーカースレッドを起動（fork後のプロセスでも動くよう初回投入時に起動）"""
+        self.workers = [w for w in self.workers if w.is_alive()]
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self.worker_loop, name=f"deploy-worker-{len(self.workers) + 1}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, repo_full_name, branch, commit=None, source='api', replicas=None):
+        """デプロイを投入（同じ repo:branch の待機中ジョブは最新に置き換え）"""
+        job = DeployJob(repo_full_name, branch, commit, source, replicas)
+        with self.cond:
+            self.ensure_workers()
+
+            superseded = self.pending.get(job.key)
+            if superseded:
+                # 合流してもレプリカ数の指定は引き継ぐ
+                job.replicas = job.replicas or superseded.replicas
+                superseded.finish('superseded', f"Replaced by deploy #{job.id}")
+                self.history.append(superseded)
+                DEPLOYS.labels(superseded.status).inc()
+                logger.info(f"🔀 Coalesced pending deploy #{superseded.id} into #{job.id} ({job.key})")
+
+            in_flight = self.running.get(job.key)
+            if in_flight and not in_flight.cancelled:
+                in_flight.cancel_event.set()
+                logger.info(f"✋ Cancelling stale deploy #{in_flight.id} ({job.key})")
+
+            # 置き換え時もキュー内の位置は維持する
+            self.pending[job.key] = job
+            DEPLOY_QUEUE_DEPTH.set(len(self.pending))
+            self.cond.notify()
+
+        if superseded:
+            self.record(superseded)
+        return job, superseded is not None
+
+    def cancel(self, key, reason):
+        """repo:branch の待機中ジョブを取り消し、実行中ジョブに中断を要求"""
+        with self.cond:
+            cancelled = self.pending.pop(key, None)
+            if cancelled:
+                cancelled.finish('cancelled', reason)
+                self.history.append(cancelled)
+                DEPLOYS.labels(cancelled.status).inc()
+                DEPLOY_QUEUE_DEPTH.set(len(self.pending))
+
+            in_flight = self.running.get(key)
+            if in_flight and not in_flight.cancelled:
+                in_flight.cancel_event.set()
+                logger.info(f"✋ Cancelling deploy #{in_flight.id} ({key}): {reason}")
+
+        if cancelled:
+            self.record(cancelled)
+        return cancelled is not None or in_flight is not None
+
+    def record(self, job):
+        """終了したジョブを on_finish へ渡す"""
+        if not self.on_finish:
+            return
+        try:
+            self.on_finish(job)
+        except Exception as e:
+            logger.error(f"Failed to record deploy #{job.id}: {e}")
+
+    def next_job(self):
+        """実行中でない repo:branch の最古のジョブを取り出す"""
+        for key in self.pending:
+            if key not in self.running:
+                return self.pending.pop(key)
+        return None
+
+    def worker_loop(self):
+        while True:
+            with self.cond:
+                job = self.next_job()
+                while job is None:
+                    self.cond.wait()
+                    job = self.next_job()
+                job.status = 'running'
+                job.started_at = datetime.now().isoformat()
+                self.running[job.key] = job
+                DEPLOY_QUEUE_DEPTH.set(len(self.pending))
+                DEPLOYS_RUNNING.set(len(self.running))
+
+            try:
+                success, message = self.deploy_func(job.repo_full_name, job.branch, job=job)
+                if job.cancelled and not success:
+                    status = 'cancelled'
+                else:
+                    status = 'succeeded' if success else 'failed'
+            except DeployCancelled as e:
+                status, message = 'cancelled', str(e)
+            except Exception as e:
+                logger.error(f"❌ Deploy worker error for {job.key}: {e}")
+                status, message = 'failed', str(e)
+
+            logger.info(f"📊 Deploy #{job.id} {status} for {job.key}: {message}")
+
+            with self.cond:
+                job.finish(status, message)
+                self.running.pop(job.key, None)
+                self.history.append(job)
+                DEPLOYS_RUNNING.set(len(self.running))
+                DEPLOYS.labels(job.status).inc()
+                # 同じキーの待機ジョブを他のワーカーが拾えるように起こす
+                self.cond.notify_all()
+
+            self.record(job)
+
+    def find(self, job_id):
+        """待機中・実行中・最近終了したジョブからIDで検索"""
+        with self.cond:
+            for job in (*self.pending.values(), *self.running.values(), *self.history):
+                if job.id == job_id:
+                    return job
+        return None
+
+    def jobs_for(self, key):
+        """repo:branch の待機中・実行中・最近終了したジョブ（新しい順）"""
+        with self.cond:
+            jobs = (*self.pending.values(), *self.running.values(), *reversed(self.history))
+            return [job for job in jobs if job.key == key]
+
+    def status(self):
+        """キューと実行中ジョブの状態"""
+        with self.cond:
+            return {
+                'max_workers': self.max_workers,
+                'queue_depth': len(self.pending),
+                'running_count': len(self.running),
+                'pending': [job.to_dict() for job in self.pending.values()],
+                'running': [job.to_dict() for job in self.running.values()],
+                'recent': [job.to_dict() for job in reversed(self.history)],
+            }
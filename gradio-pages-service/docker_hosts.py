@@ -0,0 +1,349 @@
+"""
+Docker ホストのプール
+複数の Docker デーモン（ノード）毎にクライアント・ポート範囲・メモリ容量・イベント購読を持ち、
+レプリカを配置ポリシー（least-loaded: 負荷の低いノード / sticky: リポジトリ毎に決まったノード）で割り当てる
+"""
+
+import os
+import time
+import hashlib
+import threading
+import logging
+from urllib.parse import urlparse
+
+import docker
+import yaml
+
+from port_allocator import PortAllocator
+from container_events import ContainerEventWatcher
+from resources import HostCapacity, format_bytes, parse_size
+
+logger = logging.getLogger(__name__)
+
+# DOCKER_HOSTS / DOCKER_HOSTS_FILE の指定がない場合のノード名（docker.from_env() の接続先）
+LOCAL_HOST = 'local'
+PLACEMENT_POLICIES = ('least-loaded', 'sticky')
+
+
+def parse_port_range(value, default):
+    """'9100-9150' を (開始, 終了) にする"""
+    if not value:
+        return default
+    start, _, end = str(value).partition('-')
+    return int(start), int(end or start)
+
+
+def parse_hosts(value):
+    """DOCKER_HOSTS（'node1=tcp://10.0.0.2:2375,node2=tcp://10.0.0.3:2375' または URL の列挙）をノード定義にする"""
+    definitions = []
+    for entry in value.split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        name, separator, url = entry.partition('=')
+        if not separator:
+            name, url = urlparse(entry).hostname or entry, entry
+        definitions.append({'name': name.strip(), 'url': url.strip()})
+    return definitions
+
+
+def open_client(definition):
+    """ノード定義の Docker クライアント（url のないノードは DOCKER_HOST）"""
+    url = definition.get('url')
+    if not url:
+        return docker.from_env()
+    return docker.DockerClient(base_url=url, tls=tls_config(definition))
+
+
+def tls_config(definition):
+    """cert_path（ca.pem / cert.pem / key.pem）があれば TLS で接続"""
+    cert_path = definition.get('cert_path')
+    if not cert_path:
+        return None
+    return docker.tls.TLSConfig(
+        client_cert=(os.path.join(cert_path, 'cert.pem'), os.path.join(cert_path, 'key.pem')),
+        ca_cert=os.path.join(cert_path, 'ca.pem'),
+        verify=definition.get('tls_verify', True),
+    )
+
+
+class DockerHost:
+    """Docker デーモン1つ分（コンテナの配置先ノード）"""
+
+    def __init__(self, name, client, definition, address, ports, capacity, network=''):
+        self.name = name
+        self.client = client
+        # fork 後の再接続用
+        self.definition = definition
+        self.url = definition.get('url')
+        # プロキシがこのノードの公開ポートへ接続するアドレス
+        self.address = address
+        self.ports = ports
+        self.capacity = capacity
+        # 指定時はホストポートを使わず、このネットワーク上でコンテナ名に直接ルーティング
+        self.network = network
+        self.events = None
+
+    def reconnect(self):
+        """クライアントを作り直す（fork 前の接続プール・events の購読をワーカー間で共有しない）"""
+        self.events = None
+        try:
+            self.client = open_client(self.definition)
+        except Exception as e:
+            logger.error(f"❌ Failed to reconnect Docker ({self.name}): {e}")
+            self.client = None
+
+    @property
+    def connected(self):
+        """events を購読できているか（購読前は接続済みとみなす）"""
+        return self.events is None or self.events.connected
+
+    def status(self, replicas):
+        return {
+            'name': self.name,
+            'url': self.url or 'DOCKER_HOST',
+            'address': self.address,
+            'network': self.network or None,
+            'available': self.client is not None,
+            'events_connected': bool(self.events and self.events.connected),
+            'replicas': replicas,
+            'port_range': f"{self.ports.port_start}-{self.ports.port_end}",
+            'free_ports': self.ports.free_count(),
+            'memory': self.capacity.status(),
+        }
+
+
+class DockerHostPool:
+    """ノードの一覧と配置・メモリ予約・イメージ転送"""
+
+    def __init__(self, usage_func, backend_host, port_range, network='', probe=None):
+        # usage_func(ノード名) -> (起動済みレプリカのメモリ上限の合計, レプリカ数)
+        self.usage_func = usage_func
+        self.policy = os.getenv('PLACEMENT_POLICY', 'least-loaded')
+        if self.policy not in PLACEMENT_POLICIES:
+            logger.warning(f"⚠️  Unknown PLACEMENT_POLICY {self.policy}, using least-loaded")
+            self.policy = 'least-loaded'
+        self.cond = threading.Condition()
+        self.hosts = {}
+        for definition in self.load_definitions(os.getenv('DOCKER_HOSTS_FILE', '/data/docker-hosts.yml')):
+            host = self.connect(definition, backend_host, port_range, network, probe)
+            self.hosts[host.name] = host
+
+        # 状態に node のない（単一ホスト時代の）レプリカは先頭のノードのもの
+        self.default = next(iter(self.hosts))
+        # イメージのビルド・ベースイメージはビルドノードで行い、他のノードへは転送する
+        build_host = os.getenv('BUILD_HOST', '')
+        if build_host and build_host not in self.hosts:
+            logger.warning(f"⚠️  Unknown BUILD_HOST {build_host}, building on {self.default}")
+        self.build_host = self.hosts.get(build_host) or self.hosts[self.default]
+
+        if len(self.hosts) > 1:
+            logger.info(
+                f"🖧  Docker hosts: {', '.join(f'{h.name} ({h.address})' for h in self.hosts.values())} "
+                f"(placement: {self.policy}, build: {self.build_host.name})"
+            )
+
+    def load_definitions(self, path):
+        """ノードの定義を読む（ファイル → DOCKER_HOSTS → このマシンの Docker の順）"""
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    definitions = (yaml.safe_load(f) or {}).get('docker_hosts', [])
+                definitions = [d for d in definitions if isinstance(d, dict) and d.get('name')]
+                if definitions:
+                    return definitions
+                logger.error(f"❌ No docker_hosts defined in {path}")
+            except (OSError, yaml.YAMLError, AttributeError, TypeError) as e:
+                logger.error(f"❌ Failed to load {path}: {e}")
+        definitions = parse_hosts(os.getenv('DOCKER_HOSTS', ''))
+        return definitions or [{'name': LOCAL_HOST}]
+
+    def connect(self, definition, backend_host, port_range, network, probe):
+        """ノード1つ分のクライアント・ポート範囲・容量を用意（接続できなくてもノードとしては残す）"""
+        name = str(definition['name'])
+        url = definition.get('url')
+        # url のないノードは DOCKER_HOST（このマシン）で、従来通り GRADIO_BACKEND_HOST・GRADIO_NETWORK を使う
+        local = not url
+        client = None
+        try:
+            client = open_client(definition)
+            logger.info(f"✅ Docker client connected successfully{'' if local else f' ({name}: {url})'}")
+        except Exception as e:
+            logger.error(f"❌ Failed to connect to Docker{'' if local else f' ({name}: {url})'}: {e}")
+
+        total = None
+        try:
+            if definition.get('memory') is not None:
+                total = parse_size(definition['memory'])
+            elif not local and client:
+                total = client.info().get('MemTotal', 0)
+        except Exception as e:
+            logger.warning(f"⚠️  Could not read memory of {name}, not limiting it: {e}")
+            total = 0
+
+        address = definition.get('address') or (backend_host if local else urlparse(url).hostname) or backend_host
+        start, end = parse_port_range(definition.get('ports'), port_range)
+        return DockerHost(
+            name,
+            client,
+            definition,
+            address,
+            # このマシン以外のポートは bind で確かめられない
+            PortAllocator(start, end, probe=probe if local else None),
+            HostCapacity(lambda: self.usage_func(name)[0], total, None if name == LOCAL_HOST else name),
+            definition.get('network', network if local else ''),
+        )
+
+    def reconnect(self):
+        """全ノードのクライアントを作り直す（gunicorn の post_fork から）"""
+        for host in self.hosts.values():
+            host.reconnect()
+
+    def share_ports(self, store):
+        """全ノードのポート予約を状態ストアに置く（マルチワーカー時）"""
+        for host in self.hosts.values():
+            host.ports.share(store, host.name)
+
+    def get(self, name=None):
+        """ノード名からノード（None は既定のノード）"""
+        return self.hosts.get(name or self.default)
+
+    def client(self, name=None):
+        host = self.get(name)
+        return host.client if host else None
+
+    def candidates(self, repo_id, placed):
+        """配置ポリシー順のノード（events が切れているノードは、全ノードが切れている時以外は除く）"""
+        hosts = [host for host in self.hosts.values() if host.client is not None]
+        hosts = [host for host in hosts if host.connected] or hosts
+        if self.policy == 'sticky' and repo_id:
+            # リポジトリ毎に決まる順（ノードを増減しても他のリポジトリの配置は動かない）
+            return sorted(hosts, key=lambda host: self.affinity(repo_id, host.name), reverse=True)
+        return sorted(hosts, key=lambda host: self.load(host, placed))
+
+    def affinity(self, repo_id, name):
+        return int(hashlib.sha256(f"{repo_id}\0{name}".encode()).hexdigest()[:16], 16)
+
+    def load(self, host, placed):
+        """ノードの負荷（メモリ上限の合計の割合、同じならレプリカ数の少ない方）"""
+        committed, replicas = self.usage_func(host.name)
+        replicas += placed.count(host.name)
+        capacity = host.capacity
+        if not capacity.capacity:
+            return 0, replicas
+        with capacity.lock:
+            reserved = sum(capacity.reservations.values())
+        return (committed + reserved) / capacity.capacity, replicas
+
+    def place(self, key, size, count, repo_id):
+        """レプリカを1台ずつ置けるノードへ割り当てて予約（全台置けなければ戻す）。(ノード名のリスト, 理由, 待てば置けるか)"""
+        nodes = []
+        for index in range(count):
+            reasons = []
+            for host in self.candidates(repo_id, nodes):
+                reserved, reason = host.capacity.reserve(key, size)
+                if reserved:
+                    nodes.append(host.name)
+                    break
+                reasons.append((host, reason))
+            else:
+                self.release(key)
+                if not reasons:
+                    return None, 'no Docker host available', False
+                fits = any(not host.capacity.capacity or size <= host.capacity.capacity for host, _ in reasons)
+                if len(self.hosts) == 1:
+                    return None, reasons[0][1], fits
+                details = '; '.join(f"{host.name}: {reason}" for host, reason in reasons)
+                return None, f"no node has room for replica {index + 1}/{count} ({details})", fits
+        return nodes, None, True
+
+    def reserve(self, key, size, count=1, timeout=0, job=None, repo_id=None):
+        """count 台のレプリカの配置先を決めて size バイトずつ予約する（空くまで最大 timeout 秒待つ）。(ノード名のリスト, 理由) を返す"""
+        deadline = time.monotonic() + timeout
+        logged = False
+        with self.cond:
+            while True:
+                nodes, reason, fits = self.place(key, size, count, repo_id)
+                if nodes:
+                    return nodes, None
+                remaining = deadline - time.monotonic()
+                if not fits or remaining <= 0:
+                    return None, reason
+                if not logged:
+                    message = f"Waiting for host memory: need {format_bytes(size)} per replica ({reason})"
+                    logger.info(f"⏳ {message}")
+                    if job:
+                        job.log_line(message)
+                    logged = True
+                # 停止・解放の通知がなくても（他ワーカーでの停止など）定期的に見直す
+                self.cond.wait(min(remaining, 5))
+                if job:
+                    job.check_cancelled()
+
+    def release(self, key):
+        """全ノードの予約を返す"""
+        with self.cond:
+            for host in self.hosts.values():
+                host.capacity.release(key)
+            self.cond.notify_all()
+
+    def notify(self):
+        """アプリの停止などで空きが増えた"""
+        with self.cond:
+            self.cond.notify_all()
+
+    def ensure_image(self, name, image_name, job=None):
+        """ビルドノードのイメージがなければ配置先ノードへ転送（save → load をストリームで中継）"""
+        host = self.get(name)
+        if host is self.build_host:
+            return
+        try:
+            host.client.images.get(image_name)
+            return
+        except docker.errors.ImageNotFound:
+            pass
+        message = f"Copying {image_name} to {host.name}"
+        logger.info(f"🚚 {message}")
+        if job:
+            job.log_line(message)
+        started = time.perf_counter()
+        image = self.build_host.client.images.get(image_name)
+        host.client.images.load(image.save(named=image_name))
+        logger.info(f"✅ Copied {image_name} to {host.name} in {time.perf_counter() - started:.1f}s")
+
+    def watch(self, on_event):
+        """ノード毎に events を購読（on_event(コンテナ名, アクション, node=ノード名)）"""
+        for host in self.hosts.values():
+            if host.client is None:
+                continue
+            host.events = ContainerEventWatcher(
+                host.client,
+                lambda container_name, action, node=host.name: on_event(container_name, action, node=node),
+                name=host.name if len(self.hosts) > 1 else None,
+            )
+            host.events.start()
+
+    def events_connected(self):
+        watchers = [host.events for host in self.hosts.values() if host.events]
+        return bool(watchers) and all(watcher.connected for watcher in watchers)
+
+    def free_ports(self):
+        return sum(host.ports.free_count() for host in self.hosts.values())
+
+    def memory_status(self):
+        """全ノードのメモリ容量の合計（容量管理しないノードがあれば空きは None）"""
+        statuses = [host.capacity.status() for host in self.hosts.values()]
+        limited = all(status['capacity_bytes'] for status in statuses)
+        return {
+            'capacity_bytes': sum(status['capacity_bytes'] for status in statuses),
+            'committed_bytes': sum(status['committed_bytes'] for status in statuses),
+            'reserved_bytes': sum(status['reserved_bytes'] for status in statuses),
+            'available_bytes': sum(status['available_bytes'] for status in statuses) if limited else None,
+        }
+
+    def status(self):
+        return {
+            'policy': self.policy,
+            'build_host': self.build_host.name,
+            'nodes': [host.status(self.usage_func(host.name)[1]) for host in self.hosts.values()],
+        }
@@ -5,74 +5,252 @@ Forgejo Gradio Pages サービス（デバッグ版）
 """
 
 import os
-import json
+import re
+import hashlib
 import subprocess
 import threading
+import queue
 import time
+from contextlib import nullcontext
 from datetime import datetime
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, redirect
 import docker
 import requests
 import logging
+import yaml
 from pathlib import Path
-import shutil
 import socket
 
+from proxy_engine import GradioProxy, is_streaming_request, is_websocket_request
+from deploy_scheduler import DeployScheduler, DeployJob, DeployCancelled
+from deploy_owner import DeployOwner, OwnerUnavailable
+from git_cache import RepoCache, valid_branch, valid_repo_name
+from build_cache import BuildContext, BuildContextTooLarge
+from base_images import BaseImagePool
+from container_events import MANAGED_LABEL
+from docker_hosts import DockerHostPool
+from state_store import AppStateStore
+from metrics import COLD_START_SECONDS, register_manager, render_metrics
+from load_balancer import ReplicaBalancer, STICKY_COOKIE, gradio_session_hash, wants_session_body
+from asset_cache import AssetCache, cache_key
+from admission import AdmissionController, validate_limits
+from dashboard import AppFeed, parse_since, render_app_card, render_dashboard
+from resources import container_options, effective_resources, validate_resources
+
+# Gradioコンテナ内のリッスンポート
+GRADIO_CONTAINER_PORT = 7860
+
+# main 以外のブランチは /<user>/<repo>/@<branch>/ で配信
+BRANCH_MARKER = '@'
+# リポジトリ直下に置けるサービス設定（limits: でアドミッション制御の上限を指定）
+REPO_CONFIG_FILES = ('gradio-pages.yml', '.gradio-pages.yml')
+# PRプレビューのブランチ名（git_cache で refs/pull/<番号>/head を取得）
+PREVIEW_PREFIX = 'pull/'
+# マルチワーカー時にオーナーのワーカーへ転送して実行するメソッド（デプロイ・コンテナの起動停止・アプリ状態の書き込み）
+OWNER_CALLS = {
+    'submit_deploy', 'discard_app', 'make_room_for_preview', 'stop_app', 'cold_start', 'set_app_limits',
+    'live_jobs', 'live_job', 'read_job_log', 'scheduler_status', 'base_image_status',
+}
+
 # ログ設定
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 class ForgejoGradioManager:
     def __init__(self):
-        try:
-            self.docker_client = docker.from_env()
-            logger.info("✅ Docker client connected successfully")
-        except Exception as e:
-            logger.error(f"❌ Failed to connect to Docker: {e}")
-            self.docker_client = None
-            
         self.forgejo_url = os.getenv('FORGEJO_URL', 'http://server:3000')
         self.forgejo_token = os.getenv('FORGEJO_TOKEN', '')
         self.apps = {}
+        # デプロイスレッドと API スレッドが self.apps を同時に更新するため
+        self.apps_lock = threading.RLock()
         self.port_start = int(os.getenv('GRADIO_PORT_START', 9100))  # デフォルトを9100に変更
         self.port_end = int(os.getenv('GRADIO_PORT_END', 9150))     # デフォルトを9150に変更
         self.app_dir = '/tmp/gradio-apps'
+        # マルチワーカー（ASGI）時は状態ストア経由でルーティングを共有
+        self.shared_state = int(os.getenv('GRADIO_PAGES_WORKERS', 1)) > 1
+        self.state_version = None
+        # ASGI ではイベントループを止めないよう、ルーティング用の状態をバックグラウンドで取り込む
+        self.state_sync_interval = float(os.getenv('STATE_SYNC_INTERVAL', 0.5))
+        self.background_state_sync = False
         
         logger.info(f"🔧 Port range: {self.port_start}-{self.port_end}")
         
+        # 指定時はホストポートを使わず、このネットワーク上でコンテナ名に直接ルーティング
+        self.gradio_network = os.getenv('GRADIO_NETWORK', '')
+        if self.gradio_network:
+            logger.info(f"🌐 Routing to containers on Docker network: {self.gradio_network}")
+        
+        # コンテナを置く Docker ホスト（DOCKER_HOSTS 指定時は複数ノード、ポート・メモリ容量はノード毎）
+        # ホストのメモリ容量を超える起動は CAPACITY_WAIT_SECONDS まで待たせ、空かなければ断る
+        self.backend_host = os.getenv('GRADIO_BACKEND_HOST', '192.168.0.131')
+        self.hosts = DockerHostPool(
+            self.node_usage, self.backend_host, (self.port_start, self.port_end),
+            self.gradio_network, probe=self.is_port_available
+        )
+        self.capacity_wait = int(os.getenv('CAPACITY_WAIT_SECONDS', 300))
+        # イメージのビルドはビルドノード（単一ホストならそのホスト）で行う
+        self.docker_client = self.hosts.build_host.client
+        
         # ディレクトリ作成
         os.makedirs(self.app_dir, exist_ok=True)
         logger.info(f"📁 App directory created: {self.app_dir}")
         
+        # リポジトリ毎のベアミラー（pushごとに差分だけfetch）
+        self.repo_cache = RepoCache(self.app_dir, self.forgejo_url)
+        
+        # ビルドキャッシュ設定（DOCKER_BUILDKIT=1 で docker CLI + BuildKit を使用）
+        self.buildkit = os.getenv('DOCKER_BUILDKIT', '0') == '1'
+        self.build_cache_keep = int(os.getenv('BUILD_CACHE_KEEP', 3))
+        
+        # 共通の依存関係をインストール済みのベースイメージ（BASE_IMAGE_POOL=1 で有効）
+        self.base_images = BaseImagePool(
+            self.build_base_image, self.image_exists, self.buildkit,
+            image_id_func=self.image_id, prune_func=self.prune_base_images
+        )
+        
+        # デプロイ戦略（bluegreen: 新コンテナの準備完了後に切り替え / recreate: 先に停止）
+        self.deploy_strategy = os.getenv('DEPLOY_STRATEGY', 'bluegreen')
+        self.readiness_path = os.getenv('READINESS_PATH', '/')
+        self.readiness_timeout = int(os.getenv('READINESS_TIMEOUT', 180))
+        self.readiness_interval = float(os.getenv('READINESS_INTERVAL', 1))
+        self.drain_timeout = int(os.getenv('DRAIN_TIMEOUT', 15))
+        
+        # アプリ毎のレプリカ数（デプロイAPIの replicas で個別に変更可能）
+        self.default_replicas = int(os.getenv('APP_REPLICAS', 1))
+        self.max_replicas = int(os.getenv('MAX_REPLICAS', 8))
+        
+        # 静的アセットのキャッシュ（キーにイメージを含むため再デプロイで切り替わる）
+        self.asset_cache = AssetCache()
+        # 接続先 (host, port) を手放した時に呼ぶ（プロキシのコネクションプールの破棄）
+        self.target_listeners = []
+        
+        # アプリ・クライアント毎の流入制限（既定値 ← リポジトリの設定 ← API）
+        self.admission = AdmissionController()
+        
+        # PRプレビューの同時稼働数（超えたら最もアクセスの古いプレビューを削除、0 で無効）
+        self.preview_max = int(os.getenv('PREVIEW_MAX', 5))
+        
+        # スケールtoゼロ（IDLE_TIMEOUT 秒アクセスのないアプリを停止し、次のアクセスで起動）
+        self.idle_timeout = int(os.getenv('IDLE_TIMEOUT', 0))
+        self.idle_check_interval = int(os.getenv('IDLE_CHECK_INTERVAL', 60))
+        self.cold_start_timeout = int(os.getenv('COLD_START_TIMEOUT', 120))
+        self.cold_starts = {}
+        self.access_dir = '/data/access'
+        # アクセス時刻のファイルへの書き込みはリクエストの処理（ASGI のイベントループ）から切り離す
+        self.access_queue = queue.Queue()
+        self.background_started = False
+        
+        # アプリ状態は SQLite（WAL）にアプリ単位で保存
+        self.state_store = None
+        try:
+            self.state_store = AppStateStore(
+                os.getenv('STATE_DB', '/data/apps_state.db'),
+                legacy_json='/data/apps_state.json',
+                deploy_history=int(os.getenv('DEPLOY_HISTORY_PER_APP', 50))
+            )
+        except Exception as e:
+            logger.error(f"❌ Failed to open state store: {e}")
+        
+        # マルチワーカー時はポートの予約も状態ストアに置き、ワーカー間で同じポートを払い出さない
+        if self.shared_state and self.state_store:
+            self.hosts.share_ports(self.state_store)
+        
         self.load_apps_state()
         
-        # 既存コンテナのクリーンアップ
-        self.cleanup_existing_containers()
+        # マルチワーカー時はファイルロックを取った1ワーカーだけがデプロイ・コンテナの起動停止を行い、他はそこへ転送する
+        self.owner = None
+        if self.shared_state:
+            state_dir = os.path.dirname(os.path.abspath(os.getenv('STATE_DB', '/data/apps_state.db')))
+            self.owner = DeployOwner(
+                os.path.join(state_dir, 'gradio-pages-owner.lock'),
+                os.path.join(state_dir, 'gradio-pages-owner.sock'),
+                os.urandom(32), self.dispatch_owner_call, self.start_owner_tasks
+            )
         
-    def cleanup_existing_containers(self):
-        """既存のGradioコンテナをクリーンアップ"""
+        # デプロイは有界ワーカープールで repo:branch 毎に直列化
+        self.scheduler = DeployScheduler(self.deploy_app, on_finish=self.record_deploy)
+        
+        # 稼働中のコンテナを引き継ぎ、どのアプリにも属さないものだけ削除
+        self.reconcile_containers()
+        
+    def reconcile_containers(self):
+        """保存済みの状態と実在コンテナを突き合わせ、稼働中のコンテナを再利用（全ノード）"""
         if not self.docker_client:
             return
             
         try:
-            logger.info("🧹 Cleaning up existing Gradio containers...")
-            containers = self.docker_client.containers.list(all=True)
-            
-            for container in containers:
-                if container.name.startswith('gradio-'):
-                    try:
-                        logger.info(f"🗑️  Removing container: {container.name}")
-                        container.remove(force=True)
-                    except Exception as e:
-                        logger.warning(f"Failed to remove container {container.name}: {e}")
-                        
-            # アプリ状態をクリア
-            self.apps.clear()
-            self.save_apps_state()
-            logger.info("✅ Container cleanup completed")
+            logger.info("🔍 Reconciling existing Gradio containers...")
+            containers = {}
+            for host in self.hosts.hosts.values():
+                if host.client is None:
+                    continue
+                try:
+                    for container in host.client.containers.list(all=True):
+                        if container.name.startswith('gradio-'):
+                            containers[(host.name, container.name)] = container
+                except Exception as e:
+                    # 応答しないノードのレプリカは消えたものとして扱い、アクセス時に起動し直す
+                    logger.error(f"❌ Failed to list containers on {host.name}: {e}")
+            
+            adopted = 0
+            for repo_id, app_info in list(self.apps.items()):
+                if app_info.get('status') == 'idle':
+                    continue
+                
+                replicas = []
+                for replica in app_info['replicas']:
+                    container = containers.pop((replica['node'], replica['container_name']), None)
+                    if container is None:
+                        self.release_target(replica)
+                        continue
+                    if container.status != 'running':
+                        try:
+                            container.start()
+                            container.reload()
+                        except Exception as e:
+                            logger.warning(f"Failed to restart container {container.name}: {e}")
+                    replica['container'] = container
+                    replica['status'] = 'running' if container.status == 'running' else 'stopped'
+                    replicas.append(replica)
+                    adopted += 1
+                    logger.info(f"🤝 Adopted {container.name} for {repo_id} ({replica['status']})")
+                
+                if replicas:
+                    self.set_replicas(app_info, replicas)
+                    self.refresh_app_status(app_info)
+                elif app_info.get('image') and self.image_exists(app_info['image']):
+                    # コンテナが消えていてもイメージがあれば次のアクセスで起動できる
+                    logger.info(f"💤 {repo_id}: containers missing, marking idle")
+                    self.set_replicas(app_info, [])
+                    app_info['status'] = 'idle'
+                else:
+                    self.set_replicas(app_info, [])
+                    app_info['status'] = 'stopped'
+                self.save_app(repo_id)
+            
+            # 状態に記録のないコンテナ（ドレイン途中の旧スロットなど）は削除
+            for (_, name), container in containers.items():
+                try:
+                    logger.info(f"🗑️  Removing orphan container: {name}")
+                    container.remove(force=True)
+                except Exception as e:
+                    logger.warning(f"Failed to remove container {name}: {e}")
+            
+            logger.info(f"✅ Reconciled {adopted} containers, removed {len(containers)} orphans")
             
         except Exception as e:
-            logger.error(f"Error during cleanup: {e}")
+            logger.error(f"Error during reconciliation: {e}")
+
+    def reconnect_docker(self):
+        """全ノードのクライアントを作り直し、レプリカのコンテナも新しいクライアントで取り直す（fork 後のワーカーで呼ぶ）"""
+        self.hosts.reconnect()
+        # ビルドはビルドノードのクライアントで行う
+        self.docker_client = self.hosts.build_host.client
+        with self.apps_lock:
+            for app_info in self.apps.values():
+                for replica in app_info.get('replicas', []):
+                    if replica.get('container') is not None:
+                        replica['container'] = self.find_container(replica['container_name'], replica['node'])
 
     def is_port_available(self, port):
         """ポートが利用可能かチェック"""
@@ -85,84 +263,181 @@ class ForgejoGradioManager:
 
     def load_apps_state(self):
         """アプリ状態をロード"""
+        if not self.state_store:
+            return
         try:
-            state_file = '/data/apps_state.json'
-            if os.path.exists(state_file):
-                with open(state_file, 'r') as f:
-                    saved_data = json.load(f)
-                    for repo_id, app_info in saved_data.items():
-                        self.apps[repo_id] = app_info
-                logger.info(f"📊 Loaded {len(self.apps)} apps state")
+            self.state_version = self.state_store.version()
+            if self.shared_state:
+                # 前回起動時の予約は捨て、保存済みのアプリから作り直す（マスターで一度だけ）
+                self.state_store.clear_ports()
+            for repo_id, app_info in self.state_store.load().items():
+                self.normalize_replicas(app_info)
+                self.apps[repo_id] = app_info
+                self.reserve_app_port(app_info)
+            logger.info(f"📊 Loaded {len(self.apps)} apps state")
         except Exception as e:
             logger.error(f"Error loading apps state: {e}")
-            
-    def save_apps_state(self):
-        """アプリ状態を保存"""
+
+    def save_app(self, repo_id):
+        """1アプリ分の状態を保存（self.apps から消えていれば削除）"""
+        if not self.state_store:
+            return
         try:
-            os.makedirs('/data', exist_ok=True)
-            save_data = {}
-            for repo_id, app_info in self.apps.items():
-                save_data[repo_id] = {
-                    'port': app_info.get('port'),
-                    'status': app_info.get('status'),
-                    'created': app_info.get('created'),
-                    'last_updated': app_info.get('last_updated'),
-                    'repo_full_name': app_info.get('repo_full_name'),
-                    'branch': app_info.get('branch')
-                }
-            with open('/data/apps_state.json', 'w') as f:
-                json.dump(save_data, f, indent=2)
-            logger.info("💾 Apps state saved")
+            with self.apps_lock:
+                app_info = self.apps.get(repo_id)
+                if app_info:
+                    self.state_store.put(repo_id, app_info)
+                else:
+                    self.state_store.delete(repo_id)
+            logger.info(f"💾 Saved state for {repo_id}")
         except Exception as e:
-            logger.error(f"Error saving apps state: {e}")
+            logger.error(f"Error saving state for {repo_id}: {e}")
 
-    def clone_repository(self, repo_full_name, branch='main'):
-        """リポジトリをクローン（タイムアウト付き）"""
+    def refresh_routes(self):
+        """リクエスト毎のルーティング前に他ワーカーの状態を取り込む（バックグラウンドで取り込み中なら何もしない）"""
+        if self.shared_state and not self.background_state_sync:
+            self.sync_apps_state()
+
+    def sync_apps_state(self):
+        """他ワーカーが保存したアプリ状態を取り込む（ポートの予約・解放は保存したワーカーが済ませている）"""
+        if not self.state_store:
+            return
         try:
-            logger.info(f"🔄 Cloning {repo_full_name}:{branch}")
-            repo_dir = os.path.join(self.app_dir, repo_full_name.replace('/', '-'), branch)
-            
-            # 既存ディレクトリを削除
-            if os.path.exists(repo_dir):
-                shutil.rmtree(repo_dir)
-                logger.info(f"🗑️  Removed existing directory: {repo_dir}")
-            
-            # 親ディレクトリ作成
-            os.makedirs(os.path.dirname(repo_dir), exist_ok=True)
+            version = self.state_store.version()
+            if version == self.state_version:
+                return
+            saved_data = self.state_store.load()
             
-            # クローン（タイムアウト付き）
-            clone_url = f"{self.forgejo_url}/{repo_full_name}.git"
-            logger.info(f"🌐 Clone URL: {clone_url}")
-            
-            # Git clone with timeout
-            result = subprocess.run([
-                'git', 'clone', 
-                '-b', branch,
-                '--depth', '1',
-                '--single-branch',
-                clone_url, 
-                repo_dir
-            ], check=True, timeout=60, capture_output=True, text=True)
+            with self.apps_lock:
+                for repo_id in list(self.apps):
+                    if repo_id not in saved_data:
+                        removed = self.apps.pop(repo_id)
+                        for replica in removed['replicas']:
+                            self.forget_target(replica)
+                
+                for repo_id, app_info in saved_data.items():
+                    self.normalize_replicas(app_info)
+                    current = self.apps.get(repo_id, {})
+                    # 既知のコンテナオブジェクトは引き継ぎ、新しいレプリカだけ取得する
+                    known = {r['container_name']: r for r in current.get('replicas', [])}
+                    for replica in app_info['replicas']:
+                        previous = known.pop(replica['container_name'], None)
+                        if previous and previous['port'] == replica['port'] and previous['node'] == replica['node']:
+                            replica['container'] = previous.get('container')
+                        else:
+                            replica['container'] = self.find_container(replica['container_name'], replica['node'])
+                    for stale in known.values():
+                        self.forget_target(stale)
+                    self.apps[repo_id] = {**current, **app_info}
             
-            logger.info(f"✅ Clone successful: {repo_dir}")
+            self.state_version = version
+            logger.info(f"🔄 Synced {len(self.apps)} apps state from state store")
+        except Exception as e:
+            logger.error(f"Error syncing apps state: {e}")
+
+    def container_name_for(self, repo_full_name, branch):
+        """リポジトリ・ブランチに対応するコンテナ名（イメージ名と共通）"""
+        # pull/12 や feature/x など、Dockerの名前に使えない文字は - に置き換える
+        raw = f"gradio-{repo_full_name}-{branch}"
+        slug = re.sub(r'[^a-z0-9_.-]+', '-', raw.lower())
+        if slug == raw:
+            return slug
+        # 置き換えで feature/x と feature-x、a-b/c と a/b-c などが同じ名前にならないよう元の名前のハッシュを付ける
+        return f"{slug}-{hashlib.sha1(f'{repo_full_name}:{branch}'.encode()).hexdigest()[:8]}"
+
+    def app_path(self, repo_full_name, branch='main'):
+        """アプリの公開パス（main は /<user>/<repo>、それ以外は /<user>/<repo>/@<branch>）"""
+        if branch == 'main':
+            return f"/{repo_full_name}"
+        return f"/{repo_full_name}/{BRANCH_MARKER}{branch}"
+
+    def split_branch_path(self, repo_full_name, path):
+        """'@<branch>/...' 形式のパスを (ブランチ, アプリ内パス) に分ける"""
+        if not path.startswith(BRANCH_MARKER):
+            return 'main', path
+        self.refresh_routes()
+        parts = path[len(BRANCH_MARKER):].split('/')
+        # ブランチ名に / を含められるよう、デプロイ済みのブランチと最長一致させる
+        for i in range(len(parts), 0, -1):
+            branch = '/'.join(parts[:i])
+            if f"{repo_full_name}:{branch}" in self.apps:
+                return branch, '/'.join(parts[i:])
+        # デプロイされていないブランチは、不正な名前なら空にして以降の処理へ渡さない
+        return (parts[0] if valid_branch(parts[0]) else ''), '/'.join(parts[1:])
+
+    def replica_name(self, repo_full_name, branch, slot, index):
+        """レプリカのコンテナ名（1台目は従来と同じ名前）"""
+        base = f"{self.container_name_for(repo_full_name, branch)}-{slot}"
+        return base if index == 0 else f"{base}-{index}"
+
+    def normalize_replicas(self, app_info):
+        """旧形式（単一コンテナ）の状態をレプリカ一覧の形に揃える"""
+        if app_info.get('replicas') is None:
+            app_info['replicas'] = [{
+                'container_name': app_info['container_name'],
+                'host': app_info.get('host') or self.backend_host,
+                'port': app_info['port'],
+                'status': app_info.get('status'),
+                'container': app_info.get('container'),
+            }] if app_info.get('container_name') and app_info.get('port') else []
+        # 単一ホスト時代のレプリカは既定のノードに置かれている
+        for replica in app_info['replicas']:
+            replica.setdefault('node', self.hosts.default)
+        app_info.setdefault('replica_count', max(1, len(app_info['replicas'])))
+        return app_info['replicas']
+
+    def set_replicas(self, app_info, replicas):
+        """レプリカ一覧を設定（host/port/container_name は1台目を表示用に残す）"""
+        first = replicas[0] if replicas else {}
+        app_info['replicas'] = replicas
+        app_info['container_name'] = first.get('container_name', app_info.get('container_name'))
+        app_info['host'] = first.get('host')
+        app_info['port'] = first.get('port')
+
+    def refresh_app_status(self, app_info):
+        """レプリカの状態からアプリ全体の状態を決める（1台でも稼働中なら running）"""
+        if app_info.get('status') in ('idle', 'starting'):
+            return
+        statuses = [r.get('status') for r in app_info['replicas']]
+        if 'running' in statuses:
+            app_info['status'] = 'running'
+        else:
+            app_info['status'] = statuses[0] if statuses else 'stopped'
+
+    def find_container(self, container_name, node=None):
+        """名前から既存コンテナを取得（node はレプリカの配置先ノード）"""
+        client = self.hosts.client(node)
+        if not client or not container_name:
+            return None
+        try:
+            return client.containers.get(container_name)
+        except docker.errors.NotFound:
+            return None
+
+    def clone_repository(self, repo_full_name, branch='main', commit=None):
+        """リポジトリを取得（ミラーから差分fetchしてチェックアウト）"""
+        try:
+            logger.info(f"🔄 Fetching {repo_full_name}:{branch}" + (f" @ {commit[:12]}" if commit else ""))
+            repo_dir, sha = self.repo_cache.update(repo_full_name, branch, commit)
+            logger.info(f"✅ Checked out {sha[:12]}: {repo_dir}")
             
             # ファイル確認
             files = os.listdir(repo_dir)
             logger.info(f"📁 Repository files: {files}")
             
-            return repo_dir
+            return repo_dir, sha
         except subprocess.TimeoutExpired:
-            logger.error(f"⏰ Clone timeout for {repo_full_name}")
-            return None
+            logger.error(f"⏰ Fetch timeout for {repo_full_name}")
+            return None, None
         except subprocess.CalledProcessError as e:
-            logger.error(f"❌ Clone failed for {repo_full_name}: {e.stderr}")
-            return None
+            logger.error(f"❌ Fetch failed for {repo_full_name}: {e.stderr}")
+            return None, None
         except Exception as e:
-            logger.error(f"❌ Clone error for {repo_full_name}: {e}")
-            return None
+            logger.error(f"❌ Fetch error for {repo_full_name}: {e}")
+            return None, None
 
-    def build_docker_image(self, repo_dir, repo_full_name, branch):
-        """Dockerイメージをビルド"""
+    def build_docker_image(self, repo_dir, repo_full_name, branch, job=None, base_image=None):
+        """Dockerイメージをビルド（コンテキストが同じなら既存イメージを再利用）"""
         if not self.docker_client:
             logger.error("❌ Docker client not available")
             return None
@@ -173,265 +448,1270 @@ class ForgejoGradioManager:
                 logger.error(f"❌ Dockerfile not found in {repo_dir}")
                 return None
             
-            # イメージ名
-            image_name = f"gradio-{repo_full_name.replace('/', '-').lower()}-{branch}"
-            logger.info(f"🔨 Building Docker image: {image_name}")
+            # イメージ名（タグはビルドコンテキストのダイジェスト）
+            image_name = self.container_name_for(repo_full_name, branch)
+            context = BuildContext(repo_dir)
+            dockerfile, base_id = self.base_images.prepare(repo_dir, base_image, job)
+            if dockerfile:
+                context.override('Dockerfile', dockerfile)
+            context.check_size(job)
+            # ベースイメージが更新されたら、コンテキストが同じでも作り直す
+            digest = context.digest(base_id)
+            image_tag = f"{image_name}:ctx-{digest[:16]}"
             
-            # ビルド
-            image, build_logs = self.docker_client.images.build(
-                path=repo_dir,
-                tag=image_name,
-                rm=True,
-                forcerm=True
-            )
+            if self.image_exists(image_tag):
+                logger.info(f"♻️  Build context unchanged, reusing image: {image_tag}")
+                if job:
+                    job.log_line(f"Build context unchanged, reusing image {image_tag}")
+                self.docker_client.images.get(image_tag).tag(image_name, 'latest')
+                return image_tag
+            
+            # 前回のイメージをレイヤーキャッシュとして使う
+            previous = f"{image_name}:latest" if self.image_exists(f"{image_name}:latest") else None
+            logger.info(f"🔨 Building Docker image: {image_tag}" + (f" (cache from {previous})" if previous else ""))
+            
+            if self.buildkit:
+                built = self.build_with_cli(context, image_tag, previous, job)
+            else:
+                built = self.build_with_api(context, image_tag, previous, job)
+            if not built:
+                return None
             
-            logger.info(f"✅ Build successful: {image_name}")
-            return image_name
+            self.docker_client.images.get(image_tag).tag(image_name, 'latest')
+            self.prune_build_cache(image_name)
             
+            logger.info(f"✅ Build successful: {image_tag}")
+            return image_tag
+            
+        except DeployCancelled:
+            raise
+        except BuildContextTooLarge as e:
+            logger.error(f"❌ {e}")
+            if job:
+                job.log_line(str(e))
+            return None
         except Exception as e:
             logger.error(f"❌ Build error: {e}")
             return None
 
-    def get_available_port(self):
-        """利用可能なポートを取得（改良版）"""
-        # 現在使用中のポートを確認
-        used_ports = {app.get('port') for app in self.apps.values() if app.get('port')}
-        logger.info(f"🔍 Currently used ports: {used_ports}")
+    def image_exists(self, image_tag):
+        """ローカルにイメージがあるか"""
+        try:
+            self.docker_client.images.get(image_tag)
+            return True
+        except docker.errors.ImageNotFound:
+            return False
+
+    def image_id(self, image_tag):
+        """イメージのID（なければ None）"""
+        try:
+            return self.docker_client.images.get(image_tag).id
+        except docker.errors.ImageNotFound:
+            return None
+
+    def prune_base_images(self, keep):
+        """ベースイメージ（gradio-pages.base ラベル付き）のうち keep 以外を削除（アプリのイメージが使っているものは残る）"""
+        if not self.docker_client:
+            return
+        for image in self.docker_client.images.list(filters={'label': 'gradio-pages.base'}):
+            if image.id in keep:
+                continue
+            for ref in image.tags or [image.id]:
+                try:
+                    self.docker_client.images.remove(ref, noprune=False)
+                    logger.info(f"🧽 Pruned old base image: {ref}")
+                except docker.errors.APIError as e:
+                    logger.debug(f"Keeping base image {ref}: {e}")
+
+    def build_base_image(self, context, image_tag, fresh=False):
+        """ベースイメージをビルド（fresh なら元イメージを pull し、キャッシュを使わない）"""
+        if not self.docker_client:
+            return False
+        if self.buildkit:
+            return self.build_with_cli(context, image_tag, None, fresh=fresh)
+        return self.build_with_api(context, image_tag, None, fresh=fresh)
+
+    def build_with_api(self, context, image_tag, previous, job=None, fresh=False):
+        """docker-py の低レベルAPIでビルド（コンテキストは tar をチャンク転送、古くなったビルドは中断）"""
+        build_stream = self.docker_client.api.build(
+            fileobj=context.stream(),
+            custom_context=True,
+            tag=image_tag,
+            rm=True,
+            forcerm=True,
+            cache_from=[previous] if previous else None,
+            nocache=fresh,
+            pull=fresh,
+            decode=True
+        )
+        try:
+            for chunk in build_stream:
+                if job:
+                    # ストリームを閉じるとデーモン側のビルドもキャンセルされる
+                    job.check_cancelled()
+                    for line in (chunk.get('stream') or chunk.get('status') or '').splitlines():
+                        if line.strip():
+                            job.log_line(line)
+                if 'error' in chunk:
+                    logger.error(f"❌ Build error: {chunk['error'].strip()}")
+                    if job:
+                        job.log_line(chunk['error'].strip())
+                    return False
+        finally:
+            build_stream.close()
+        return True
+
+    def build_with_cli(self, context, image_tag, previous, job=None, fresh=False):
+        """docker CLI + BuildKit でビルド（インラインキャッシュ付き、コンテキストは標準入力へ tar で送る）"""
+        cmd = [
+            'docker', 'build',
+            '--progress=plain',
+            '--tag', image_tag,
+            '--build-arg', 'BUILDKIT_INLINE_CACHE=1'
+        ]
+        if previous:
+            cmd += ['--cache-from', previous]
+        if fresh:
+            cmd += ['--no-cache', '--pull']
+        cmd.append('-')
         
-        for port in range(self.port_start, self.port_end + 1):
-            if port not in used_ports and self.is_port_available(port):
-                logger.info(f"✅ Found available port: {port}")
-                return port
-                
-        logger.error(f"❌ No available ports in range {self.port_start}-{self.port_end}")
-        return None
+        process = subprocess.Popen(
+            cmd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            env={**os.environ, 'DOCKER_BUILDKIT': '1'}
+        )
+        
+        def send_context():
+            try:
+                for chunk in context.stream():
+                    process.stdin.write(chunk)
+            except (BrokenPipeError, OSError):
+                # ビルドが中断された
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except OSError:
+                    pass
+        
+        sender = threading.Thread(target=send_context, daemon=True)
+        sender.start()
+        last_lines = []
+        try:
+            for line in process.stdout:
+                last_lines = (last_lines + [line.rstrip()])[-20:]
+                if job:
+                    job.log_line(line.rstrip())
+                    if job.cancelled:
+                        process.kill()
+                        job.check_cancelled()
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+            sender.join()
+        
+        if returncode != 0:
+            logger.error("❌ Build error:\n" + "\n".join(last_lines))
+            return False
+        return True
 
-    def deploy_app(self, repo_full_name, branch='main'):
-        """アプリをデプロイ（改良版）"""
+    def prune_build_cache(self, image_name, client=None):
+        """古いダイジェストタグのイメージを削除（直近 build_cache_keep 件は残す、client は転送先ノード）"""
+        client = client or self.docker_client
+        try:
+            images = client.images.list(name=image_name)
+            tagged = []
+            for image in images:
+                for tag in image.tags:
+                    if tag.startswith(f"{image_name}:ctx-"):
+                        tagged.append((image.attrs.get('Created', ''), tag))
+            tagged.sort(reverse=True)
+            for _, tag in tagged[self.build_cache_keep:]:
+                try:
+                    # 使用中のイメージは force なしでは消えないのでそのまま残る
+                    client.images.remove(tag, noprune=False)
+                    logger.info(f"🧽 Pruned old image: {tag}")
+                except docker.errors.APIError as e:
+                    logger.debug(f"Keeping image {tag}: {e}")
+        except Exception as e:
+            logger.warning(f"Failed to prune build cache for {image_name}: {e}")
+
+    def reserve_app_port(self, app_info):
+        """ホストポートを使うレプリカのポートを配置先ノードで予約済みにする"""
+        for replica in app_info.get('replicas', []):
+            host = self.hosts.get(replica.get('node'))
+            if host and replica.get('port') and replica.get('host') == host.address:
+                host.ports.reserve(replica['port'], replica['container_name'])
+
+    def allocate_target(self, container_name, node=None):
+        """新しいコンテナの接続先 (host, port) を配置先ノードで決める"""
+        host = self.hosts.get(node)
+        if host.network:
+            return container_name, GRADIO_CONTAINER_PORT
+        port = host.ports.allocate(container_name)
+        return (host.address, port) if port else None
+
+    def forget_target(self, replica):
+        """レプリカの接続先への接続（プロキシのコネクションプール等）を破棄"""
+        for listener in self.target_listeners:
+            listener(replica.get('host'), replica.get('port'))
+
+    def release_target(self, replica):
+        """レプリカの接続先を手放し、ホストポートを解放（ネットワークモードではポートの解放はしない）"""
+        self.forget_target(replica)
+        host = self.hosts.get(replica.get('node'))
+        if host and replica.get('host') == host.address:
+            host.ports.release(replica.get('port'))
+
+    def deploy_app(self, repo_full_name, branch='main', job=None):
+        """アプリをデプロイ（スケジューラーのワーカーから呼ばれる）"""
         logger.info(f"🚀 Starting deployment: {repo_full_name}:{branch}")
         
         if not self.docker_client:
             return False, "Docker client not available"
+        
+        # スケジューラー外からの呼び出しでもフェーズを記録できるようにする
+        job = job or DeployJob(repo_full_name, branch, source='direct')
             
         try:
             repo_id = f"{repo_full_name}:{branch}"
             
-            # 既存アプリを停止
-            if repo_id in self.apps:
+            previous = self.apps.get(repo_id)
+            
+            # recreate モードでは従来通り先に停止（blue/green では旧コンテナで配信を継続）
+            if previous and self.deploy_strategy == 'recreate':
                 logger.info(f"🛑 Stopping existing app: {repo_id}")
                 self.stop_app(repo_id)
+                previous = None
             
             # リポジトリクローン
-            repo_dir = self.clone_repository(repo_full_name, branch)
+            with job.phase('clone'):
+                repo_dir, commit = self.clone_repository(repo_full_name, branch, job.commit)
             if not repo_dir:
                 return False, "Failed to clone repository"
+            job.commit = commit
+            job.log_line(f"Checked out {commit}")
+            job.check_cancelled()
             
             # 必須ファイルの確認
-            required_files = ['Dockerfile', 'app.py', 'requirements.txt']
-            for file in required_files:
-                file_path = os.path.join(repo_dir, file)
-                if not os.path.exists(file_path):
-                    logger.error(f"❌ Required file missing: {file}")
-                    return False, f"Required file missing: {file}"
-                logger.info(f"✅ Found required file: {file}")
+            with job.phase('checks'):
+                required_files = ['Dockerfile', 'app.py', 'requirements.txt']
+                for file in required_files:
+                    file_path = os.path.join(repo_dir, file)
+                    if not os.path.exists(file_path):
+                        logger.error(f"❌ Required file missing: {file}")
+                        return False, f"Required file missing: {file}"
+                    logger.info(f"✅ Found required file: {file}")
+                repo_config = self.read_repo_config(repo_dir, job)
+                repo_limits = self.read_repo_limits(repo_config, job)
+                resources = effective_resources(self.read_repo_resources(repo_config, job))
             
             # Dockerイメージビルド
-            image_name = self.build_docker_image(repo_dir, repo_full_name, branch)
+            with job.phase('build'):
+                image_name = self.build_docker_image(
+                    repo_dir, repo_full_name, branch, job, base_image=repo_config.get('base_image')
+                )
             if not image_name:
                 return False, "Failed to build Docker image"
+            job.check_cancelled()
             
-            # ポート取得
-            port = self.get_available_port()
-            if not port:
-                return False, "No available ports"
+            # 旧コンテナと反対側のスロットで新しいコンテナを起動
+            slot = 'green' if previous and previous.get('slot') == 'blue' else 'blue'
+            replica_count = job.replicas or (previous or {}).get('replica_count') or self.default_replicas
+            replica_count = max(1, min(replica_count, self.max_replicas))
             
-            logger.info(f"🔌 Using port: {port}")
+            # 旧コンテナと並んで動く間もホストのメモリを超えないよう、配置先ノードで新しいレプリカの分を予約
+            with job.phase('capacity'):
+                nodes, reason = self.hosts.reserve(
+                    job.id, resources['memory'], replica_count, self.capacity_wait, job, repo_id
+                )
+            if not nodes:
+                logger.error(f"❌ Not enough host memory for {repo_id}: {reason}")
+                return False, f"Not enough host memory: {reason}"
             
-            # コンテナ起動
-            container_name = f"gradio-{repo_full_name.replace('/', '-')}-{branch}".lower()
+            # 準備完了までは旧コンテナへルーティングしたまま待つ
+            replicas, reason = self.start_replicas(image_name, repo_full_name, branch, slot, nodes, job, resources)
+            if not replicas:
+                logger.error(f"❌ New containers not ready for {repo_id}: {reason}")
+                return False, f"Container failed readiness check: {reason}"
             
-            # 既存コンテナを削除
-            try:
-                old_container = self.docker_client.containers.get(container_name)
-                old_container.remove(force=True)
-                logger.info(f"🗑️  Removed old container: {container_name}")
-            except docker.errors.NotFound:
-                pass
-            
-            # 新しいコンテナを起動
-            logger.info(f"🐳 Starting container: {container_name}")
-            
-            container = self.docker_client.containers.run(
-                image_name,
-                name=container_name,
-                ports={'7860/tcp': port},
-                environment={
-                    'GRADIO_SERVER_NAME': '0.0.0.0',
-                    'GRADIO_SERVER_PORT': '7860',
-                    'GRADIO_ROOT_PATH': f'/{repo_full_name}'
-                },
-                detach=True,
-                restart_policy={'Name': 'unless-stopped'}
-                # ネットワーク指定を削除 - デフォルトネットワークを使用
-            )
+            # ルーティングをアトミックに切り替え
+            now = datetime.now().isoformat()
+            with self.apps_lock:
+                # 起動待ちの間に取り消された（ブランチ削除・PRクローズ等）なら切り替えない
+                # discard_app は取り消し後に apps_lock を取るので、ここを過ぎた分は stop_app が片付ける
+                cancelled = job.cancelled
+                if not cancelled:
+                    previous = self.apps.get(repo_id)
+                    app_info = {
+                        'slot': slot,
+                        'status': 'running',
+                        'created': previous.get('created', now) if previous else now,
+                        'last_updated': now,
+                        'image': image_name,
+                        'repo_full_name': repo_full_name,
+                        'branch': branch,
+                        'replica_count': replica_count,
+                        'limits': (previous or {}).get('limits'),
+                        'repo_limits': repo_limits,
+                        'resources': resources
+                    }
+                    self.set_replicas(app_info, replicas)
+                    self.apps[repo_id] = app_info
+            if cancelled:
+                logger.info(f"✋ {repo_id} was cancelled before the switch, removing new containers")
+                for replica in replicas:
+                    self.retire_container(replica)
+                job.check_cancelled()
+            # 起動したレプリカは node_usage 側で数える
+            self.hosts.release(job.id)
             
-            # アプリ情報を保存
-            self.apps[repo_id] = {
-                'container': container,
-                'port': port,
-                'status': 'running',
-                'created': datetime.now().isoformat(),
-                'last_updated': datetime.now().isoformat(),
-                'image': image_name,
-                'repo_full_name': repo_full_name,
-                'branch': branch
-            }
+            self.save_app(repo_id)
+            # 旧イメージのアセットはもう返さないので先に解放
+            self.asset_cache.invalidate(repo_id, keep_version=image_name)
             
-            self.save_apps_state()
+            # 旧コンテナは処理中のリクエストを待ってから削除
+            if previous:
+                for replica in previous.get('replicas', []):
+                    if replica.get('container'):
+                        self.drain_container(replica)
+                    else:
+                        # コンテナが見つからなかったレプリカはポートの予約だけ外す
+                        self.release_target(replica)
+            # ビルドノード以外へ転送した古いイメージを片付ける
+            for node in {r['node'] for r in replicas} - {self.hosts.build_host.name}:
+                self.prune_build_cache(self.container_name_for(repo_full_name, branch), self.hosts.client(node))
             
-            logger.info(f"🎉 Successfully deployed {repo_id} on port {port}")
-            return True, f"App deployed successfully on port {port}"
+            targets = ', '.join(f"{r['host']}:{r['port']}" for r in replicas)
+            logger.info(f"🎉 Successfully deployed {repo_id} ({replica_count} replica(s): {targets})")
+            return True, f"App deployed successfully with {replica_count} replica(s) on {targets}"
             
+        except DeployCancelled as e:
+            logger.info(f"✋ {e}")
+            return False, str(e)
         except Exception as e:
             logger.error(f"❌ Deployment error for {repo_full_name}: {e}")
             return False, str(e)
 
+    def read_repo_config(self, repo_dir, job=None):
+        """リポジトリの設定ファイル（gradio-pages.yml）を読む（読めなければ空の設定でデプロイは続ける）"""
+        for name in REPO_CONFIG_FILES:
+            path = os.path.join(repo_dir, name)
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, 'r') as f:
+                    config = yaml.safe_load(f) or {}
+            except (OSError, yaml.YAMLError) as e:
+                logger.warning(f"⚠️  Ignoring {name}: {e}")
+                if job:
+                    job.log_line(f"Ignoring {name}: {e}")
+                return {}
+            if not isinstance(config, dict):
+                logger.warning(f"⚠️  Ignoring {name}: not a mapping")
+                if job:
+                    job.log_line(f"Ignoring {name}: not a mapping")
+                return {}
+            config['_file'] = name
+            return config
+        return {}
+
+    def read_repo_limits(self, config, job=None):
+        """設定ファイルの limits を検証する（不正な内容は無視してデプロイは続ける）"""
+        name = config.get('_file')
+        limits, error = validate_limits(config.get('limits', {}))
+        if error:
+            logger.warning(f"⚠️  Ignoring limits in {name}: {error}")
+            if job:
+                job.log_line(f"Ignoring limits in {name}: {error}")
+            return None
+        if job and limits:
+            job.log_line(f"Limits from {name}: {limits}")
+        return limits or None
+
+    def read_repo_resources(self, config, job=None):
+        """設定ファイルの resources を検証する（不正な内容は無視して既定値で起動）"""
+        name = config.get('_file')
+        resources, error = validate_resources(config.get('resources', {}))
+        if error:
+            logger.warning(f"⚠️  Ignoring resources in {name}: {error}")
+            if job:
+                job.log_line(f"Ignoring resources in {name}: {error}")
+            return None
+        if job and resources:
+            job.log_line(f"Resources from {name}: {resources}")
+        return resources or None
+
+    def node_usage(self, node):
+        """ノード上の起動済みレプリカのメモリ上限の合計とレプリカ数（制限のない旧アプリは既定値で見積もる）"""
+        default_memory = None
+        total = 0
+        replicas = 0
+        with self.apps_lock:
+            for app_info in self.apps.values():
+                count = sum(1 for r in app_info.get('replicas') or [] if r.get('node') == node)
+                if not count:
+                    continue
+                resources = app_info.get('resources')
+                if resources is None:
+                    if default_memory is None:
+                        default_memory = effective_resources()['memory']
+                    memory = default_memory
+                else:
+                    memory = resources.get('memory', 0)
+                total += count * memory
+                replicas += count
+        return total, replicas
+
+    def start_replicas(self, image_name, repo_full_name, branch, slot, nodes, job=None, resources=None):
+        """nodes（レプリカ毎の配置先ノード）の台数だけ起動して全台の準備完了を待つ（失敗時は全て片付ける）"""
+        replicas = []
+        try:
+            # ビルドノード以外の配置先へはイメージを転送しておく
+            with job.phase('distribute') if job else nullcontext():
+                for node in dict.fromkeys(nodes):
+                    self.hosts.ensure_image(node, image_name, job)
+            
+            with job.phase('allocate') if job else nullcontext():
+                for index, node in enumerate(nodes):
+                    container_name = self.replica_name(repo_full_name, branch, slot, index)
+                    target = self.allocate_target(container_name, node)
+                    if not target:
+                        return None, f"No available ports on {node}"
+                    host, port = target
+                    replicas.append({
+                        'container_name': container_name, 'node': node, 'host': host, 'port': port, 'status': 'starting'
+                    })
+            
+            with job.phase('start') if job else nullcontext():
+                for replica in replicas:
+                    logger.info(f"🔌 Using target: {replica['host']}:{replica['port']} ({replica['node']})")
+                    if job:
+                        job.log_line(f"Starting {replica['container_name']} on {replica['node']} ({replica['host']}:{replica['port']})")
+                    replica['container'] = self.start_container(
+                        image_name, replica['container_name'], repo_full_name, replica['port'], branch, resources,
+                        replica['node']
+                    )
+            
+            # 起動は並行して進むので、待つのは一番遅いレプリカの分だけ
+            with job.phase('ready') if job else nullcontext():
+                for replica in replicas:
+                    ready, reason = self.wait_until_ready(replica['container'], replica['host'], replica['port'], job)
+                    if not ready:
+                        return None, reason
+                    replica['status'] = 'running'
+            
+            started, replicas = replicas, None
+            return started, None
+        finally:
+            # 途中で失敗・中断した場合は起動済みのレプリカを削除
+            for replica in replicas or []:
+                if replica.get('container'):
+                    self.remove_container(replica['container'])
+                self.release_target(replica)
+
+    def start_container(self, image_name, container_name, repo_full_name, port, branch='main', resources=None, node=None):
+        """Gradioコンテナを配置先ノードで起動（同名の残骸があれば削除、リソース制限付き）"""
+        host = self.hosts.get(node)
+        try:
+            stale = host.client.containers.get(container_name)
+            stale.remove(force=True)
+            logger.info(f"🗑️  Removed old container: {container_name}")
+        except docker.errors.NotFound:
+            pass
+        
+        logger.info(f"🐳 Starting container: {container_name}")
+        
+        if host.network:
+            # ホストポートは公開せず、マネージャーと同じネットワークに参加
+            placement = {'network': host.network}
+        else:
+            placement = {'ports': {f'{GRADIO_CONTAINER_PORT}/tcp': port}}
+        
+        return host.client.containers.run(
+            image_name,
+            name=container_name,
+            labels={MANAGED_LABEL: 'true', 'gradio-pages.repo': repo_full_name},
+            **placement,
+            **container_options(resources or effective_resources()),
+            environment={
+                'GRADIO_SERVER_NAME': '0.0.0.0',
+                'GRADIO_SERVER_PORT': str(GRADIO_CONTAINER_PORT),
+                'GRADIO_ROOT_PATH': self.app_path(repo_full_name, branch)
+            },
+            detach=True,
+            restart_policy={'Name': 'unless-stopped'}
+            # ネットワーク指定を削除 - デフォルトネットワークを使用
+        )
+
+    def record_deploy(self, job):
+        """終了したデプロイを状態ストアへ保存"""
+        # 失敗・中断したデプロイのメモリ予約を返す
+        self.hosts.release(job.id)
+        if self.state_store:
+            self.state_store.put_deploy(job.key, job.to_dict(include_log=True))
+
+    @property
+    def is_owner(self):
+        """デプロイ・コンテナの起動停止をこのプロセスで行うか（単一ワーカーなら常に）"""
+        return self.owner is None or self.owner.is_owner
+
+    def run_on_owner(self, name, *args, **kwargs):
+        """オーナーのワーカーでメソッドを実行（オーナー自身ならそのまま呼ぶ）"""
+        if self.is_owner:
+            return getattr(self, name)(*args, **kwargs)
+        return self.owner.call(name, *args, **kwargs)
+
+    def dispatch_owner_call(self, name, args, kwargs):
+        """他のワーカーから転送された呼び出しを実行"""
+        if name not in OWNER_CALLS:
+            raise ValueError(f"Unknown owner call: {name}")
+        return getattr(self, name)(*args, **kwargs)
+
+    def start_owner_tasks(self):
+        """オーナー（単一ワーカーなら自身）だけで動かすスレッドを起動し、引き継ぐアプリ状態を取り込む"""
+        if self.shared_state:
+            self.sync_apps_state()
+        self.base_images.start()
+        if self.idle_timeout > 0:
+            threading.Thread(target=self.idle_reaper_loop, name='idle-reaper', daemon=True).start()
+            logger.info(f"💤 Idle reaper enabled (timeout: {self.idle_timeout}s)")
+
+    def base_image_status(self):
+        return self.base_images.to_dict()
+
+    def submit_deploy(self, repo_full_name, branch, commit=None, source='api', replicas=None):
+        """デプロイをスケジューラーへ投入し、(ジョブID, 合流したか) を返す"""
+        job, coalesced = self.scheduler.submit(repo_full_name, branch, commit=commit, source=source, replicas=replicas)
+        return job.id, coalesced
+
+    def scheduler_status(self):
+        return self.scheduler.status()
+
+    def live_jobs(self, key):
+        """スケジューラー上の repo:branch のジョブ（新しい順）"""
+        return [job.to_dict() for job in self.scheduler.jobs_for(key)]
+
+    def live_job(self, job_id):
+        """スケジューラー上のジョブ（ログ込み、なければ None）"""
+        job = self.scheduler.find(job_id)
+        return job.to_dict(include_log=True) if job else None
+
+    def read_job_log(self, job_id, index):
+        """スケジューラー上のジョブの index 行目以降のログ（行, 次の index, 終了済みか）。なければ None"""
+        job = self.scheduler.find(job_id)
+        return job.read_log(index) if job else None
+
+    def deploy_history(self, repo_full_name, branch='main', limit=20):
+        """待機中・実行中と終了済みのデプロイ（新しい順）"""
+        key = f"{repo_full_name}:{branch}"
+        deploys = self.run_on_owner('live_jobs', key)
+        if self.state_store:
+            # 再起動前や他ワーカーで実行されたデプロイは状態ストアから補う
+            seen = {job['id'] for job in deploys}
+            deploys += [job for job in self.state_store.load_deploys(key, limit) if job['id'] not in seen]
+            deploys.sort(key=lambda job: job['submitted_at'], reverse=True)
+        return deploys[:limit]
+
+    def get_deploy(self, job_id):
+        """IDでデプロイを取得（ログ込み）"""
+        job = self.run_on_owner('live_job', job_id)
+        if job:
+            return job
+        if self.state_store:
+            return self.state_store.get_deploy(job_id)
+        return None
+
+    def wait_until_ready(self, container, host, port, job=None):
+        """HTTPで応答するまでポーリング（コンテナが落ちたら即失敗）"""
+        url = f"http://{host}:{port}{self.readiness_path}"
+        deadline = time.monotonic() + self.readiness_timeout
+        logger.info(f"⏳ Waiting for readiness: {url}")
+        
+        while time.monotonic() < deadline:
+            if job and job.cancelled:
+                self.remove_container(container)
+                job.check_cancelled()
+            
+            container.reload()
+            if container.status in ('exited', 'dead'):
+                return False, f"container {container.status}"
+            
+            try:
+                resp = requests.get(url, timeout=2)
+                if resp.status_code < 500:
+                    logger.info(f"✅ Ready on port {port} (HTTP {resp.status_code})")
+                    return True, None
+            except requests.RequestException:
+                pass
+            time.sleep(self.readiness_interval)
+        
+        return False, f"timed out after {self.readiness_timeout}s"
+
+    def remove_container(self, container):
+        """コンテナを強制削除"""
+        try:
+            container.remove(force=True)
+            logger.info(f"🗑️  Removed container: {container.name}")
+        except Exception as e:
+            logger.warning(f"Failed to remove container: {e}")
+
+    def retire_container(self, replica):
+        """レプリカのコンテナを削除して接続先を解放"""
+        self.remove_container(replica['container'])
+        self.release_target(replica)
+        self.hosts.notify()
+
+    def drain_container(self, replica):
+        """切り替え後、ドレイン時間を置いて旧レプリカのコンテナを削除"""
+        logger.info(
+            f"🚰 Draining old container {replica['container'].name} "
+            f"({replica['host']}:{replica['port']} on {replica['node']}) for {self.drain_timeout}s"
+        )
+        timer = threading.Timer(self.drain_timeout, self.retire_container, args=(replica,))
+        timer.daemon = True
+        timer.start()
+
     def stop_app(self, repo_id):
         """アプリを停止"""
         try:
-            if repo_id in self.apps:
-                container = self.apps[repo_id].get('container')
-                if container:
-                    try:
-                        container.remove(force=True)
-                        logger.info(f"🗑️  Removed container: {container.name}")
-                    except Exception as e:
-                        logger.warning(f"Failed to remove container: {e}")
-                del self.apps[repo_id]
-                self.save_apps_state()
+            with self.apps_lock:
+                app_info = self.apps.pop(repo_id, None)
+            if app_info:
+                for replica in app_info.get('replicas', []):
+                    if replica.get('container'):
+                        self.remove_container(replica['container'])
+                    self.release_target(replica)
+                self.save_app(repo_id)
+                self.asset_cache.invalidate(repo_id)
+                self.hosts.notify()
                 logger.info(f"🛑 Stopped app: {repo_id}")
                 return True
         except Exception as e:
             logger.error(f"Error stopping app {repo_id}: {e}")
         return False
 
-    def get_app_port(self, repo_full_name, branch='main'):
-        """アプリのポートを取得"""
+    def remove_images(self, repo_full_name, branch):
+        """ブランチのイメージを全ノードから全タグ削除（プレビュー削除時）"""
+        image_name = self.container_name_for(repo_full_name, branch)
+        for host in self.hosts.hosts.values():
+            if host.client is None:
+                continue
+            try:
+                for image in host.client.images.list(name=image_name):
+                    for tag in image.tags:
+                        try:
+                            host.client.images.remove(tag, noprune=False)
+                            logger.info(f"🧽 Removed image: {tag}" + (f" on {host.name}" if host is not self.hosts.build_host else ""))
+                        except docker.errors.APIError as e:
+                            logger.debug(f"Keeping image {tag}: {e}")
+            except Exception as e:
+                logger.warning(f"Failed to remove images for {image_name} on {host.name}: {e}")
+
+    def discard_app(self, repo_full_name, branch, reason):
+        """ブランチのデプロイを取り消し、コンテナ・イメージ・worktreeまで削除"""
+        if not valid_repo_name(repo_full_name) or not valid_branch(branch):
+            logger.warning(f"⚠️  Ignoring discard of invalid target {repo_full_name!r}:{branch!r}")
+            return False
         repo_id = f"{repo_full_name}:{branch}"
+        self.scheduler.cancel(repo_id, reason)
+        stopped = self.stop_app(repo_id)
+        if self.docker_client:
+            self.remove_images(repo_full_name, branch)
+        self.repo_cache.remove_worktree(repo_full_name, branch)
+        logger.info(f"🧹 Discarded {repo_id}: {reason}")
+        return stopped
+
+    def make_room_for_preview(self, repo_full_name, branch):
+        """プレビューが上限に達していれば、最もアクセスの古いプレビューを削除"""
+        repo_id = f"{repo_full_name}:{branch}"
+        if self.shared_state:
+            self.sync_apps_state()
         if repo_id in self.apps:
-            app_info = self.apps[repo_id]
+            # 既存プレビューの更新は数が増えない
+            return
+        previews = sorted(
+            (
+                (self.last_access(other_id, app_info), app_info)
+                for other_id, app_info in list(self.apps.items())
+                if (app_info.get('branch') or '').startswith(PREVIEW_PREFIX)
+            ),
+            key=lambda item: item[0]
+        )
+        while previews and len(previews) >= self.preview_max:
+            _, app_info = previews.pop(0)
+            self.discard_app(
+                app_info['repo_full_name'], app_info['branch'],
+                f"Evicted to make room for preview {repo_id}"
+            )
+
+    def touch_app(self, repo_full_name, branch='main'):
+        """プロキシ経由のアクセス時刻を記録"""
+        app_info = self.apps.get(f"{repo_full_name}:{branch}")
+        if not app_info:
+            return
+        now = time.time()
+        last_flushed = app_info.get('access_flushed', 0)
+        app_info['last_access'] = now
+        
+        # マルチワーカー時は他ワーカーのリーパーにも見えるようファイルに残す（間引きあり、書き込みは access_flush_loop）
+        if self.shared_state and now - last_flushed > self.idle_check_interval / 2:
+            app_info['access_flushed'] = now
+            self.access_queue.put_nowait(f"{repo_full_name}:{branch}")
+
+    def access_flush_loop(self):
+        """touch_app が積んだアクセスをファイルの更新時刻に書き出す"""
+        while True:
+            repo_id = self.access_queue.get()
+            try:
+                os.makedirs(self.access_dir, exist_ok=True)
+                path = os.path.join(self.access_dir, repo_id.replace('/', '-'))
+                with open(path, 'a'):
+                    os.utime(path, None)
+            except OSError as e:
+                logger.warning(f"Failed to record access for {repo_id}: {e}")
+
+    def last_access(self, repo_id, app_info):
+        """最終アクセス時刻（未アクセスなら最終更新時刻）"""
+        last = app_info.get('last_access') or 0
+        if self.shared_state:
+            try:
+                path = os.path.join(self.access_dir, repo_id.replace('/', '-'))
+                last = max(last, os.path.getmtime(path))
+            except OSError:
+                pass
+        if not last and app_info.get('last_updated'):
+            last = datetime.fromisoformat(app_info['last_updated']).timestamp()
+        return last
+
+    def reap_idle_apps(self):
+        """一定時間アクセスのないアプリのコンテナを停止（イメージとルーティング情報は保持）"""
+        now = time.time()
+        for repo_id, app_info in list(self.apps.items()):
+            if app_info.get('status') != 'running':
+                continue
+            idle_for = now - self.last_access(repo_id, app_info)
+            if idle_for >= self.idle_timeout:
+                logger.info(f"💤 {repo_id} idle for {int(idle_for)}s, suspending")
+                self.suspend_app(repo_id)
+
+    def suspend_app(self, repo_id):
+        """コンテナを削除してポートを解放し、idle 状態にする"""
+        with self.apps_lock:
+            app_info = self.apps.get(repo_id)
+            if not app_info or app_info.get('status') != 'running':
+                return False
+            replicas = app_info['replicas']
+            self.set_replicas(app_info, [])
+            app_info['status'] = 'idle'
+        for replica in replicas:
+            if replica.get('container'):
+                self.remove_container(replica['container'])
+            self.release_target(replica)
+        self.save_app(repo_id)
+        self.hosts.notify()
+        return True
+
+    def is_app_suspended(self, repo_full_name, branch='main'):
+        """idle（または起動中）のアプリか"""
+        app_info = self.apps.get(f"{repo_full_name}:{branch}")
+        return bool(app_info) and app_info.get('status') in ('idle', 'starting')
+
+    def cold_start(self, repo_full_name, branch='main', wait=True):
+        """idle アプリを起動（同時要求は1回の起動にまとめる）し、wait 時は準備完了まで待つ"""
+        if not self.is_owner:
+            # 起動はオーナーが行い、このワーカーは状態の同期で準備完了を待つ
+            self.owner.call('cold_start', repo_full_name, branch, wait=False)
+            deadline = time.monotonic() + self.cold_start_timeout
+            while wait and time.monotonic() < deadline and self.is_app_suspended(repo_full_name, branch):
+                time.sleep(0.5)
+                self.sync_apps_state()
+            return self.get_app_target(repo_full_name, branch) if wait else None
+        repo_id = f"{repo_full_name}:{branch}"
+        with self.apps_lock:
+            app_info = self.apps.get(repo_id)
+            if not app_info:
+                return None
             if app_info.get('status') == 'running':
-                return app_info.get('port')
-        return None
+                return self.get_app_target(repo_full_name, branch)
+            event = self.cold_starts.get(repo_id)
+            if event is None:
+                event = threading.Event()
+                self.cold_starts[repo_id] = event
+                app_info['status'] = 'starting'
+                threading.Thread(target=self.resume_app, args=(repo_id, event), daemon=True).start()
+        
+        if not wait:
+            return None
+        event.wait(self.cold_start_timeout)
+        return self.get_app_target(repo_full_name, branch)
 
-    def list_apps(self):
-        """アプリ一覧を取得"""
+    def resume_app(self, repo_id, event):
+        """保持していたイメージからコンテナを起動し直す"""
+        app_info = self.apps[repo_id]
+        repo_full_name = app_info.get('repo_full_name')
+        branch = app_info.get('branch')
+        try:
+            image_name = app_info.get('image')
+            if not self.docker_client or not image_name or not self.image_exists(image_name):
+                # イメージが消えている場合は通常のデプロイで作り直す
+                logger.warning(f"⚠️  Image for {repo_id} not found, redeploying")
+                app_info['status'] = 'idle'
+                self.scheduler.submit(repo_full_name, branch, source='cold-start')
+                return
+            
+            logger.info(f"🥶 Cold starting {repo_id}")
+            started = time.perf_counter()
+            # 要求を待たせたまま容量待ちはしない
+            resources = app_info.get('resources') or effective_resources()
+            replica_count = app_info.get('replica_count', 1)
+            nodes, reason = self.hosts.reserve(
+                f"cold-start:{repo_id}", resources['memory'], replica_count, repo_id=repo_id
+            )
+            if not nodes:
+                logger.error(f"❌ Not enough host memory to cold start {repo_id}: {reason}")
+                app_info['status'] = 'idle'
+                return
+            replicas, reason = self.start_replicas(
+                image_name, repo_full_name, branch, app_info.get('slot') or 'blue', nodes, resources=resources
+            )
+            if not replicas:
+                logger.error(f"❌ Cold start failed for {repo_id}: {reason}")
+                app_info['status'] = 'idle'
+                return
+            
+            with self.apps_lock:
+                self.set_replicas(app_info, replicas)
+                app_info.update({'status': 'running', 'last_access': time.time()})
+            self.save_app(repo_id)
+            COLD_START_SECONDS.labels(repo_id).observe(time.perf_counter() - started)
+            logger.info(f"🔥 {repo_id} resumed with {len(replicas)} replica(s)")
+        except Exception as e:
+            logger.error(f"❌ Cold start error for {repo_id}: {e}")
+            app_info['status'] = 'idle'
+        finally:
+            self.hosts.release(f"cold-start:{repo_id}")
+            with self.apps_lock:
+                self.cold_starts.pop(repo_id, None)
+            event.set()
+
+    def idle_reaper_loop(self):
+        while True:
+            time.sleep(self.idle_check_interval)
+            try:
+                if self.shared_state:
+                    self.sync_apps_state()
+                self.reap_idle_apps()
+            except Exception as e:
+                logger.error(f"Idle reaper error: {e}")
+
+    def start_background_tasks(self):
+        """バックグラウンドスレッドを起動（fork後のワーカーでも呼ぶ）"""
+        if self.background_started:
+            return
+        self.background_started = True
+        # コンテナ状態は各ノードの Docker events から更新（リクエスト毎の reload をしない）
+        self.hosts.watch(self.on_container_event)
+        if self.shared_state:
+            threading.Thread(target=self.access_flush_loop, name='access-flush', daemon=True).start()
+        # ベースイメージの更新・アイドル停止はオーナーになったワーカーだけで行う
+        if self.owner:
+            self.owner.start()
+        else:
+            self.start_owner_tasks()
+
+    def get_app_target(self, repo_full_name, branch='main'):
+        """アプリの接続先 (host, port) を取得（稼働中の最初のレプリカ）"""
+        replicas = self.get_app_replicas(repo_full_name, branch)
+        running = [r for r in replicas if r.get('status') == 'running']
+        return (running[0]['host'], running[0]['port']) if running else None
+
+    def get_app_replicas(self, repo_full_name, branch='main'):
+        """稼働中アプリのレプリカ一覧（プロキシの振り分け用）"""
+        self.refresh_routes()
+        app_info = self.apps.get(f"{repo_full_name}:{branch}")
+        if not app_info or app_info.get('status') != 'running':
+            return []
+        return app_info['replicas']
+
+    def get_app_limits(self, repo_full_name, branch='main'):
+        """アプリの制限（API・設定ファイルの指定と実際に使う値、現在の処理中・待ち数）"""
+        repo_id = f"{repo_full_name}:{branch}"
+        if self.shared_state:
+            self.sync_apps_state()
+        app_info = self.apps.get(repo_id)
+        if not app_info:
+            return None
         return {
-            repo_id: {
-                'port': info.get('port'),
-                'status': info.get('status'),
-                'created': info.get('created'),
-                'last_updated': info.get('last_updated'),
-                'repo_full_name': info.get('repo_full_name'),
-                'branch': info.get('branch')
-            }
-            for repo_id, info in self.apps.items()
+            'limits': app_info.get('limits') or {},
+            'repo_limits': app_info.get('repo_limits') or {},
+            'effective': self.admission.effective(app_info),
+            **self.admission.status(repo_id),
         }
 
-    def health_check(self):
-        """ヘルスチェック"""
-        healthy_apps = 0
+    def set_app_limits(self, repo_full_name, branch, limits):
+        """API から制限を上書き（None の項目は指定を外す）"""
+        repo_id = f"{repo_full_name}:{branch}"
+        with self.apps_lock:
+            app_info = self.apps.get(repo_id)
+            if not app_info:
+                return None
+            merged = dict(app_info.get('limits') or {})
+            for key, value in limits.items():
+                if value is None:
+                    merged.pop(key, None)
+                else:
+                    merged[key] = value
+            app_info['limits'] = merged or None
+        self.save_app(repo_id)
+        logger.info(f"🚦 Updated limits for {repo_id}: {merged}")
+        return self.get_app_limits(repo_full_name, branch)
+
+    def get_app_image(self, repo_full_name, branch='main'):
+        """アプリが使っているイメージ（アセットキャッシュのキー用）"""
+        app_info = self.apps.get(f"{repo_full_name}:{branch}")
+        return app_info.get('image') if app_info else None
+
+    def get_app_port(self, repo_full_name, branch='main'):
+        """アプリのポートを取得"""
+        target = self.get_app_target(repo_full_name, branch)
+        return target[1] if target else None
+
+    def app_summary(self, info):
+        """API・ダッシュボード向けのアプリ概要"""
+        return {
+            'host': info.get('host'),
+            'port': info.get('port'),
+            'status': info.get('status'),
+            'replicas': [
+                {
+                    'container_name': r['container_name'], 'node': r.get('node'),
+                    'host': r['host'], 'port': r['port'], 'status': r.get('status')
+                }
+                for r in info.get('replicas', [])
+            ],
+            'created': info.get('created'),
+            'last_updated': info.get('last_updated'),
+            'repo_full_name': info.get('repo_full_name'),
+            'branch': info.get('branch'),
+            'resources': info.get('resources'),
+            'url': f"{self.app_path(info.get('repo_full_name'), info.get('branch'))}/"
+        }
+
+    def list_apps(self):
+        """アプリ一覧を取得（メモリ上の状態のみ、Docker には問い合わせない）"""
+        if self.shared_state:
+            self.sync_apps_state()
+        with self.apps_lock:
+            return {repo_id: self.app_summary(info) for repo_id, info in self.apps.items()}
+
+    def on_container_event(self, container_name, action, node=None):
+        """コンテナイベント（node はイベントの届いたノード）をレプリカ・アプリの状態へ反映"""
+        with self.apps_lock:
+            for repo_id, app_info in self.apps.items():
+                replica = next(
+                    (
+                        r for r in app_info.get('replicas', [])
+                        if r['container_name'] == container_name and (node is None or r.get('node') == node)
+                    ),
+                    None
+                )
+                if replica is None:
+                    continue
+                # idle/起動中のアプリはリーパー・コールドスタート側で管理する
+                if app_info.get('status') in ('idle', 'starting'):
+                    return
+                
+                status = replica.get('status')
+                if action == 'start' or action == 'health_status: healthy':
+                    status = 'running'
+                elif action == 'health_status: unhealthy':
+                    status = 'unhealthy'
+                elif action == 'oom':
+                    status = 'error'
+                elif action in ('die', 'destroy') and status != 'error':
+                    status = 'stopped'
+                
+                if status != replica.get('status'):
+                    logger.info(f"📣 {repo_id} ({container_name}): {action} → {status}")
+                    replica['status'] = status
+                    self.refresh_app_status(app_info)
+                return
+
+    def refresh_container_status(self):
+        """events を購読できていない時のフォールバック（コンテナ毎に reload）"""
         for repo_id, app_info in self.apps.items():
-            try:
-                container = app_info.get('container')
-                if container:
-                    container.reload()
-                    if container.status == 'running':
-                        healthy_apps += 1
-                        app_info['status'] = 'running'
+            if app_info.get('status') in ('idle', 'starting'):
+                continue
+            for replica in app_info.get('replicas', []):
+                try:
+                    container = replica.get('container')
+                    if container:
+                        container.reload()
+                        replica['status'] = 'running' if container.status == 'running' else 'stopped'
                     else:
-                        app_info['status'] = 'stopped'
-                else:
-                    app_info['status'] = 'stopped'
-            except Exception as e:
-                logger.error(f"Health check failed for {repo_id}: {e}")
-                app_info['status'] = 'error'
+                        replica['status'] = 'stopped'
+                except Exception as e:
+                    logger.error(f"Health check failed for {replica['container_name']}: {e}")
+                    replica['status'] = 'error'
+            self.refresh_app_status(app_info)
+
+    def health_check(self):
+        """ヘルスチェック（イベントで更新済みのメモリ上の状態から集計）"""
+        if self.shared_state:
+            self.sync_apps_state()
+        events_connected = self.hosts.events_connected()
+        if not events_connected:
+            self.refresh_container_status()
         
+        statuses = [info.get('status') for info in self.apps.values()]
         return {
             'total_apps': len(self.apps),
-            'healthy_apps': healthy_apps,
+            'healthy_apps': statuses.count('running'),
+            'idle_apps': statuses.count('idle') + statuses.count('starting'),
             'timestamp': datetime.now().isoformat(),
-            'port_range': f"{self.port_start}-{self.port_end}"
+            'port_range': f"{self.port_start}-{self.port_end}",
+            'free_ports': self.hosts.free_ports(),
+            'memory': self.hosts.memory_status(),
+            'events_connected': events_connected,
+            'docker_hosts': self.hosts.status()
         }
 
 # Flask アプリケーション
 app = Flask(__name__)
 manager = ForgejoGradioManager()
+proxy = GradioProxy(manager.asset_cache)
+# 入れ替え・停止・スケールtoゼロで使わなくなった接続先のセッションを残さない
+manager.target_listeners.append(proxy.close_session)
+balancer = ReplicaBalancer()
+metrics_collector = register_manager(manager)
+# ダッシュボード・/api/apps 用のアプリ概要（変更のあったアプリだけ描き直す）
+feed = AppFeed(manager.list_apps, lambda summary: render_app_card(summary, manager.backend_host))
+
+def wants_html(req):
+    """ブラウザのページ遷移か（起動中ページを返してよいか）"""
+    return req.method == 'GET' and 'text/html' in req.headers.get('Accept', '')
+
+def render_starting_page(repo_full_name):
+    """コールドスタート中の案内ページ（自動リロード）"""
+    return f"""<!DOCTYPE html>
+<html>
+<head><meta http-equiv="refresh" content="2"><title>Starting {repo_full_name}...</title></head>
+<body style="font-family: Arial, sans-serif; margin: 40px;">
+    <h1>🚀 Starting {repo_full_name}...</h1>
+    <p>This app was sleeping and is being started. This page reloads automatically.</p>
+</body>
+</html>"""
+
+STARTING_HEADERS = {'Retry-After': '2', 'Cache-Control': 'no-store'}
+
+def lookup_asset(repo_full_name, branch, method, path, query, headers):
+    """静的アセットのキャッシュを引き、(保存用のキー, ヒット時の (ステータス, ヘッダ, ボディ)) を返す（Flask/ASGI共通）"""
+    cache = manager.asset_cache
+    if not cache.is_candidate(method, path, headers):
+        return None, None
+    key = cache_key(f"{repo_full_name}:{branch}", manager.get_app_image(repo_full_name, branch), path, query)
+    entry = cache.lookup(key)
+    if entry:
+        return None, cache.respond(entry, headers)
+    # HEAD のレスポンスはボディがないので保存しない
+    return (key if method == 'GET' else None), None
+
+def choose_replica(repo_full_name, branch, sticky=None, session_hash=None):
+    """振り分け先のレプリカと、固定用クッキーを設定すべきか（Flask/ASGI共通）"""
+    replicas = manager.get_app_replicas(repo_full_name, branch)
+    replica = balancer.pick(replicas, sticky, session_hash)
+    set_sticky = replica is not None and len(replicas) > 1 and sticky != replica['container_name']
+    return replica, set_sticky
 
 def proxy_to_gradio_app(repo_full_name, path, branch='main'):
-    """Gradioアプリにプロキシ"""
-    port = manager.get_app_port(repo_full_name, branch)
-    if not port:
-        return f"<h1>404 - Gradio App Not Found</h1><p>App '{repo_full_name}' is not deployed or not running.</p><p><a href='/'>← Back to Apps List</a></p>", 404
+    """Gradioアプリにプロキシ（ストリーミング・コネクションプール・レプリカ間の振り分け）"""
+    target = manager.get_app_target(repo_full_name, branch)
+    if not target and manager.is_app_suspended(repo_full_name, branch):
+        # ブラウザには即座に起動中ページ、API呼び出しは起動完了まで保留
+        if wants_html(request):
+            manager.cold_start(repo_full_name, branch, wait=False)
+            return render_starting_page(repo_full_name), 503, STARTING_HEADERS
+        target = manager.cold_start(repo_full_name, branch, wait=True)
+    if not target:
+        return f"<h1>404 - Gradio App Not Found</h1><p>App '{repo_full_name}' ({branch}) is not deployed or not running.</p><p><a href='/'>← Back to Apps List</a></p>", 404
+    
+    manager.touch_app(repo_full_name, branch)
+    
+    # JS/CSS等はキャッシュから返し、上流へは送らない
+    asset_key = None
+    if not is_websocket_request(request):
+        asset_key, cached = lookup_asset(
+            repo_full_name, branch, request.method, path, request.query_string.decode('latin-1'), request.headers
+        )
+        if cached:
+            status, headers, body = cached
+            return Response(body, status=status, headers=headers)
+    
+    # Gradioのセッション（キュー/SSE）は同じレプリカへ固定する
+    cached_body = None
+    if wants_session_body(request.method, path, request.content_type, request.content_length):
+        cached_body = request.get_data(cache=True)
+    session_hash = gradio_session_hash(path, request.args.get('session_hash'), cached_body)
     
+    # アプリ・クライアント毎の上限を超えたら上流へ送らずに返す
+    app_label = f"{repo_full_name}:{branch}"
+    ticket, rejection = manager.admission.admit(
+        app_label,
+        manager.admission.client_id(request.remote_addr, request.headers.get('X-Forwarded-For')),
+        manager.admission.effective(manager.apps.get(app_label) or {}),
+        streaming=is_websocket_request(request) or is_streaming_request(request, path)
+    )
+    if rejection:
+        return f"<h1>{rejection.status} - {rejection.message}</h1><p>Please retry in {rejection.retry_after}s.</p>", rejection.status, rejection.headers
+    
+    replica, set_sticky = choose_replica(repo_full_name, branch, request.cookies.get(STICKY_COOKIE), session_hash)
+    if not replica:
+        manager.admission.release(ticket)
+        return f"<h1>503 - No Healthy Replica</h1><p>App '{repo_full_name}' has no healthy replica.</p>", 503
+    
+    def finish():
+        balancer.release(replica)
+        manager.admission.release(ticket)
+    
+    balancer.acquire(replica)
     try:
-        target_url = f"http://192.168.0.131:{port}{path}"
-        
-        if request.method == 'GET':
-            resp = requests.get(target_url, params=request.args, timeout=30)
-        elif request.method == 'POST':
-            resp = requests.post(target_url, 
-                               data=request.get_data(),
-                               headers={'Content-Type': request.content_type},
-                               timeout=30)
-        else:
-            resp = requests.request(request.method, target_url, 
-                                  data=request.get_data(),
-                                  headers={'Content-Type': request.content_type},
-                                  timeout=30)
-        
-        return Response(resp.content, status=resp.status_code, headers=dict(resp.headers))
+        host, port = replica['host'], replica['port']
+        if is_websocket_request(request):
+            try:
+                return proxy.tunnel_websocket(request, host, port, path, app_label=app_label)
+            finally:
+                finish()
+        response = proxy.forward(request, host, port, path, prefix=manager.app_path(repo_full_name, branch), app_label=app_label, cached_body=cached_body, cache_key=asset_key, on_close=finish)
         
     except Exception as e:
+        if not is_websocket_request(request):
+            finish()
+        if isinstance(e, (requests.ConnectionError, ConnectionError)):
+            balancer.eject(replica)
         logger.error(f"Proxy error for {repo_full_name}: {e}")
         return f"<h1>502 - Service Unavailable</h1><p>Error connecting to Gradio app: {str(e)}</p>", 502
 
-@app.route('/<username>/<repository>/')
-@app.route('/<username>/<repository>/<path:path>')
+    if set_sticky:
+        response.set_cookie(STICKY_COOKIE, replica['container_name'], path=f"{manager.app_path(repo_full_name, branch)}/", httponly=True, samesite='Lax')
+    return response
+
+PROXY_METHODS = ['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS']
+
+@app.route('/<username>/<repository>/', methods=PROXY_METHODS)
+@app.route('/<username>/<repository>/<path:path>', methods=PROXY_METHODS)
+@app.route('/<username>/<repository>/', websocket=True)
+@app.route('/<username>/<repository>/<path:path>', websocket=True)
 def serve_gradio_app(username, repository, path=''):
-    """Gradioアプリを提供（パスベース）"""
+    """Gradioアプリを提供（パスベース、main 以外のブランチは /@<branch>/ 配下）"""
     repo_full_name = f"{username}/{repository}"
+    branch, path = manager.split_branch_path(repo_full_name, path)
+    if request.path == manager.app_path(repo_full_name, branch) and not is_websocket_request(request):
+        # 相対パスのアセットを解決できるよう末尾の / を付ける
+        query = request.query_string.decode()
+        return redirect(f"{request.path}/" + (f"?{query}" if query else ''), 308)
     if not path.startswith('/'):
         path = '/' + path
-    return proxy_to_gradio_app(repo_full_name, path)
+    return proxy_to_gradio_app(repo_full_name, path, branch)
+
+def start_deploy(repo_full_name, branch, commit=None, source='api', replicas=None):
+    """デプロイをスケジューラーへ投入（Flask/ASGI共通）"""
+    if not valid_repo_name(repo_full_name):
+        return {'status': 'error', 'message': f'Invalid repository name: {repo_full_name}'}, 400
+    if not valid_branch(branch):
+        return {'status': 'error', 'message': f'Invalid branch name: {branch}'}, 400
+    if replicas is not None:
+        if not isinstance(replicas, int) or not 1 <= replicas <= manager.max_replicas:
+            return {'status': 'error', 'message': f'replicas must be an integer between 1 and {manager.max_replicas}'}, 400
+    try:
+        job_id, coalesced = manager.run_on_owner('submit_deploy', repo_full_name, branch, commit, source, replicas)
+    except OwnerUnavailable as e:
+        return {'status': 'error', 'message': str(e)}, 503
+    
+    return {
+        'status': 'accepted',
+        'message': f'Deployment queued for {repo_full_name}:{branch}',
+        'job_id': job_id,
+        'coalesced': coalesced
+    }, 202
+
+def deploy_log_stream(job_id):
+    """デプロイログのストリーム（実行中は終了まで追従、なければ None）"""
+    job = manager.scheduler.find(job_id) if manager.is_owner else None
+    if job:
+        return (f"{line}\n" if line else '' for line in job.follow_log())
+    stored = manager.get_deploy(job_id)
+    if stored:
+        return iter([''.join(f"{line}\n" for line in stored.get('log', []))])
+    return None
+
+def handle_pull_request_event(data):
+    """PRのWebhookでプレビューをデプロイ（クローズ・マージ時は削除）"""
+    repo_full_name = data.get('repository', {}).get('full_name')
+    pull_request = data.get('pull_request') or {}
+    number = data.get('number') or pull_request.get('number')
+    action = data.get('action')
+    if not repo_full_name or not number:
+        return {'status': 'ignored', 'message': 'Pull request without repository or number'}, 200
+    if not str(number).isdigit():
+        return {'status': 'error', 'message': f'Invalid pull request number: {number}'}, 400
+    
+    branch = f"{PREVIEW_PREFIX}{number}"
+    if action == 'closed':
+        logger.info(f"🧹 Pull request closed, removing preview {repo_full_name}:{branch}")
+        manager.run_on_owner('discard_app', repo_full_name, branch, f"Pull request #{number} closed")
+        return {'status': 'success', 'message': f'Preview for #{number} removed'}, 200
+    
+    if action in ('opened', 'reopened', 'synchronized', 'synchronize'):
+        if manager.preview_max <= 0:
+            return {'status': 'ignored', 'message': 'Preview deployments are disabled'}, 200
+        logger.info(f"🔍 Processing pull request #{number} ({action}) for {repo_full_name}")
+        manager.run_on_owner('make_room_for_preview', repo_full_name, branch)
+        body, status = start_deploy(
+            repo_full_name, branch,
+            commit=pull_request.get('head', {}).get('sha'), source='preview'
+        )
+        body['url'] = f"{manager.app_path(repo_full_name, branch)}/"
+        return body, status
+    
+    return {'status': 'ignored', 'message': f'Pull request action {action} not handled'}, 200
+
+def handle_webhook_event(data, headers):
+    """Webhookペイロードを処理（Flask/ASGI共通）"""
+    event = headers.get('X-Forgejo-Event') or headers.get('X-Gitea-Event')
+    if event == 'pull_request':
+        return handle_pull_request_event(data)
+    
+    if event == 'delete' and data.get('ref_type') == 'branch':
+        # 削除されたブランチのデプロイを片付ける
+        repo_full_name = data.get('repository', {}).get('full_name')
+        if repo_full_name and data.get('ref'):
+            if not valid_branch(data['ref']):
+                return {'status': 'error', 'message': f"Invalid branch name: {data['ref']}"}, 400
+            manager.run_on_owner('discard_app', repo_full_name, data['ref'], 'Branch deleted')
+            return {'status': 'success', 'message': f"Removed deployment of {data['ref']}"}, 200
+    
+    if data.get('action') == 'push' or event == 'push':
+        repo_full_name = data.get('repository', {}).get('full_name')
+        ref = data.get('ref', 'refs/heads/main')
+        branch = ref.replace('refs/heads/', '')
+        
+        if repo_full_name:
+            logger.info(f"🔄 Processing push event for {repo_full_name}:{branch}")
+            return start_deploy(repo_full_name, branch, commit=data.get('after'), source='webhook')
+    
+    return {'status': 'ignored', 'message': 'Event not handled'}, 200
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
     """Forgejo Webhookエンドポイント"""
     try:
         logger.info("📧 Received webhook")
-        data = request.get_json()
-        
-        if data.get('action') == 'push' or request.headers.get('X-Forgejo-Event') == 'push':
-            repo_full_name = data.get('repository', {}).get('full_name')
-            ref = data.get('ref', 'refs/heads/main')
-            branch = ref.replace('refs/heads/', '')
-            
-            if repo_full_name:
-                logger.info(f"🔄 Processing push event for {repo_full_name}:{branch}")
-                
-                def deploy_async():
-                    success, message = manager.deploy_app(repo_full_name, branch)
-                    logger.info(f"📊 Deploy result for {repo_full_name}: {message}")
-                
-                threading.Thread(target=deploy_async, daemon=True).start()
-                
-                return jsonify({
-                    'status': 'accepted',
-                    'message': f'Deployment started for {repo_full_name}:{branch}'
-                }), 202
-        
-        return jsonify({'status': 'ignored', 'message': 'Event not handled'}), 200
+        body, status = handle_webhook_event(request.get_json(), request.headers)
+        return jsonify(body), status
         
     except Exception as e:
         logger.error(f"Webhook error: {e}")
@@ -439,9 +1719,23 @@ def webhook():
 
 @app.route('/api/apps', methods=['GET'])
 def list_apps():
-    """アプリ一覧API"""
-    logger.info("📋 Listing apps")
-    return jsonify(manager.list_apps())
+    """アプリ一覧API（owner / status / branch で絞り込み、limit / offset でページング、ETag 対応）"""
+    status, body, headers = feed.query(request.args, request.headers.get('If-None-Match'))
+    if status == 304:
+        return Response(status=304, headers=headers)
+    return jsonify(body), status, headers
+
+@app.route('/api/dashboard', methods=['GET'])
+def dashboard_delta():
+    """ダッシュボードの差分（since 以降に変わったアプリ）"""
+    return jsonify(feed.delta(parse_since(request.args.get('since')), request.args.get('feed')))
+
+@app.route('/api/dashboard/events', methods=['GET'])
+def dashboard_events():
+    """ダッシュボードの差分フィード（SSE）"""
+    since = parse_since(request.headers.get('Last-Event-ID') or request.args.get('since'))
+    stream = feed.events(since, request.args.get('feed'))
+    return Response(stream, content_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/apps/<path:repo_full_name>', methods=['POST'])
 def deploy_app(repo_full_name):
@@ -452,16 +1746,8 @@ def deploy_app(repo_full_name):
         branch = data.get('branch', 'main')
         
         # バックグラウンドでデプロイ
-        def deploy_async():
-            success, message = manager.deploy_app(repo_full_name, branch)
-            logger.info(f"📊 Deploy result: {message}")
-        
-        threading.Thread(target=deploy_async, daemon=True).start()
-        
-        return jsonify({
-            'status': 'accepted',
-            'message': f'Deployment started for {repo_full_name}:{branch}'
-        }), 202
+        body, status = start_deploy(repo_full_name, branch, replicas=data.get('replicas'))
+        return jsonify(body), status
         
     except Exception as e:
         logger.error(f"Deploy API error: {e}")
@@ -471,11 +1757,12 @@ def deploy_app(repo_full_name):
 def stop_app(repo_full_name):
     """アプリ停止API"""
     try:
-        data = request.get_json() or {}
-        branch = data.get('branch', 'main')
+        data = request.get_json(silent=True) or {}
+        # DELETE にボディを付けられないクライアント向けにクエリでも指定可能
+        branch = request.args.get('branch') or data.get('branch', 'main')
         repo_id = f"{repo_full_name}:{branch}"
         
-        if manager.stop_app(repo_id):
+        if manager.run_on_owner('stop_app', repo_id):
             return jsonify({'status': 'success', 'message': 'App stopped'})
         else:
             return jsonify({'status': 'error', 'message': 'Failed to stop app'}), 400
@@ -484,95 +1771,75 @@ def stop_app(repo_full_name):
         logger.error(f"Stop API error: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/apps/<path:repo_full_name>/deploys', methods=['GET'])
+def app_deploys(repo_full_name):
+    """アプリのデプロイ履歴API（フェーズ毎の時刻付き）"""
+    branch = request.args.get('branch', 'main')
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify(manager.deploy_history(repo_full_name, branch, limit))
+
+@app.route('/api/apps/<path:repo_full_name>/limits', methods=['GET', 'PUT'])
+def app_limits(repo_full_name):
+    """アプリの流入制限API（PUT の null は既定値に戻す）"""
+    branch = request.args.get('branch', 'main')
+    if request.method == 'PUT':
+        limits, error = validate_limits(request.get_json(silent=True))
+        if error:
+            return jsonify({'error': error}), 400
+        result = manager.run_on_owner('set_app_limits', repo_full_name, branch, limits)
+    else:
+        result = manager.get_app_limits(repo_full_name, branch)
+    if result is None:
+        return jsonify({'error': 'App not found'}), 404
+    return jsonify(result)
+
+@app.route('/api/deploys', methods=['GET'])
+def deploy_status():
+    """デプロイキューの状態API"""
+    return jsonify(manager.run_on_owner('scheduler_status'))
+
+@app.route('/api/deploys/<job_id>', methods=['GET'])
+def deploy_detail(job_id):
+    """デプロイ詳細API（ビルドログ込み）"""
+    job = manager.get_deploy(job_id)
+    if not job:
+        return jsonify({'error': 'Deploy not found'}), 404
+    return jsonify(job)
+
+@app.route('/api/deploys/<job_id>/log', methods=['GET'])
+def deploy_log(job_id):
+    """デプロイログ（実行中はライブで追従）"""
+    stream = deploy_log_stream(job_id)
+    if stream is None:
+        return jsonify({'error': 'Deploy not found'}), 404
+    return Response(stream, content_type='text/plain; charset=utf-8', headers={'X-Accel-Buffering': 'no'})
+
+@app.route('/api/base-images', methods=['GET'])
+def base_images():
+    """ベースイメージプールの状態API"""
+    return jsonify({'enabled': manager.base_images.enabled, 'base_images': manager.run_on_owner('base_image_status')})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheusメトリクス"""
+    body, content_type = render_metrics(metrics_collector)
+    return Response(body, content_type=content_type)
+
 @app.route('/health')
 def health():
     """ヘルスチェックAPI"""
     return jsonify(manager.health_check())
 
+def render_status_page():
+    """ステータスページのHTML（Flask/ASGI共通、アプリ状態が変わった時だけ描き直す）"""
+    return feed.page(lambda *args: render_dashboard(manager, *args))
+
 @app.route('/')
 def index():
     """ステータスページ"""
-    apps = manager.list_apps()
-    health_status = manager.health_check()
-    
-    html = f"""
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>🚀 Forgejo Gradio Pages (Debug)</title>
-        <style>
-            body {{ font-family: Arial, sans-serif; margin: 40px; }}
-            .app {{ border: 1px solid #ddd; margin: 10px 0; padding: 15px; border-radius: 5px; }}
-            .status-running {{ background-color: #d4edda; }}
-            .status-stopped {{ background-color: #f8d7da; }}
-            .status-error {{ background-color: #fff3cd; }}
-            .header {{ background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); color: white; padding: 20px; border-radius: 10px; margin-bottom: 20px; }}
-            .url {{ font-family: monospace; background: #f8f9fa; padding: 5px; border-radius: 3px; }}
-            .debug {{ background: #fff3cd; padding: 15px; border-radius: 8px; margin: 20px 0; }}
-        </style>
-    </head>
-    <body>
-        <div class="header">
-            <h1>🚀 Forgejo Gradio Pages (Debug)</h1>
-            <p>GitHub Pagesライクな Gradio アプリ デプロイサービス</p>
-            <p><strong>Active Apps:</strong> {health_status['healthy_apps']} / {health_status['total_apps']}</p>
-            <p><strong>Port Range:</strong> {health_status['port_range']}</p>
-        </div>
-        
-        <div class="debug">
-            <h3>🔧 Debug Info</h3>
-            <p><strong>Docker:</strong> {'✅ Connected' if manager.docker_client else '❌ Not connected'}</p>
-            <p><strong>Forgejo URL:</strong> {manager.forgejo_url}</p>
-            <p><strong>Token:</strong> {'✅ Set' if manager.forgejo_token else '❌ Not set'}</p>
-            <p><strong>Port Range:</strong> {manager.port_start}-{manager.port_end}</p>
-        </div>
-        
-        <h2>📱 Deployed Gradio Apps</h2>
-        {''.join([f'''
-            <div class="app status-{app_info['status']}">
-                <h3>{app_info['repo_full_name']}</h3>
-                <p><strong>Status:</strong> {app_info['status']}</p>
-                <p><strong>Port:</strong> {app_info['port']}</p>
-                <p><strong>URL:</strong> <a href="/{app_info['repo_full_name']}/" target="_blank" class="url">/{app_info['repo_full_name']}/</a></p>
-                <p><strong>Direct:</strong> <a href="http://192.168.0.131:{app_info['port']}" target="_blank" class="url">192.168.0.131:{app_info['port']}</a></p>
-                <p><strong>Branch:</strong> {app_info['branch']}</p>
-                <p><strong>Created:</strong> {app_info['created']}</p>
-            </div>
-        ''' for repo_id, app_info in apps.items()]) if apps else '<p>No apps deployed yet.</p>'}
-        
-        <h2>🧪 Test Deploy</h2>
-        <button onclick="testDeploy()">Test Deploy Sunwood-ai-labs/gradio-pages</button>
-        <div id="testResult"></div>
-        
-        <script>
-        function testDeploy() {{
-            fetch('/api/apps/Sunwood-ai-labs/gradio-pages', {{
-                method: 'POST',
-                headers: {{'Content-Type': 'application/json'}},
-                body: JSON.stringify({{'branch': 'main'}})
-            }})
-            .then(response => response.json())
-            .then(data => {{
-                document.getElementById('testResult').innerHTML = 
-                    '<p><strong>Result:</strong> ' + JSON.stringify(data) + '</p>';
-            }})
-            .catch(error => {{
-                document.getElementById('testResult').innerHTML = 
-                    '<p><strong>Error:</strong> ' + error + '</p>';
-            }});
-        }}
-        </script>
-        
-        <h2>📝 API Test</h2>
-        <ul>
-            <li><a href="/api/apps">GET /api/apps</a></li>
-            <li><a href="/health">GET /health</a></li>
-        </ul>
-    </body>
-    </html>
-    """
-    return html
+    return render_status_page()
 
 if __name__ == '__main__':
     logger.info("🚀 Starting Forgejo Gradio Pages (Debug version)")
+    manager.start_background_tasks()
     app.run(host='0.0.0.0', port=8081, debug=False, threaded=True)
@@ -0,0 +1,217 @@
+"""
+リポジトリキャッシュ
+リポジトリ毎にベアミラーを保持し、pushされたコミットだけを差分fetchしてworktreeへチェックアウト
+"""
+
+import os
+import re
+import shutil
+import subprocess
+import threading
+import logging
+from functools import lru_cache
+
+logger = logging.getLogger(__name__)
+
+# Forgejoのユーザー名・リポジトリ名に使える文字
+REPO_NAME_PART = re.compile(r'[A-Za-z0-9_.-]+')
+
+
+@lru_cache(maxsize=1024)
+def valid_branch(branch):
+    """ブランチ名として正しく、worktreeのパスにしてもキャッシュの外へ出ないか"""
+    if not isinstance(branch, str) or not branch or branch.startswith(('/', '-')) or '..' in branch:
+        return False
+    try:
+        subprocess.run(['git', 'check-ref-format', '--branch', branch], check=True, capture_output=True, timeout=10)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired, OSError):
+        return False
+    return True
+
+
+def valid_repo_name(repo_full_name):
+    """<owner>/<repo> 形式で、パスとして . や .. を含まないか"""
+    parts = repo_full_name.split('/') if isinstance(repo_full_name, str) else []
+    return len(parts) == 2 and all(part not in ('.', '..') and REPO_NAME_PART.fullmatch(part) for part in parts)
+
+
+class RepoCache:
+    """ベアミラー + ブランチ毎のworktreeによるインクリメンタルなチェックアウト"""
+
+    def __init__(self, app_dir, forgejo_url):
+        self.app_dir = app_dir
+        self.forgejo_url = forgejo_url
+        # <owner>/<repo> をそのまま階層にする（- で繋ぐと a-b/c と a/b-c が同じパスになる）
+        self.mirror_dir = os.path.join(app_dir, '.mirrors')
+        self.worktree_dir = os.path.join(app_dir, 'worktrees')
+        self.fetch_depth = int(os.getenv('GIT_FETCH_DEPTH', 1))
+        self.timeout = int(os.getenv('GIT_TIMEOUT', 60))
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        os.makedirs(self.mirror_dir, exist_ok=True)
+
+    def repo_lock(self, repo_full_name):
+        """同じミラーを別ブランチのデプロイが同時に触らないためのロック（ミラーのパス毎）"""
+        with self.locks_lock:
+            return self.locks.setdefault(self.mirror_path(repo_full_name), threading.Lock())
+
+    def git(self, *args, cwd=None):
+        """gitコマンドを実行して標準出力を返す"""
+        result = subprocess.run(
+            ['git', *args],
+            cwd=cwd,
+            check=True,
+            timeout=self.timeout,
+            capture_output=True,
+            text=True
+        )
+        return result.stdout.strip()
+
+    def check_target(self, repo_full_name, branch):
+        """不正なリポジトリ名・ブランチ名を拒否"""
+        if not valid_repo_name(repo_full_name):
+            raise ValueError(f"Invalid repository name: {repo_full_name!r}")
+        if not valid_branch(branch):
+            raise ValueError(f"Invalid branch name: {branch!r}")
+
+    def remove_tree(self, path, ignore_errors=False):
+        """キャッシュ配下であることを確かめてから削除"""
+        root = os.path.realpath(self.app_dir)
+        real = os.path.realpath(path)
+        if real == root or not real.startswith(root + os.sep):
+            raise ValueError(f"Refusing to remove {path}: outside {self.app_dir}")
+        shutil.rmtree(real, ignore_errors=ignore_errors)
+
+    def mirror_path(self, repo_full_name):
+        owner, repo = repo_full_name.split('/')
+        return os.path.join(self.mirror_dir, owner, repo + '.git')
+
+    def worktree_path(self, repo_full_name, branch):
+        owner, repo = repo_full_name.split('/')
+        return os.path.join(self.worktree_dir, owner, repo, branch)
+
+    @staticmethod
+    def remote_ref(branch):
+        """ブランチに対応するリモートの参照（プレビューの pull/<番号> はPRのheadを指す）"""
+        if branch.startswith('pull/'):
+            return f"refs/{branch}/head"
+        return f"refs/heads/{branch}"
+
+    def has_commit(self, mirror, commit):
+        try:
+            self.git('cat-file', '-e', f"{commit}^{{commit}}", cwd=mirror)
+            return True
+        except subprocess.CalledProcessError:
+            return False
+
+    def ensure_mirror(self, repo_full_name):
+        """ベアミラーを用意（なければ初期化）"""
+        mirror = self.mirror_path(repo_full_name)
+        remote_url = f"{self.forgejo_url}/{repo_full_name}.git"
+        if not os.path.exists(os.path.join(mirror, 'HEAD')):
+            logger.info(f"🪞 Initializing mirror: {mirror}")
+            os.makedirs(mirror, exist_ok=True)
+            self.git('init', '--bare', '--quiet', cwd=mirror)
+            self.git('remote', 'add', 'origin', remote_url, cwd=mirror)
+        elif self.git('remote', 'get-url', 'origin', cwd=mirror) != remote_url:
+            # FORGEJO_URL が変わった場合は古いサーバーから取得し続けないよう付け替える
+            logger.info(f"🪞 Updating mirror remote: {remote_url}")
+            self.git('remote', 'set-url', 'origin', remote_url, cwd=mirror)
+        return mirror
+
+    def fetch(self, mirror, branch, commit=None):
+        """ブランチ（と指定コミット）の差分だけを取得し、チェックアウト対象を返す"""
+        depth_args = ['--depth', str(self.fetch_depth)] if self.fetch_depth > 0 else []
+        self.git('fetch', '--quiet', '--no-tags', '--force', *depth_args,
+                 'origin', f"+{self.remote_ref(branch)}:refs/heads/{branch}", cwd=mirror)
+
+        if commit:
+            if not self.has_commit(mirror, commit):
+                # ブランチが既に先へ進んでいる場合など、コミットを直接取得する
+                try:
+                    self.git('fetch', '--quiet', '--no-tags', *depth_args, 'origin', commit, cwd=mirror)
+                except subprocess.CalledProcessError as e:
+                    logger.warning(f"⚠️  Could not fetch {commit[:12]}, using branch head: {e.stderr.strip()}")
+            if self.has_commit(mirror, commit):
+                return commit
+        return f"refs/heads/{branch}"
+
+    def checkout(self, mirror, worktree, target):
+        """worktreeを対象コミットへ更新（既存worktreeは差分だけ書き換え）"""
+        if os.path.isdir(os.path.join(worktree, '.git')):
+            # 旧方式のフルクローンは作り直す
+            self.remove_tree(worktree)
+
+        if os.path.isfile(os.path.join(worktree, '.git')):
+            self.git('checkout', '--quiet', '--force', '--detach', target, cwd=worktree)
+            self.git('clean', '-ffdxq', cwd=worktree)
+        else:
+            if os.path.exists(worktree):
+                self.remove_tree(worktree)
+            os.makedirs(os.path.dirname(worktree), exist_ok=True)
+            self.git('worktree', 'prune', cwd=mirror)
+            self.git('worktree', 'add', '--quiet', '--force', '--detach', worktree, target, cwd=mirror)
+
+        if self.uses_lfs(worktree):
+            logger.info(f"📦 Pulling LFS objects in {worktree}")
+            self.git('lfs', 'pull', cwd=worktree)
+
+        return self.git('rev-parse', 'HEAD', cwd=worktree)
+
+    def uses_lfs(self, worktree):
+        attributes = os.path.join(worktree, '.gitattributes')
+        if not shutil.which('git-lfs') or not os.path.exists(attributes):
+            return False
+        with open(attributes, 'r', errors='ignore') as f:
+            return 'filter=lfs' in f.read()
+
+    def reset(self, repo_full_name, branch):
+        """失敗したブランチのworktreeとローカルブランチを削除（ミラーは他ブランチのworktreeが使うので、壊れている時だけ削除）"""
+        worktree = self.worktree_path(repo_full_name, branch)
+        mirror = self.mirror_path(repo_full_name)
+        if os.path.exists(worktree):
+            self.remove_tree(worktree, ignore_errors=True)
+            logger.info(f"🗑️  Removed cached checkout: {worktree}")
+        if not os.path.exists(mirror):
+            return
+        try:
+            self.git('rev-parse', '--git-dir', cwd=mirror)
+            self.git('worktree', 'prune', cwd=mirror)
+            self.git('update-ref', '-d', f"refs/heads/{branch}", cwd=mirror)
+        except subprocess.CalledProcessError as e:
+            logger.warning(f"⚠️  Mirror {mirror} is unusable, removing it: {e.stderr.strip()}")
+            self.remove_tree(mirror, ignore_errors=True)
+
+    def remove_worktree(self, repo_full_name, branch):
+        """ブランチのworktreeとミラー内のローカルブランチを削除（ミラー自体は残す）"""
+        self.check_target(repo_full_name, branch)
+        worktree = self.worktree_path(repo_full_name, branch)
+        mirror = self.mirror_path(repo_full_name)
+        with self.repo_lock(repo_full_name):
+            if os.path.exists(worktree):
+                self.remove_tree(worktree, ignore_errors=True)
+                logger.info(f"🗑️  Removed worktree: {worktree}")
+            if os.path.exists(os.path.join(mirror, 'HEAD')):
+                try:
+                    self.git('worktree', 'prune', cwd=mirror)
+                    self.git('update-ref', '-d', f"refs/heads/{branch}", cwd=mirror)
+                except subprocess.CalledProcessError as e:
+                    logger.warning(f"⚠️  Could not clean up {branch} in {mirror}: {e.stderr.strip()}")
+
+    def update(self, repo_full_name, branch, commit=None):
+        """ミラーを差分更新してworktreeをチェックアウトし、(パス, コミットSHA) を返す"""
+        self.check_target(repo_full_name, branch)
+        worktree = self.worktree_path(repo_full_name, branch)
+        with self.repo_lock(repo_full_name):
+            try:
+                mirror = self.ensure_mirror(repo_full_name)
+                target = self.fetch(mirror, branch, commit)
+                sha = self.checkout(mirror, worktree, target)
+            except subprocess.CalledProcessError as e:
+                # キャッシュが壊れている可能性があるので、このブランチの分だけ一度作り直す
+                logger.warning(f"⚠️  Cached checkout failed, retrying with a fresh worktree: {e.stderr.strip()}")
+                self.reset(repo_full_name, branch)
+                mirror = self.ensure_mirror(repo_full_name)
+                target = self.fetch(mirror, branch, commit)
+                sha = self.checkout(mirror, worktree, target)
+        return worktree, sha
@@ -0,0 +1,35 @@
+"""
+ASGIモード用 gunicorn 設定
+uvicornワーカーを複数起動し、ルーティングは状態ファイル経由で共有する
+デプロイやコンテナの起動停止はロックを取った1ワーカー（デプロイオーナー）だけが行う
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('GRADIO_PAGES_PORT', 8081)}"
+workers = int(os.getenv('GRADIO_PAGES_WORKERS', 1))
+worker_class = 'uvicorn.workers.UvicornWorker'
+
+# マネージャー初期化（コンテナのクリーンアップ等）をマスターで一度だけ実行
+preload_app = True
+
+# SSE/WebSocketの長時間接続があるためグレースフル停止は長めに待つ
+graceful_timeout = int(os.getenv('GRADIO_PAGES_GRACEFUL_TIMEOUT', 30))
+keepalive = 75
+
+
+def post_fork(server, worker):
+    """fork前のDockerクライアント接続（全ノード）をワーカー間で共有しないよう作り直す"""
+    from forgejo_gradio_manager import manager
+
+    manager.reconnect_docker()
+    if manager.docker_client is None:
+        server.log.error(f"❌ Failed to reconnect Docker in worker {worker.pid}")
+
+
+def child_exit(server, worker):
+    """終了したワーカーのメトリクスファイルを集計対象から外す"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
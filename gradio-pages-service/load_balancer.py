@@ -0,0 +1,117 @@
+"""
+レプリカ間のロードバランサー
+処理中リクエスト数が最少のレプリカへ振り分け、Gradioのセッションは同じレプリカに固定する
+"""
+
+import os
+import re
+import time
+import json
+import random
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# ブラウザを同じレプリカへ固定するクッキー（アップロード済みファイル等もレプリカ毎のため）
+STICKY_COOKIE = 'gradio-pages-replica'
+
+# session_hash がURLに含まれるGradioのエンドポイント
+SESSION_PATH_PATTERN = re.compile(r'/heartbeat/([A-Za-z0-9_-]+)')
+# session_hash をJSONボディで送るエンドポイント（/queue/join, /run/predict 等）
+SESSION_BODY_MARKERS = ('/queue/join', '/run/', '/api/')
+SESSION_BODY_LIMIT = 64 * 1024
+
+
+def wants_session_body(method, path, content_type, content_length):
+    """session_hash を読むためにボディを先読みすべきリクエストか"""
+    return (
+        method == 'POST'
+        and 'application/json' in (content_type or '')
+        and content_length is not None
+        and 0 < content_length <= SESSION_BODY_LIMIT
+        and any(marker in path for marker in SESSION_BODY_MARKERS)
+    )
+
+
+def gradio_session_hash(path, query_session=None, body=None):
+    """リクエストからGradioの session_hash を取り出す（なければ None）"""
+    if query_session:
+        return query_session
+    match = SESSION_PATH_PATTERN.search(path)
+    if match:
+        return match.group(1)
+    if body:
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return None
+        if isinstance(data, dict) and isinstance(data.get('session_hash'), str):
+            return data['session_hash']
+    return None
+
+
+class ReplicaBalancer:
+    """レプリカ毎の処理中リクエスト数と、接続に失敗したレプリカの一時除外を管理"""
+
+    def __init__(self):
+        self.inflight = {}
+        self.ejected = {}
+        self.lock = threading.Lock()
+        self.eject_seconds = float(os.getenv('PROXY_EJECT_SECONDS', 30))
+
+    @staticmethod
+    def key(replica):
+        return replica['host'], replica['port']
+
+    def healthy(self, replicas):
+        """ローテーション対象のレプリカ（全て除外中なら稼働中のものを全て返す）"""
+        running = [r for r in replicas if r.get('status') == 'running' and r.get('port')]
+        now = time.monotonic()
+        with self.lock:
+            available = [r for r in running if self.ejected.get(self.key(r), 0) <= now]
+        return available or running
+
+    def pick(self, replicas, sticky=None, session_hash=None):
+        """振り分け先のレプリカを選ぶ（クッキー → session_hash → 最少処理中の順）"""
+        candidates = self.healthy(replicas)
+        if not candidates:
+            return None
+        if len(candidates) == 1:
+            return candidates[0]
+
+        if sticky:
+            for replica in candidates:
+                if replica['container_name'] == sticky:
+                    return replica
+
+        if session_hash:
+            # ランデブーハッシュ：レプリカが減っても他のセッションは移動しない
+            return max(
+                candidates,
+                key=lambda r: hashlib.sha1(f"{session_hash}:{r['container_name']}".encode()).digest()
+            )
+
+        with self.lock:
+            return min(candidates, key=lambda r: (self.inflight.get(self.key(r), 0), random.random()))
+
+    def acquire(self, replica):
+        with self.lock:
+            key = self.key(replica)
+            self.inflight[key] = self.inflight.get(key, 0) + 1
+
+    def release(self, replica):
+        with self.lock:
+            key = self.key(replica)
+            count = self.inflight.get(key, 0) - 1
+            if count > 0:
+                self.inflight[key] = count
+            else:
+                self.inflight.pop(key, None)
+
+    def eject(self, replica):
+        """接続できなかったレプリカを一定時間ローテーションから外す"""
+        with self.lock:
+            self.ejected[self.key(replica)] = time.monotonic() + self.eject_seconds
+        logger.warning(f"🚫 Ejected replica {replica['container_name']} for {self.eject_seconds}s")
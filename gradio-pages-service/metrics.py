@@ -0,0 +1,192 @@
+"""
+Prometheusメトリクス
+プロキシ・デプロイパイプライン・コンテナのリソース使用量を /metrics で公開する
+PROMETHEUS_MULTIPROC_DIR 指定時はワーカー間で集計（gunicorn のマルチワーカー用）
+"""
+
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram,
+    generate_latest, multiprocess,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+logger = logging.getLogger(__name__)
+
+# プロキシのレイテンシ（ミリ秒〜数十秒）と、ビルド等の長いフェーズ用のバケット
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PHASE_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+
+PROXY_REQUEST_SECONDS = Histogram(
+    'gradio_proxy_request_duration_seconds',
+    'Time until the upstream app returned response headers',
+    ['app', 'code'], buckets=LATENCY_BUCKETS
+)
+PROXY_CONNECT_SECONDS = Histogram(
+    'gradio_proxy_upstream_connect_seconds',
+    'Time to open a new TCP connection to an app container',
+    ['app'], buckets=LATENCY_BUCKETS
+)
+PROXY_RESPONSE_BYTES = Counter(
+    'gradio_proxy_response_bytes_total',
+    'Response body bytes streamed from app containers to clients',
+    ['app']
+)
+PROXY_ERRORS = Counter(
+    'gradio_proxy_errors_total',
+    'Requests that failed before the upstream app answered',
+    ['app']
+)
+PROXY_CACHE_REQUESTS = Counter(
+    'gradio_proxy_cache_requests_total',
+    'Static asset cache lookups by result (hit, not_modified, miss)',
+    ['result']
+)
+PROXY_CACHE_BYTES = Gauge(
+    'gradio_proxy_cache_bytes',
+    'Bytes held by the static asset cache',
+    ['tier'], multiprocess_mode='livesum'
+)
+ADMISSION_REJECTIONS = Counter(
+    'gradio_admission_rejections_total',
+    'Requests rejected by admission control (rate limits, concurrency caps, full queue)',
+    ['app', 'reason']
+)
+ADMISSION_QUEUE_SECONDS = Histogram(
+    'gradio_admission_queue_seconds',
+    'Time requests waited in an app queue for a concurrency slot',
+    ['app'], buckets=LATENCY_BUCKETS
+)
+COLD_START_SECONDS = Histogram(
+    'gradio_cold_start_duration_seconds',
+    'Time to start an idle app until it answered the readiness probe',
+    ['app'], buckets=PHASE_BUCKETS
+)
+DEPLOY_PHASE_SECONDS = Histogram(
+    'gradio_deploy_phase_duration_seconds',
+    'Duration of each deploy phase (clone, checks, build, capacity, distribute, allocate, start, ready)',
+    ['app', 'phase'], buckets=PHASE_BUCKETS
+)
+DEPLOYS = Counter(
+    'gradio_deploys_total',
+    'Finished deploy jobs by result',
+    ['status']
+)
+DEPLOY_QUEUE_DEPTH = Gauge(
+    'gradio_deploy_queue_depth',
+    'Deploy jobs waiting for a worker',
+    multiprocess_mode='livesum'
+)
+DEPLOYS_RUNNING = Gauge(
+    'gradio_deploys_running',
+    'Deploy jobs currently running',
+    multiprocess_mode='livesum'
+)
+
+
+class ManagerCollector:
+    """スクレイプ時にアプリ状態とコンテナの stats を読むコレクター"""
+
+    def __init__(self, manager):
+        self.manager = manager
+        # stats API はコンテナ毎に1往復かかるため結果を一定時間使い回す
+        self.stats_ttl = float(os.getenv('METRICS_STATS_TTL', 15))
+        self.stats_cache = []
+        self.stats_at = 0
+
+    def describe(self):
+        # 登録時に collect()（Docker API 呼び出し）が走らないようにする
+        return []
+
+    def container_stats(self):
+        """稼働中コンテナの stats を並列に取得"""
+        if time.monotonic() - self.stats_at < self.stats_ttl:
+            return self.stats_cache
+
+        targets = [
+            (repo_id, replica['container'])
+            for repo_id, info in list(self.manager.apps.items())
+            if info.get('status') == 'running'
+            for replica in info.get('replicas', [])
+            if replica.get('container') is not None
+        ]
+
+        def fetch(target):
+            repo_id, container = target
+            try:
+                # one_shot は前回サンプルを待たずに返る（CPUは累積値を出して rate() で計算）
+                return repo_id, container.name, container.stats(stream=False, one_shot=True)
+            except Exception as e:
+                logger.warning(f"Failed to read stats for {container.name}: {e}")
+                return repo_id, container.name, None
+
+        stats = []
+        if targets:
+            with ThreadPoolExecutor(max_workers=min(8, len(targets))) as pool:
+                for repo_id, name, data in pool.map(fetch, targets):
+                    if data:
+                        stats.append((repo_id, name, data))
+        self.stats_cache = stats
+        self.stats_at = time.monotonic()
+        return stats
+
+    def collect(self):
+        apps = GaugeMetricFamily('gradio_apps', 'Apps by status', labels=['status'])
+        counts = {}
+        for info in list(self.manager.apps.values()):
+            status = info.get('status') or 'unknown'
+            counts[status] = counts.get(status, 0) + 1
+        for status, count in counts.items():
+            apps.add_metric([status], count)
+        yield apps
+
+        cpu = CounterMetricFamily(
+            'gradio_container_cpu_seconds', 'Total CPU time consumed by the app container',
+            labels=['app', 'container']
+        )
+        memory = GaugeMetricFamily(
+            'gradio_container_memory_bytes', 'Memory used by the app container (excluding page cache)',
+            labels=['app', 'container']
+        )
+        memory_limit = GaugeMetricFamily(
+            'gradio_container_memory_limit_bytes', 'Memory limit of the app container',
+            labels=['app', 'container']
+        )
+        if self.manager.docker_client:
+            for repo_id, name, data in self.container_stats():
+                cpu_usage = data.get('cpu_stats', {}).get('cpu_usage', {}).get('total_usage')
+                if cpu_usage is not None:
+                    cpu.add_metric([repo_id, name], cpu_usage / 1e9)
+                mem = data.get('memory_stats', {})
+                if 'usage' in mem:
+                    cache = mem.get('stats', {}).get('inactive_file', mem.get('stats', {}).get('cache', 0))
+                    memory.add_metric([repo_id, name], mem['usage'] - cache)
+                if 'limit' in mem:
+                    memory_limit.add_metric([repo_id, name], mem['limit'])
+        yield cpu
+        yield memory
+        yield memory_limit
+
+
+def register_manager(manager):
+    """アプリ状態・コンテナ stats のコレクターを登録"""
+    collector = ManagerCollector(manager)
+    if not os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        REGISTRY.register(collector)
+    return collector
+
+
+def render_metrics(manager_collector):
+    """/metrics のレスポンス本文と Content-Type"""
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        # 各ワーカーが書き出した値を集計し、アプリ状態はスクレイプされたワーカーから読む
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        registry.register(manager_collector)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,113 @@
+"""
+ホストポートのアロケーター
+空きポートのフリーリストをロック下で予約し、同時デプロイで同じポートを掴まないようにする
+マルチワーカー時は状態ストア（SQLite）のトランザクションで予約し、ワーカー間でも重複させない
+"""
+
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class PortAllocator:
+    """範囲内のポートをフリーリストで払い出す"""
+
+    def __init__(self, port_start, port_end, probe=None):
+        self.port_start = port_start
+        self.port_end = port_end
+        # 予約外のプロセスがポートを使っていないかの確認（払い出し時に1ポートだけ）
+        self.probe = probe
+        self.free = deque(range(port_start, port_end + 1))
+        self.reserved = {}
+        self.lock = threading.Lock()
+        # share() 後は予約を状態ストアに置く（node はストア上のノード名）
+        self.store = None
+        self.node = None
+
+    def share(self, store, node):
+        """予約をワーカー間で共有する状態ストアへ移す"""
+        self.store = store
+        self.node = node
+
+    def allocate(self, owner):
+        """空きポートを1つ予約して返す（なければ None）"""
+        if self.store:
+            port = self.store.allocate_port(self.node, self.port_start, self.port_end, owner, self.probe)
+            if port is None:
+                logger.error(f"❌ No available ports in range {self.port_start}-{self.port_end}")
+            else:
+                logger.info(f"✅ Reserved port {port} for {owner}")
+            return port
+        with self.lock:
+            skipped = []
+            port = None
+            while self.free:
+                candidate = self.free.popleft()
+                if self.probe is None or self.probe(candidate):
+                    port = candidate
+                    break
+                # 外部プロセスが使用中のポートは末尾に回して次回以降に再確認
+                skipped.append(candidate)
+            self.free.extend(skipped)
+
+            if port is None:
+                logger.error(f"❌ No available ports in range {self.port_start}-{self.port_end}")
+                return None
+            self.reserved[port] = owner
+            logger.info(f"✅ Reserved port {port} for {owner}")
+            return port
+
+    def reserve(self, port, owner):
+        """既知のポートを予約済みにする（状態の復元時）"""
+        if port is None:
+            return
+        if self.store:
+            self.store.reserve_port(self.node, port, owner)
+            return
+        with self.lock:
+            if port in self.reserved:
+                return
+            try:
+                self.free.remove(port)
+            except ValueError:
+                # 範囲外のポートも二重割り当てを避けるため記録だけする
+                pass
+            self.reserved[port] = owner
+
+    def release(self, port):
+        """ポートを解放してフリーリストへ戻す"""
+        if port is None:
+            return
+        if self.store:
+            if self.store.release_port(self.node, port):
+                logger.info(f"♻️  Released port {port}")
+            return
+        with self.lock:
+            if self.reserved.pop(port, None) is None:
+                return
+            if self.port_start <= port <= self.port_end:
+                self.free.append(port)
+            logger.info(f"♻️  Released port {port}")
+
+    def reserved_ports(self):
+        if self.store:
+            return self.store.reserved_ports(self.node)
+        with self.lock:
+            return dict(self.reserved)
+
+    def free_count(self):
+        """範囲内の空きポート数"""
+        if self.store:
+            reserved = self.reserved_ports()
+            return sum(1 for port in range(self.port_start, self.port_end + 1) if port not in reserved)
+        with self.lock:
+            return len(self.free)
+
+    def status(self):
+        return {
+            'range': f"{self.port_start}-{self.port_end}",
+            'free': self.free_count(),
+            'reserved': dict(sorted(self.reserved_ports().items())),
+        }
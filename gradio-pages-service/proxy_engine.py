@@ -0,0 +1,352 @@
+"""
+Gradioアプリ向けストリーミング・リバースプロキシ
+バックエンドポート毎にkeep-aliveセッションをプールし、レスポンスをチャンク単位で中継
+SSE（Gradioキュー）とWebSocketアップグレードもバッファリングせずに中継
+"""
+
+import os
+import time
+import select
+import socket
+import threading
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.exceptions import HTTPError as UpstreamError
+from flask import Response
+
+from metrics import PROXY_CONNECT_SECONDS, PROXY_ERRORS, PROXY_REQUEST_SECONDS, PROXY_RESPONSE_BYTES
+
+logger = logging.getLogger(__name__)
+
+# RFC 7230 のホップバイホップヘッダ（プロキシで転送しない）
+HOP_BY_HOP_HEADERS = {
+    'connection',
+    'keep-alive',
+    'proxy-authenticate',
+    'proxy-authorization',
+    'te',
+    'trailers',
+    'transfer-encoding',
+    'upgrade',
+}
+
+# 長時間接続になるGradioのキュー/ストリーミング系パス
+STREAMING_PATH_MARKERS = ('/queue/', '/call/', '/stream/')
+
+
+def is_websocket_request(req):
+    """WebSocketアップグレード要求か判定"""
+    connection = req.headers.get('Connection', '').lower()
+    return req.headers.get('Upgrade', '').lower() == 'websocket' and 'upgrade' in connection
+
+
+def is_streaming_request(req, path):
+    """SSE/ロングポーリング等の長時間リクエストか判定"""
+    if 'text/event-stream' in req.headers.get('Accept', ''):
+        return True
+    return any(marker in path for marker in STREAMING_PATH_MARKERS)
+
+
+class RequestBodyStream:
+    """クライアントのリクエストボディを上流へ逐次送るためのラッパー"""
+
+    def __init__(self, stream, length, chunk_size):
+        self.stream = stream
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        # 0 の場合 requests は chunked 転送にフォールバックする
+        return self.length or 0
+
+    def read(self, size=-1):
+        return self.stream.read(self.chunk_size if size is None or size < 0 else size)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class UpstreamBody:
+    """上流レスポンスを届いた分だけ中継するイテレータ
+
+    WSGIサーバーは送信後（切断時も）必ず close() を呼ぶため、接続の返却と on_close をここで行う
+    （direct_passthrough のレスポンスでは call_on_close が呼ばれない）
+    """
+
+    def __init__(self, upstream, chunk_size, app_label, on_close=None):
+        self.upstream = upstream
+        self.chunk_size = chunk_size
+        self.app_label = app_label
+        self.on_close = on_close
+        self.sent = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        # read1 は chunk_size 分揃うのを待たないため SSE のイベントも遅延なく流れる
+        try:
+            chunk = self.upstream.raw.read1(self.chunk_size, decode_content=False)
+        except (UpstreamError, OSError) as e:
+            # ドレイン・クラッシュなどで上流が途中で切れたら、ここでレスポンスを終える
+            logger.warning(f"⚠️  Upstream for {self.app_label} closed mid-stream: {e}")
+            PROXY_ERRORS.labels(self.app_label).inc()
+            self.close()
+            raise StopIteration
+        if not chunk:
+            raise StopIteration
+        self.sent += len(chunk)
+        return chunk
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # コネクションをプールへ返却
+            self.upstream.close()
+            PROXY_RESPONSE_BYTES.labels(self.app_label).inc(self.sent)
+        finally:
+            if self.on_close:
+                self.on_close()
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """TCP接続の確立時間を計測するコネクション"""
+
+    app_label = ''
+
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        PROXY_CONNECT_SECONDS.labels(self.app_label).observe(time.perf_counter() - started)
+
+
+def timed_pool_class(app_label):
+    """接続時間をアプリ名のラベルで記録するコネクションプールのクラス"""
+    connection_cls = type('TimedHTTPConnection', (TimedHTTPConnection,), {'app_label': app_label})
+    return type('TimedHTTPConnectionPool', (HTTPConnectionPool,), {'ConnectionCls': connection_cls})
+
+
+class GradioProxy:
+    """ポート毎のコネクションプールを持つストリーミングプロキシ"""
+
+    def __init__(self, asset_cache=None):
+        # 静的アセットのキャッシュ（forward に cache_key を渡したリクエストだけ保存する）
+        self.asset_cache = asset_cache
+        self.chunk_size = int(os.getenv('PROXY_CHUNK_SIZE', 64 * 1024))
+        self.pool_maxsize = int(os.getenv('PROXY_POOL_MAXSIZE', 32))
+        self.connect_timeout = float(os.getenv('PROXY_CONNECT_TIMEOUT', 5))
+        self.read_timeout = float(os.getenv('PROXY_READ_TIMEOUT', 30))
+        # SSE/WebSocketは総時間ではなく無通信時間で切断
+        self.stream_idle_timeout = float(os.getenv('PROXY_STREAM_IDLE_TIMEOUT', 600))
+        self.sessions = {}
+        self.sessions_lock = threading.Lock()
+
+        logger.info(f"🔀 Proxy pool size per target: {self.pool_maxsize}")
+
+    def get_session(self, host, port, app_label=''):
+        """接続先・アプリ毎のkeep-aliveセッションを取得（なければ作成）
+
+        ポートは別アプリに再利用されるため、接続時間のラベルを焼き込むプールはアプリ単位で分ける
+        """
+        app_label = app_label or f"{host}:{port}"
+        with self.sessions_lock:
+            session = self.sessions.get((host, port, app_label))
+            if session is None:
+                session = requests.Session()
+                # 上流エラーはそのままクライアントへ返すためリトライしない
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+                adapter.poolmanager.pool_classes_by_scheme = {'http': timed_pool_class(app_label)}
+                session.mount('http://', adapter)
+                session.trust_env = False
+                self.sessions[(host, port, app_label)] = session
+                logger.info(f"🔌 Created connection pool for {host}:{port} ({app_label})")
+            return session
+
+    def close_session(self, host, port):
+        """接続先のコネクションプールを（全アプリ分）破棄"""
+        with self.sessions_lock:
+            keys = [key for key in self.sessions if key[:2] == (host, port)]
+            sessions = [self.sessions.pop(key) for key in keys]
+        for session in sessions:
+            session.close()
+        if sessions:
+            logger.info(f"🔌 Closed connection pool for {host}:{port}")
+
+    def build_upstream_headers(self, req):
+        """上流へ転送するリクエストヘッダを組み立て"""
+        headers = {}
+        for key, value in req.headers.items():
+            lower = key.lower()
+            if lower in HOP_BY_HOP_HEADERS or lower in ('host', 'content-length'):
+                continue
+            headers[key] = value
+
+        forwarded_for = req.headers.get('X-Forwarded-For')
+        client_ip = req.remote_addr or ''
+        headers['X-Forwarded-For'] = f"{forwarded_for}, {client_ip}" if forwarded_for else client_ip
+        headers['X-Forwarded-Host'] = req.host
+        headers['X-Forwarded-Proto'] = req.scheme
+        return headers
+
+    def build_response_headers(self, upstream, host, port, prefix):
+        """クライアントへ返すレスポンスヘッダを組み立て"""
+        headers = []
+        for key, value in upstream.raw.headers.items():
+            lower = key.lower()
+            if lower in HOP_BY_HOP_HEADERS:
+                continue
+            if lower == 'location':
+                # バックエンド直のURLをプロキシ経由のパスに書き換え
+                for origin in (f"http://{host}:{port}", f"http://localhost:{port}"):
+                    if value.startswith(origin):
+                        value = prefix + value[len(origin):]
+                        break
+            headers.append((key, value))
+        return headers
+
+    def forward(self, req, host, port, path, prefix='', app_label='', cached_body=None, cache_key=None, on_close=None):
+        """Flaskリクエストを上流へ転送し、ストリーミングレスポンスを返す
+
+        cached_body は先読み済みのボディ、on_close はレスポンスの送信が終わった後に呼ぶ
+        """
+        app_label = app_label or f"{host}:{port}"
+        target_url = f"http://{host}:{port}{path}"
+        query_string = req.query_string.decode('latin-1')
+        if query_string:
+            target_url = f"{target_url}?{query_string}"
+
+        body = cached_body
+        if body is None and (req.content_length or req.headers.get('Transfer-Encoding', '').lower() == 'chunked'):
+            body = RequestBodyStream(req.stream, req.content_length, self.chunk_size)
+
+        streaming = is_streaming_request(req, path)
+        read_timeout = self.stream_idle_timeout if streaming else self.read_timeout
+
+        cache = self.asset_cache if cache_key else None
+        upstream_headers = self.build_upstream_headers(req)
+        if cache:
+            upstream_headers = dict(cache.upstream_headers(upstream_headers.items()))
+
+        session = self.get_session(host, port, app_label)
+        started = time.perf_counter()
+        try:
+            upstream = session.request(
+                req.method,
+                target_url,
+                data=body,
+                headers=upstream_headers,
+                stream=True,
+                allow_redirects=False,
+                timeout=(self.connect_timeout, read_timeout)
+            )
+        except Exception:
+            PROXY_ERRORS.labels(app_label).inc()
+            raise
+        PROXY_REQUEST_SECONDS.labels(app_label, str(upstream.status_code)).observe(time.perf_counter() - started)
+
+        headers = self.build_response_headers(upstream, host, port, prefix)
+        if cache:
+            content_length = upstream.headers.get('Content-Length', '')
+            ttl = cache.ttl_for(upstream.status_code, headers, int(content_length) if content_length.isdigit() else None)
+            if ttl:
+                try:
+                    content = upstream.raw.read(decode_content=False)
+                finally:
+                    upstream.close()
+                PROXY_RESPONSE_BYTES.labels(app_label).inc(len(content))
+                entry = cache.store(cache_key, upstream.status_code, headers, content, ttl)
+                status, headers, content = cache.respond(entry, req.headers, hit=False)
+                if on_close:
+                    on_close()
+                return Response(content, status=status, headers=headers)
+
+        if 'text/event-stream' in upstream.headers.get('Content-Type', ''):
+            # 中間のプロキシ（nginx等）にもバッファリングさせない
+            headers.append(('X-Accel-Buffering', 'no'))
+            logger.info(f"📡 SSE stream opened: {path} ({host}:{port})")
+
+        return Response(
+            UpstreamBody(upstream, self.chunk_size, app_label, on_close),
+            status=upstream.status_code,
+            headers=headers,
+            direct_passthrough=True
+        )
+
+    def build_handshake(self, req, host, port, path):
+        """WebSocketハンドシェイク要求を上流向けに組み立て"""
+        query_string = req.query_string.decode('latin-1')
+        target = f"{path}?{query_string}" if query_string else path
+        lines = [f"{req.method} {target} HTTP/1.1", f"Host: {host}:{port}"]
+        for key, value in req.headers.items():
+            if key.lower() in ('host', 'content-length'):
+                continue
+            lines.append(f"{key}: {value}")
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def pump(self, client_sock, upstream_sock):
+        """双方向にバイト列を中継（無通信タイムアウト付き）"""
+        peers = {client_sock: upstream_sock, upstream_sock: client_sock}
+        while True:
+            readable, _, _ = select.select(list(peers), [], [], self.stream_idle_timeout)
+            if not readable:
+                logger.info(f"⏰ WebSocket idle timeout ({self.stream_idle_timeout}s)")
+                return
+            for sock in readable:
+                data = sock.recv(self.chunk_size)
+                if not data:
+                    return
+                peers[sock].sendall(data)
+
+    def tunnel_websocket(self, req, host, port, path, app_label=''):
+        """WebSocketアップグレードをコンテナポートへトンネリング"""
+        client_sock = req.environ.get('werkzeug.socket')
+        if client_sock is None:
+            # 生ソケットを取得できないWSGIサーバーでは中継できない
+            return Response("WebSocket tunnelling is not supported by this server", status=501)
+
+        app_label = app_label or f"{host}:{port}"
+        started = time.perf_counter()
+        try:
+            upstream_sock = socket.create_connection((host, port), timeout=self.connect_timeout)
+        except OSError:
+            PROXY_ERRORS.labels(app_label).inc()
+            raise
+        PROXY_CONNECT_SECONDS.labels(app_label).observe(time.perf_counter() - started)
+        try:
+            upstream_sock.settimeout(None)
+            upstream_sock.sendall(self.build_handshake(req, host, port, path))
+
+            # 上流のハンドシェイク応答（101）をそのままクライアントへ返す
+            handshake = b''
+            while b'\r\n\r\n' not in handshake:
+                readable, _, _ = select.select([upstream_sock], [], [], self.read_timeout)
+                data = upstream_sock.recv(self.chunk_size) if readable else b''
+                if not data:
+                    raise ConnectionError("WebSocket handshake was not completed by upstream")
+                handshake += data
+            client_sock.sendall(handshake)
+
+            if handshake.split(b'\r\n', 1)[0].split(b' ')[1:2] == [b'101']:
+                logger.info(f"🔗 WebSocket tunnel opened: {path} ({host}:{port})")
+                self.pump(client_sock, upstream_sock)
+                logger.info(f"🔗 WebSocket tunnel closed: {path} ({host}:{port})")
+        finally:
+            upstream_sock.close()
+            # 以降のレスポンス書き込みはサーバー側で接続断として扱われる
+            try:
+                client_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+        return Response(status=101)
@@ -0,0 +1,178 @@
+"""
+コンテナのリソース制限とホストのメモリ容量管理
+アプリ毎のメモリ・CPU・CPUピン留め・共有メモリ・プロセス数の上限（既定値 ← リポジトリの設定ファイル）と、
+起動済みアプリのメモリ上限の合計がホストの容量を超えないよう起動を待たせる・断る仕組み
+"""
+
+import os
+import re
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+SIZE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+SIZE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(?:i?b)?\s*$', re.IGNORECASE)
+CPUSET_PATTERN = re.compile(r'^\d+(-\d+)?(,\d+(-\d+)?)*$')
+
+
+def parse_size(value):
+    """'512m' / '2g' / バイト数 をバイト数にする（0 は無制限）"""
+    if isinstance(value, bool):
+        raise ValueError(f"invalid size: {value}")
+    if isinstance(value, (int, float)):
+        if value < 0:
+            raise ValueError(f"invalid size: {value}")
+        return int(value)
+    match = SIZE_PATTERN.match(str(value))
+    if not match:
+        raise ValueError(f"invalid size: {value}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+
+def parse_cpuset(value):
+    value = str(value).replace(' ', '')
+    if value and not CPUSET_PATTERN.match(value):
+        raise ValueError(f"invalid cpuset: {value}")
+    return value
+
+
+def parse_count(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+        raise ValueError(f"must be a non-negative number: {value}")
+    return value
+
+
+# 設定できるリソース（0・空は無制限）
+RESOURCE_FIELDS = {
+    'memory': parse_size,                          # メモリ上限（スワップも同じ値で止める）
+    'cpus': lambda v: float(parse_count(v)),       # 使えるCPU数（小数可）
+    'cpuset': parse_cpuset,                        # ピン留めするCPU（例: '0-3' / '4,5'）
+    'shm_size': parse_size,                        # /dev/shm の大きさ（PyTorch の DataLoader 等）
+    'pids_limit': lambda v: int(parse_count(v)),   # プロセス・スレッド数の上限
+}
+
+
+def default_resources():
+    """環境変数による既定のリソース制限"""
+    return {
+        'memory': parse_size(os.getenv('APP_MEMORY_LIMIT', '2g')),
+        'cpus': float(os.getenv('APP_CPUS', 0)),
+        'cpuset': parse_cpuset(os.getenv('APP_CPUSET', '')),
+        'shm_size': parse_size(os.getenv('APP_SHM_SIZE', '256m')),
+        'pids_limit': int(os.getenv('APP_PIDS_LIMIT', 1024)),
+    }
+
+
+def validate_resources(data):
+    """設定ファイルのリソース制限を検証し、(リソース, エラー) を返す"""
+    if not isinstance(data, dict):
+        return None, 'resources must be a mapping'
+    resources = {}
+    for key, value in data.items():
+        parse = RESOURCE_FIELDS.get(key)
+        if parse is None:
+            return None, f"unknown resource: {key}"
+        try:
+            resources[key] = parse(value)
+        except (TypeError, ValueError) as e:
+            return None, f"{key}: {e}"
+    return resources, None
+
+
+def effective_resources(repo_resources=None):
+    """既定値 ← リポジトリの設定ファイル の順に上書きしたリソース制限"""
+    resources = default_resources()
+    resources.update(repo_resources or {})
+    return resources
+
+
+def container_options(resources):
+    """containers.run に渡すリソース制限"""
+    options = {}
+    if resources.get('memory'):
+        options['mem_limit'] = resources['memory']
+        options['memswap_limit'] = resources['memory']
+    if resources.get('cpus'):
+        options['nano_cpus'] = int(resources['cpus'] * 1e9)
+    if resources.get('cpuset'):
+        options['cpuset_cpus'] = resources['cpuset']
+    if resources.get('shm_size'):
+        options['shm_size'] = resources['shm_size']
+    if resources.get('pids_limit'):
+        options['pids_limit'] = resources['pids_limit']
+    return options
+
+
+def format_bytes(size):
+    return f"{size / 1024 ** 3:.1f}GiB" if size >= 1024 ** 3 else f"{size / 1024 ** 2:.0f}MiB"
+
+
+def host_memory_total():
+    """ホストの物理メモリ（HOST_MEMORY_MB 指定がなければ /proc/meminfo）"""
+    configured = os.getenv('HOST_MEMORY_MB')
+    if configured:
+        return int(float(configured) * 1024 * 1024)
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+class HostCapacity:
+    """ノード1台分の、起動済みアプリと起動中のデプロイのメモリ上限の合計（空き待ちは DockerHostPool.reserve）"""
+
+    def __init__(self, committed_func, total=None, name=None):
+        # committed_func() -> 起動済みアプリのメモリ上限の合計（バイト）
+        self.committed_func = committed_func
+        # total 未指定ならこのマシンの物理メモリ（リモートのノードは Docker の info から渡す）
+        total = host_memory_total() if total is None else total
+        reserved = int(float(os.getenv('HOST_MEMORY_RESERVED_MB', 1024)) * 1024 * 1024)
+        overcommit = float(os.getenv('HOST_MEMORY_OVERCOMMIT', 1.0))
+        # 0 なら容量管理しない
+        self.capacity = max(0, int((total - reserved) * overcommit)) if total else 0
+        self.reservations = {}
+        self.lock = threading.Lock()
+
+        if self.capacity:
+            logger.info(
+                f"🧮 Host memory capacity for apps{f' on {name}' if name else ''}: {format_bytes(self.capacity)} "
+                f"(total {format_bytes(total)}, reserved {format_bytes(reserved)}, overcommit {overcommit:g}x)"
+            )
+
+    def available(self):
+        """空き容量（ロック取得済み）"""
+        return self.capacity - self.committed_func() - sum(self.reservations.values())
+
+    def reserve(self, key, size):
+        """size バイトを予約する（待たない、待つのは DockerHostPool 側）。(予約できたか, 理由) を返す"""
+        if not self.capacity or not size:
+            return True, None
+        if size > self.capacity:
+            return False, f"needs {format_bytes(size)} of memory but the host can give apps at most {format_bytes(self.capacity)}"
+        with self.lock:
+            available = self.available()
+            if size > available:
+                return False, f"needs {format_bytes(size)} of memory, only {format_bytes(max(0, available))} free"
+            self.reservations[key] = self.reservations.get(key, 0) + size
+            return True, None
+
+    def release(self, key):
+        """予約を返す（起動したアプリは committed_func 側で数えられる）"""
+        with self.lock:
+            self.reservations.pop(key, None)
+
+    def status(self):
+        with self.lock:
+            committed = self.committed_func()
+            reserved = sum(self.reservations.values())
+        return {
+            'capacity_bytes': self.capacity,
+            'committed_bytes': committed,
+            'reserved_bytes': reserved,
+            'available_bytes': self.capacity - committed - reserved if self.capacity else None,
+        }
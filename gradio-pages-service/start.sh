@@ -0,0 +1,16 @@
+#!/bin/sh
+# Forgejo Gradio Pages 起動スクリプト
+# GRADIO_PAGES_SERVER=asgi の場合は gunicorn + uvicorn ワーカーで起動
+
+if [ "${GRADIO_PAGES_SERVER:-flask}" = "asgi" ]; then
+    echo "🚀 Starting ASGI server with ${GRADIO_PAGES_WORKERS:-1} worker(s)"
+    if [ "${GRADIO_PAGES_WORKERS:-1}" -gt 1 ]; then
+        # ワーカー間でメトリクスを集計するためのディレクトリ（起動毎に空にする）
+        export PROMETHEUS_MULTIPROC_DIR="${PROMETHEUS_MULTIPROC_DIR:-/tmp/prometheus-metrics}"
+        rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+        mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+    fi
+    exec gunicorn -c gunicorn.conf.py asgi_app:app
+fi
+
+exec python forgejo_gradio_manager.py
@@ -0,0 +1,219 @@
+"""
+アプリ状態ストア
+SQLite（WALモード）にアプリ毎の行として保存し、1アプリ単位でアトミックに更新する
+終了したデプロイジョブ（フェーズ時刻・ビルドログ）の履歴も保存する
+マルチワーカー時はホストポートの予約もここで管理する
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 永続化するフィールド（コンテナオブジェクトなど実行時のみの値は含めない）
+PERSISTED_FIELDS = (
+    'port', 'status', 'created', 'last_updated', 'repo_full_name',
+    'branch', 'container_name', 'slot', 'image', 'host', 'replicas', 'replica_count',
+    'limits', 'repo_limits', 'resources',
+)
+
+
+def persisted_record(app_info):
+    """保存用のレコード（レプリカのコンテナオブジェクトは除く）"""
+    record = {field: app_info.get(field) for field in PERSISTED_FIELDS}
+    if record['replicas'] is not None:
+        record['replicas'] = [
+            {key: value for key, value in replica.items() if key != 'container'}
+            for replica in record['replicas']
+        ]
+    return record
+
+
+class AppStateStore:
+    """apps テーブル（repo_id → JSON）と、変更検知用のバージョンカウンタ"""
+
+    def __init__(self, path, legacy_json=None, deploy_history=50):
+        self.path = path
+        # repo:branch 毎に残すデプロイ履歴の件数
+        self.deploy_history = deploy_history
+        self.local = threading.local()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+        conn = self.connection()
+        with conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS apps ("
+                "repo_id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS deploys ("
+                "job_id TEXT PRIMARY KEY, repo_id TEXT NOT NULL, data TEXT NOT NULL, finished_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS deploys_repo ON deploys (repo_id, finished_at)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ports ("
+                "node TEXT NOT NULL, port INTEGER NOT NULL, owner TEXT NOT NULL, PRIMARY KEY (node, port))"
+            )
+
+        if legacy_json:
+            self.import_legacy_json(legacy_json)
+
+    def connection(self):
+        """スレッド毎（fork後はプロセス毎）の接続"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+        return conn
+
+    def transaction(self, *statements, bump_version=True):
+        """複数の文を1トランザクションで実行し、バージョンを進める"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for sql, params in statements:
+                conn.execute(sql, params)
+            if bump_version:
+                conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def put(self, repo_id, app_info):
+        """1アプリ分の状態を保存"""
+        record = persisted_record(app_info)
+        self.transaction((
+            "INSERT INTO apps (repo_id, data, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(repo_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+            (repo_id, json.dumps(record), time.time())
+        ))
+
+    def delete(self, repo_id):
+        """1アプリ分の状態を削除"""
+        self.transaction(("DELETE FROM apps WHERE repo_id = ?", (repo_id,)))
+
+    def load(self):
+        """全アプリの状態を読む"""
+        rows = self.connection().execute("SELECT repo_id, data FROM apps").fetchall()
+        return {repo_id: json.loads(data) for repo_id, data in rows}
+
+    def version(self):
+        """書き込みの度に増えるカウンタ（他プロセスの変更検知用）"""
+        row = self.connection().execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def put_deploy(self, repo_id, job_data):
+        """終了したデプロイを保存し、古い履歴を削除（アプリ状態のバージョンは進めない）"""
+        self.transaction(
+            ("INSERT OR REPLACE INTO deploys (job_id, repo_id, data, finished_at) VALUES (?, ?, ?, ?)",
+             (job_data['id'], repo_id, json.dumps(job_data), time.time())),
+            ("DELETE FROM deploys WHERE repo_id = ? AND job_id NOT IN "
+             "(SELECT job_id FROM deploys WHERE repo_id = ? ORDER BY finished_at DESC LIMIT ?)",
+             (repo_id, repo_id, self.deploy_history)),
+            bump_version=False
+        )
+
+    def load_deploys(self, repo_id, limit=20):
+        """repo:branch のデプロイ履歴（新しい順、ログは含めない）"""
+        rows = self.connection().execute(
+            "SELECT data FROM deploys WHERE repo_id = ? ORDER BY finished_at DESC LIMIT ?",
+            (repo_id, limit)
+        ).fetchall()
+        deploys = []
+        for (data,) in rows:
+            job_data = json.loads(data)
+            job_data.pop('log', None)
+            deploys.append(job_data)
+        return deploys
+
+    def get_deploy(self, job_id):
+        """IDでデプロイを取得（ログ込み）"""
+        row = self.connection().execute("SELECT data FROM deploys WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def allocate_port(self, node, port_start, port_end, owner, probe=None):
+        """ノードの空きポートを1つ予約して返す（なければ None、前回の払い出しの次から探す）"""
+        conn = self.connection()
+        cursor_key = f"port_cursor:{node}"
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            taken = {row[0] for row in conn.execute("SELECT port FROM ports WHERE node = ?", (node,))}
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (cursor_key,)).fetchone()
+            last = row[0] if row and port_start <= row[0] <= port_end else port_end
+            # 直前に解放されたポートをすぐ使い回さないよう、前回の次から一周する
+            candidates = list(range(last + 1, port_end + 1)) + list(range(port_start, last + 1))
+            port = None
+            for candidate in candidates:
+                if candidate in taken:
+                    continue
+                if probe is None or probe(candidate):
+                    port = candidate
+                    break
+            if port is not None:
+                conn.execute("INSERT INTO ports (node, port, owner) VALUES (?, ?, ?)", (node, port, owner))
+                conn.execute(
+                    "INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                    (cursor_key, port)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return port
+
+    def reserve_port(self, node, port, owner):
+        """既知のポートを予約済みにする（予約済みなら何もしない）"""
+        self.transaction(
+            ("INSERT OR IGNORE INTO ports (node, port, owner) VALUES (?, ?, ?)", (node, port, owner)),
+            bump_version=False
+        )
+
+    def release_port(self, node, port):
+        """ポートの予約を外す（予約されていたら True）"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            released = conn.execute("DELETE FROM ports WHERE node = ? AND port = ?", (node, port)).rowcount > 0
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return released
+
+    def reserved_ports(self, node):
+        """ノードの予約済みポート（ポート → 予約者）"""
+        rows = self.connection().execute("SELECT port, owner FROM ports WHERE node = ?", (node,)).fetchall()
+        return dict(rows)
+
+    def clear_ports(self):
+        """ポートの予約を全て外す（起動時にアプリ状態から作り直す前）"""
+        self.transaction(("DELETE FROM ports", ()), bump_version=False)
+
+    def import_legacy_json(self, legacy_json):
+        """旧 apps_state.json があれば一度だけ取り込む"""
+        if not os.path.exists(legacy_json):
+            return
+        try:
+            with open(legacy_json, 'r') as f:
+                saved_data = json.load(f)
+            existing = self.load()
+            statements = [
+                ("INSERT OR IGNORE INTO apps (repo_id, data, updated_at) VALUES (?, ?, ?)",
+                 (repo_id, json.dumps(persisted_record(app_info)), time.time()))
+                for repo_id, app_info in saved_data.items() if repo_id not in existing
+            ]
+            self.transaction(*statements)
+            os.replace(legacy_json, legacy_json + '.migrated')
+            logger.info(f"📦 Migrated {len(statements)} apps from {legacy_json}")
+        except Exception as e:
+            logger.error(f"Error migrating {legacy_json}: {e}")